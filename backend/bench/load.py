@@ -0,0 +1,323 @@
+"""
+Load driver for the DevLift API.
+
+Sends explain / optimize / refactor requests at a target rate with bounded
+concurrency and reports throughput, latency percentiles, time to first
+byte and event-loop lag. Results are written as JSON so runs can be
+compared between commits.
+
+Against a running server (backed by bench.mock_llm):
+
+    python -m bench.load --url http://127.0.0.1:8000 --rps 50 --duration 30 --output results.json
+
+In-process, so the event-loop lag is the API's own:
+
+    python -m bench.load --in-process --rps 50 --duration 30 --baseline previous.json
+"""
+from typing import Optional, Dict, Any, List
+from collections import defaultdict
+import argparse
+import asyncio
+import itertools
+import json
+import platform
+import random
+import subprocess
+import time
+import httpx
+
+# Each request gets its own names, message and literals, drawn from a
+# per-run seed: the API answers repeats from its response cache, trace
+# fingerprints and similarity index without calling the provider, and those
+# compare traces with numbers stripped and code with identifiers renamed
+RUN_SEED = random.getrandbits(64)
+
+STACK_TRACE = """Traceback (most recent call last):
+  File "/app/{module}/handlers.py", line 42, in handle_{action}
+    result = {action}_{entity}(payload["{field}"])
+  File "/app/{module}/{entity}_store.py", line 17, in {action}_{entity}
+    return [item.{attribute} for item in {field}]
+{error}: '{kind}' object has no attribute '{attribute}' while {action} {entity} {field}"""
+
+OPTIMIZE_CODE = """def has_duplicates(items):
+    label = "{label}"
+    limit = {limit}
+    for i in range(min(len(items), limit)):
+        for j in range(i + 1, len(items)):
+            if items[i] == items[j] and items[i] != {sentinel}:
+                return label
+    return None"""
+
+REFACTOR_CODE = """import urllib2
+
+def greet(name):
+    message = "Hello, %s! You have %d new {label}" % (name, {count})
+    options = dict(verbose=True, retries={retries})
+    page = urllib2.urlopen("https://example.com/{label}").read()
+    return message, options, page"""
+
+ERRORS = ("AttributeError", "TypeError", "KeyError", "ValueError", "LookupError", "RuntimeError")
+
+
+def _word(rng: random.Random) -> str:
+    return "".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(5, 9)))
+
+
+def _rng(n: int) -> random.Random:
+    return random.Random(f"{RUN_SEED}:{n}")
+
+
+def stack_trace(n: int) -> str:
+    rng = _rng(n)
+    words = {key: _word(rng) for key in ("module", "action", "entity", "field", "kind", "attribute")}
+    return STACK_TRACE.format(error=rng.choice(ERRORS), **words)
+
+
+def optimize_code(n: int) -> str:
+    rng = _rng(n)
+    return OPTIMIZE_CODE.format(label=_word(rng), limit=rng.randint(100, 10 ** 6), sentinel=rng.randint(-10 ** 6, -1))
+
+
+def refactor_code(n: int) -> str:
+    rng = _rng(n)
+    return REFACTOR_CODE.format(label=_word(rng), count=rng.randint(1, 999), retries=rng.randint(1, 99))
+
+
+ENDPOINTS = {
+    "explain": ("/explain/stacktrace", lambda n: {"stack_trace": stack_trace(n), "language": "python"}),
+    "optimize": ("/optimize/dsa", lambda n: {"code": optimize_code(n), "language": "python"}),
+    "refactor": ("/refactor/modernize", lambda n: {
+        "code": refactor_code(n),
+        "source_language": "python",
+        "source_version": "2.7",
+        "target_version": "3.12"
+    }),
+}
+
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    """
+    p50 / p95 / p99 / mean / max of values, in milliseconds
+    """
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "mean": None, "max": None}
+    ordered = sorted(values)
+
+    def pick(pct: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(pct / 100 * len(ordered)))] * 1000, 2)
+
+    return {
+        "p50": pick(50),
+        "p95": pick(95),
+        "p99": pick(99),
+        "mean": round(sum(ordered) / len(ordered) * 1000, 2),
+        "max": round(ordered[-1] * 1000, 2)
+    }
+
+
+async def monitor_loop_lag(samples: List[float], interval: float = 0.01) -> None:
+    """
+    Measure how late the event loop wakes up from a short sleep
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, loop.time() - started - interval))
+
+
+async def send(client: httpx.AsyncClient, endpoint: str, n: int, stream: bool) -> Dict[str, Any]:
+    """
+    Send one request and time it
+
+    Returns:
+        A dict with endpoint, status, latency and time to first byte
+    """
+    path, payload = ENDPOINTS[endpoint]
+    if stream:
+        path += "/stream"
+    started = time.perf_counter()
+    ttfb = None
+    try:
+        async with client.stream("POST", path, json=payload(n)) as response:
+            async for _ in response.aiter_raw():
+                if ttfb is None:
+                    ttfb = time.perf_counter() - started
+            status = response.status_code
+    except httpx.HTTPError as e:
+        return {"endpoint": endpoint, "status": type(e).__name__, "latency": time.perf_counter() - started, "ttfb": ttfb}
+    return {"endpoint": endpoint, "status": status, "latency": time.perf_counter() - started, "ttfb": ttfb}
+
+
+async def run_load(
+    client: httpx.AsyncClient,
+    endpoints: List[str],
+    rps: float,
+    duration: float,
+    concurrency: int,
+    stream: bool = False,
+    poisson: bool = True
+) -> Dict[str, Any]:
+    """
+    Open-loop load: requests are started on an arrival schedule regardless
+    of how fast earlier ones finish, up to concurrency at a time. Arrivals
+    that find every slot busy wait, and that wait counts in their latency.
+
+    Args:
+        client: Client pointed at the API
+        endpoints: Endpoint names to cycle through
+        rps: Target arrival rate
+        duration: Seconds to generate load for
+        concurrency: Maximum requests in flight
+        stream: Hit the /stream variants
+        poisson: Exponential inter-arrival times instead of a fixed interval
+
+    Returns:
+        The benchmark report
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    results: List[Dict[str, Any]] = []
+    lag: List[float] = []
+    tasks = []
+    counter = itertools.count()
+    mix = itertools.cycle(endpoints)
+
+    async def one(endpoint: str, n: int, scheduled: float) -> None:
+        async with semaphore:
+            result = await send(client, endpoint, n, stream)
+        # Include queueing behind the concurrency limit
+        result["latency"] = time.perf_counter() - scheduled
+        results.append(result)
+
+    monitor = asyncio.create_task(monitor_loop_lag(lag))
+    started = time.perf_counter()
+    next_at = started
+    while next_at - started < duration:
+        delay = next_at - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(one(next(mix), next(counter), next_at)))
+        next_at += random.expovariate(rps) if poisson else 1 / rps
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    monitor.cancel()
+
+    return {
+        "elapsed_seconds": round(elapsed, 3),
+        "event_loop_lag_ms": percentiles(lag),
+        **summarize(results, elapsed),
+        "endpoints": {
+            name: summarize([r for r in results if r["endpoint"] == name], elapsed)
+            for name in endpoints
+        }
+    }
+
+
+def summarize(results: List[Dict[str, Any]], elapsed: float) -> Dict[str, Any]:
+    statuses: Dict[str, int] = defaultdict(int)
+    for result in results:
+        statuses[str(result["status"])] += 1
+    ok = [r for r in results if r["status"] == 200]
+    return {
+        "requests": len(results),
+        "errors": len(results) - len(ok),
+        "throughput_rps": round(len(ok) / elapsed, 2) if elapsed else 0.0,
+        "statuses": dict(statuses),
+        "latency_ms": percentiles([r["latency"] for r in ok]),
+        "ttfb_ms": percentiles([r["ttfb"] for r in ok if r["ttfb"] is not None])
+    }
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any]) -> List[str]:
+    """
+    Describe changes in throughput and latency against a baseline report
+    """
+    lines = []
+
+    def delta(label: str, new: Optional[float], old: Optional[float]) -> None:
+        if new is None or old is None or not old:
+            return
+        lines.append(f"{label}: {old} -> {new} ({(new - old) / old * 100:+.1f}%)")
+
+    delta("throughput_rps", current["throughput_rps"], baseline["throughput_rps"])
+    for key in ("latency_ms", "ttfb_ms", "event_loop_lag_ms"):
+        for pct in ("p50", "p95", "p99"):
+            delta(f"{key} {pct}", current[key][pct], baseline[key][pct])
+    return lines
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _client(url: Optional[str], in_process: bool, concurrency: int, timeout: float) -> httpx.AsyncClient:
+    if in_process:
+        from main import app
+        return httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://devlift", timeout=timeout)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    return httpx.AsyncClient(base_url=url, limits=limits, timeout=timeout)
+
+
+async def main_async(args: argparse.Namespace) -> Dict[str, Any]:
+    async with _client(args.url, args.in_process, args.concurrency, args.timeout) as client:
+        report = await run_load(
+            client,
+            args.endpoints,
+            rps=args.rps,
+            duration=args.duration,
+            concurrency=args.concurrency,
+            stream=args.stream,
+            poisson=not args.constant
+        )
+    report["config"] = {
+        "url": None if args.in_process else args.url,
+        "in_process": args.in_process,
+        "endpoints": args.endpoints,
+        "rps": args.rps,
+        "duration": args.duration,
+        "concurrency": args.concurrency,
+        "stream": args.stream,
+        "arrivals": "constant" if args.constant else "poisson"
+    }
+    report["commit"] = _git_commit()
+    report["timestamp"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    report["python"] = platform.python_version()
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="DevLift load driver")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="Base URL of the API")
+    parser.add_argument("--in-process", action="store_true", help="Drive main:app in this process via ASGI")
+    parser.add_argument("--endpoints", nargs="+", choices=list(ENDPOINTS), default=list(ENDPOINTS))
+    parser.add_argument("--rps", type=float, default=20, help="Target arrival rate")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds of load")
+    parser.add_argument("--concurrency", type=int, default=64, help="Maximum requests in flight")
+    parser.add_argument("--stream", action="store_true", help="Use the streaming endpoints")
+    parser.add_argument("--constant", action="store_true", help="Fixed inter-arrival time instead of Poisson")
+    parser.add_argument("--timeout", type=float, default=120, help="Per-request timeout in seconds")
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    parser.add_argument("--baseline", help="JSON report to compare against")
+    args = parser.parse_args()
+
+    report = asyncio.run(main_async(args))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print("\nCompared with", args.baseline, f"({baseline.get('commit')})")
+        for line in compare(report, baseline):
+            print("  " + line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+"""
+Mock OpenAI-compatible chat completions server for load testing DevLift
+without paying for real completions.
+
+Run from the backend directory:
+
+    python -m bench.mock_llm --port 9100 --latency lognormal:0.8:0.5 --tokens-per-second 80
+
+and point a provider at it, e.g. OPENAI_API_KEY=mock OPENAI_BASE_URL=http://127.0.0.1:9100/v1
+"""
+from typing import Optional, Dict, Any, Callable
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# Rough characters per token, used to size streamed deltas
+CHARS_PER_TOKEN = 4
+
+
+def parse_distribution(spec: str) -> Callable[[], float]:
+    """
+    Build a sampler from a latency spec
+
+    Args:
+        spec: One of "fixed:S", "uniform:LOW:HIGH", "normal:MEAN:STD",
+            "lognormal:MEDIAN:SIGMA" or "exponential:MEAN" (seconds)
+
+    Returns:
+        A callable returning a non-negative delay in seconds
+    """
+    kind, *params = spec.split(":")
+    values = [float(p) for p in params]
+    samplers = {
+        "fixed": lambda: values[0],
+        "uniform": lambda: random.uniform(values[0], values[1]),
+        "normal": lambda: random.gauss(values[0], values[1]),
+        "lognormal": lambda: random.lognormvariate(math.log(values[0]), values[1]),
+        "exponential": lambda: random.expovariate(1 / values[0]),
+    }
+    if kind not in samplers:
+        raise ValueError(f"Unknown latency distribution: {spec}")
+    sampler = samplers[kind]
+    return lambda: max(0.0, sampler())
+
+
+class MockConfig:
+    """
+    Behaviour of the mock server
+    """
+
+    def __init__(
+        self,
+        latency: str = "fixed:0.2",
+        tokens_per_second: float = 0,
+        completion_tokens: int = 300,
+        error_rate: float = 0,
+        error_status: int = 500,
+        hang_rate: float = 0,
+        stream_error_rate: float = 0,
+        rate_limit_rpm: int = 0
+    ):
+        self.latency = parse_distribution(latency)
+        self.tokens_per_second = tokens_per_second
+        self.completion_tokens = completion_tokens
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.hang_rate = hang_rate
+        self.stream_error_rate = stream_error_rate
+        self.rate_limit_rpm = rate_limit_rpm
+
+
+def _content(tokens: int) -> str:
+    """
+    A JSON answer valid for every DevLift endpoint, padded to roughly the
+    requested number of tokens
+    """
+    answer = {
+        "explanation": "",
+        "possible_fixes": ["Check the value before dereferencing it", "Add a regression test"],
+        "references": ["https://docs.python.org/3/tutorial/errors.html"],
+        "optimized_code": "def solve(items):\n    seen = set()\n    return [x for x in items if not (x in seen or seen.add(x))]",
+        "time_complexity_before": "O(n^2)",
+        "time_complexity_after": "O(n)",
+        "space_complexity_before": "O(1)",
+        "space_complexity_after": "O(n)",
+        "optimization_techniques": ["Hash set membership"],
+        "refactored_code": "def greet(name: str) -> str:\n    return f\"Hello {name}\"",
+        "changes_made": ["Use f-strings", "Add type hints"],
+        "migration_notes": "No behaviour changes."
+    }
+    padding = max(0, tokens * CHARS_PER_TOKEN - len(json.dumps(answer)))
+    answer["explanation"] = ("The value is None at this point. " * (padding // 33 + 1))[:max(padding, 20)]
+    return json.dumps(answer)
+
+
+def create_app(config: Optional[MockConfig] = None) -> FastAPI:
+    config = config or MockConfig()
+    app = FastAPI(title="DevLift mock LLM")
+    counters = {"requests": 0, "errors": 0, "streams": 0, "rate_limited": 0}
+    window = {"start": time.monotonic(), "used": 0}
+
+    def _rate_limit_headers() -> Dict[str, str]:
+        """
+        OpenAI-style x-ratelimit-* headers for a fixed one-minute window
+        """
+        now = time.monotonic()
+        if now - window["start"] >= 60:
+            window.update(start=now, used=0)
+        reset = 60 - (now - window["start"])
+        return {
+            "x-ratelimit-limit-requests": str(config.rate_limit_rpm),
+            "x-ratelimit-remaining-requests": str(max(0, config.rate_limit_rpm - window["used"])),
+            "x-ratelimit-reset-requests": f"{reset:.3f}s",
+        }
+
+    def _chunk(model: str, delta: Dict[str, Any], finish: Optional[str] = None) -> str:
+        payload = {
+            "id": "chatcmpl-mock",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish}]
+        }
+        return f"data: {json.dumps(payload)}\n\n"
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        counters["requests"] += 1
+        model = body.get("model", "mock")
+        max_tokens = body.get("max_tokens") or config.completion_tokens
+        tokens = min(config.completion_tokens, max_tokens)
+        content = _content(tokens)
+        prompt_tokens = sum(len(m.get("content") or "") for m in body.get("messages", [])) // CHARS_PER_TOKEN
+
+        headers: Dict[str, str] = {}
+        if config.rate_limit_rpm:
+            headers = _rate_limit_headers()
+            if window["used"] >= config.rate_limit_rpm:
+                counters["rate_limited"] += 1
+                return JSONResponse(
+                    {"error": {"message": "Rate limit reached for requests", "type": "requests"}},
+                    status_code=429,
+                    headers={**headers, "retry-after": headers["x-ratelimit-reset-requests"].rstrip("s")}
+                )
+            window["used"] += 1
+            headers["x-ratelimit-remaining-requests"] = str(config.rate_limit_rpm - window["used"])
+
+        if random.random() < config.hang_rate:
+            # Never answer; exercises client timeouts and cancellation
+            await asyncio.sleep(3600)
+        if random.random() < config.error_rate:
+            counters["errors"] += 1
+            headers = {"retry-after": "1"} if config.error_status == 429 else {}
+            return JSONResponse(
+                {"error": {"message": "Injected failure", "type": "server_error"}},
+                status_code=config.error_status,
+                headers=headers
+            )
+
+        # Time to first token
+        await asyncio.sleep(config.latency())
+
+        if body.get("stream"):
+            counters["streams"] += 1
+            token_delay = 1 / config.tokens_per_second if config.tokens_per_second else 0
+            step = CHARS_PER_TOKEN
+
+            async def events():
+                yield _chunk(model, {"role": "assistant", "content": ""})
+                for i in range(0, len(content), step):
+                    if i and random.random() < config.stream_error_rate / max(1, len(content) // step):
+                        # Drop the connection mid-stream
+                        raise RuntimeError("Injected stream failure")
+                    yield _chunk(model, {"content": content[i:i + step]})
+                    if token_delay:
+                        await asyncio.sleep(token_delay)
+                yield _chunk(model, {}, "stop")
+                yield "data: [DONE]\n\n"
+
+            return StreamingResponse(events(), media_type="text/event-stream", headers=headers)
+
+        if config.tokens_per_second:
+            await asyncio.sleep(tokens / config.tokens_per_second)
+        return JSONResponse({
+            "id": "chatcmpl-mock",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": tokens, "total_tokens": prompt_tokens + tokens}
+        }, headers=headers)
+
+    @app.get("/stats")
+    async def stats():
+        return counters
+
+    return app
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Mock OpenAI-compatible server for DevLift benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--latency", default="fixed:0.2", help="Time to first token, e.g. lognormal:0.8:0.5")
+    parser.add_argument("--tokens-per-second", type=float, default=0, help="Generation speed (0 = instant)")
+    parser.add_argument("--completion-tokens", type=int, default=300, help="Tokens per answer, capped by max_tokens")
+    parser.add_argument("--error-rate", type=float, default=0, help="Fraction of requests answered with an error")
+    parser.add_argument("--error-status", type=int, default=500, help="HTTP status of injected errors")
+    parser.add_argument("--hang-rate", type=float, default=0, help="Fraction of requests that never answer")
+    parser.add_argument("--stream-error-rate", type=float, default=0, help="Fraction of streams cut off mid-way")
+    parser.add_argument("--rate-limit-rpm", type=int, default=0, help="Emulate an upstream requests-per-minute limit")
+    args = parser.parse_args()
+
+    config = MockConfig(
+        latency=args.latency,
+        tokens_per_second=args.tokens_per_second,
+        completion_tokens=args.completion_tokens,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        hang_rate=args.hang_rate,
+        stream_error_rate=args.stream_error_rate,
+        rate_limit_rpm=args.rate_limit_rpm
+    )
+
+    import uvicorn
+    uvicorn.run(create_app(config), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
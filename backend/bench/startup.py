@@ -0,0 +1,175 @@
+"""
+Startup benchmark for the DevLift API.
+
+Measures, in fresh interpreters, how long `import main` takes in total and
+how much of that is the app's own code once the libraries preloaded by
+serve.py are in memory (what a forked worker pays), and checks that modules
+deferred to first use (the provider SDK, httpx, tiktoken) stay out of
+startup. Optionally starts serve.py and times the first /health answer.
+Exits non-zero when a budget is exceeded, so it can gate CI.
+
+    python -m bench.startup --runs 5 --budget 2.0 --app-budget 0.4
+    python -m bench.startup --serve --workers 4 --output startup.json
+"""
+from typing import Optional, Dict, Any, List
+import argparse
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import httpx
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Must not be imported by `import main`; they load on the first request instead
+DEFERRED_MODULES = ("openai", "httpx", "tiktoken")
+
+_PROBE = """
+import json, sys, time
+preload = {preload!r}
+started = time.perf_counter()
+for module in preload:
+    try:
+        __import__(module)
+    except ImportError:
+        pass
+preloaded = time.perf_counter()
+import main
+finished = time.perf_counter()
+print(json.dumps({{
+    "total": finished - started,
+    "app": finished - preloaded,
+    "loaded": [m for m in {deferred!r} if m in sys.modules]
+}}))
+"""
+
+
+def _probe(preload: List[str]) -> Dict[str, Any]:
+    """
+    Import main in a fresh interpreter, after importing preload
+    """
+    code = _PROBE.format(preload=preload, deferred=DEFERRED_MODULES)
+    result = subprocess.run(
+        [sys.executable, "-c", code], cwd=BACKEND_DIR, capture_output=True, text=True, check=True
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def slowest_imports(limit: int = 15) -> List[Dict[str, Any]]:
+    """
+    The modules with the largest cumulative import time, from -X importtime
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=BACKEND_DIR, capture_output=True, text=True, check=True
+    )
+    rows = []
+    for line in result.stderr.splitlines():
+        parts = line.removeprefix("import time:").split("|")
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        rows.append({"module": parts[2].strip(), "cumulative_ms": round(int(parts[1]) / 1000, 1)})
+    return sorted(rows, key=lambda row: row["cumulative_ms"], reverse=True)[:limit]
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def time_to_ready(workers: int, timeout: float = 60) -> Optional[float]:
+    """
+    Start serve.py and time how long until /health answers
+    """
+    port = _free_port()
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "serve.py", "--host", "127.0.0.1", "--port", str(port), "--workers", str(workers),
+         "--log-level", "warning"],
+        cwd=BACKEND_DIR
+    )
+    try:
+        while time.perf_counter() - started < timeout:
+            try:
+                if httpx.get(f"http://127.0.0.1:{port}/health", timeout=1).status_code == 200:
+                    return time.perf_counter() - started
+            except httpx.TransportError:
+                pass
+            if process.poll() is not None:
+                return None
+            time.sleep(0.02)
+        return None
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+
+
+def run(runs: int, preload: List[str]) -> Dict[str, Any]:
+    cold = [_probe([]) for _ in range(runs)]
+    warm = [_probe(preload) for _ in range(runs)]
+    return {
+        "import_s": {
+            "median": round(statistics.median(r["total"] for r in cold), 3),
+            "min": round(min(r["total"] for r in cold), 3),
+            "max": round(max(r["total"] for r in cold), 3)
+        },
+        "app_import_s": {
+            "median": round(statistics.median(r["app"] for r in warm), 3),
+            "min": round(min(r["app"] for r in warm), 3),
+            "max": round(max(r["app"] for r in warm), 3)
+        },
+        "deferred_loaded": sorted({m for r in cold for m in r["loaded"]})
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="DevLift startup benchmark")
+    parser.add_argument("--runs", type=int, default=5, help="Fresh interpreters per measurement")
+    parser.add_argument("--budget", type=float, default=float(os.getenv("STARTUP_IMPORT_BUDGET", "2.0")),
+                        help="Maximum median seconds for `import main`")
+    parser.add_argument("--app-budget", type=float, default=float(os.getenv("STARTUP_APP_IMPORT_BUDGET", "0.4")),
+                        help="Maximum median seconds for the app's own imports after serve.py's preload")
+    parser.add_argument("--serve", action="store_true", help="Also time serve.py until /health answers")
+    parser.add_argument("--workers", type=int, default=2, help="Workers for --serve")
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    args = parser.parse_args()
+
+    sys.path.insert(0, BACKEND_DIR)
+    from serve import PRELOAD_MODULES
+
+    report = run(args.runs, list(PRELOAD_MODULES))
+    report["slowest_imports"] = slowest_imports()
+    if args.serve:
+        ready = time_to_ready(args.workers)
+        report["ready_s"] = round(ready, 3) if ready is not None else None
+    report["budget_s"] = {"import": args.budget, "app_import": args.app_budget}
+    report["python"] = platform.python_version()
+
+    failures = []
+    if report["import_s"]["median"] > args.budget:
+        failures.append(f"import main took {report['import_s']['median']}s (budget {args.budget}s)")
+    if report["app_import_s"]["median"] > args.app_budget:
+        failures.append(f"app imports took {report['app_import_s']['median']}s (budget {args.app_budget}s)")
+    if report["deferred_loaded"]:
+        failures.append(f"imported at startup instead of on first use: {', '.join(report['deferred_loaded'])}")
+    if args.serve and report["ready_s"] is None:
+        failures.append("serve.py did not answer /health")
+    report["ok"] = not failures
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+    for failure in failures:
+        print("FAIL:", failure, file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,40 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import RedirectResponse
-from routers import explain, refactor, optimize
+from fastapi.responses import RedirectResponse, PlainTextResponse
+from routers import explain, refactor, optimize, batch, jobs, repository
+from services import metrics
+from services.admission import snapshot as admission_snapshot
+from services.ai_service import ai_service
+from services.cache import response_cache
+from services.deadline import DeadlineMiddleware
+from services.jobs import JobWorker, job_store, JOBS_RUN_IN_API
+from services.similarity import similarity_index
+from services.stacktrace import fingerprint_index
+from services.structured_output import parse_stats
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    worker = JobWorker(job_store) if JOBS_RUN_IN_API else None
+    if worker is not None:
+        await worker.start()
+    yield
+    if worker is not None:
+        await worker.stop()
+    # Release the pooled provider connections on shutdown
+    await ai_service.aclose()
 
 app = FastAPI(
     title="DevLift API",
     description="API for DevLift, an AI-powered tool for debugging, refactoring, and optimizing code",
-    version="0.1.0"
+    version="0.1.0",
+    lifespan=lifespan
 )
 
+# Request deadlines, and cancellation of abandoned requests. Added first so
+# it sits inside CORS and its 504s still carry the CORS headers.
+app.add_middleware(DeadlineMiddleware)
+
 # Configure CORS
 app.add_middleware(
     CORSMiddleware,
@@ -19,12 +45,20 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing"],
 )
 
-# Include routers
+# Per-route latency and Server-Timing headers
+app.middleware("http")(metrics.metrics_middleware)
+
+# Include routers; the routes that start work declare their own admission
+# control, so status polls and downloads do not spend a client's quota
 app.include_router(explain.router)
 app.include_router(refactor.router)
 app.include_router(optimize.router)
+app.include_router(batch.router)
+app.include_router(jobs.router)
+app.include_router(repository.router)
 
 @app.get("/")
 async def root():
@@ -34,6 +68,63 @@ async def root():
 async def health_check():
     return {"status": "healthy"}
 
+@app.get("/cache/stats")
+async def cache_stats():
+    """
+    Hit, miss and coalesce counters for the response cache, the stack
+    trace fingerprint index and the near-duplicate similarity index
+    """
+    indexes = {"fingerprints": fingerprint_index.stats(), "similarity": similarity_index.stats()}
+    if response_cache is None:
+        return {"enabled": False, **indexes}
+    return {"enabled": True, **await response_cache.stats(), **indexes}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint():
+    """
+    Prometheus metrics: route and provider latency, time to first token,
+    queue wait, tokens, errors, plus cache and parser counters
+    """
+    samples = []
+    if response_cache is not None:
+        cache = await response_cache.stats()
+        samples += metrics.stats_samples(
+            "devlift_cache_events_total", "counter", "Response cache lookups by outcome",
+            {k: cache[k] for k in ("memory_hits", "disk_hits", "misses", "coalesced", "evictions")}, "event"
+        )
+        samples += metrics.stats_samples(
+            "devlift_cache_entries", "gauge", "Response cache entries by tier",
+            {"memory": cache["memory_entries"], "disk": cache["disk_entries"]}, "tier"
+        )
+    fingerprints = fingerprint_index.stats()
+    samples += metrics.stats_samples(
+        "devlift_fingerprint_lookups_total", "counter", "Stack trace fingerprint index lookups by outcome",
+        {k: fingerprints[k] for k in ("hits", "misses")}, "event"
+    )
+    similar = similarity_index.stats()
+    samples += metrics.stats_samples(
+        "devlift_similarity_lookups_total", "counter", "Near-duplicate index lookups by outcome",
+        {k: similar[k] for k in ("exact_hits", "similar_hits", "misses")}, "event"
+    )
+    samples += metrics.stats_samples(
+        "devlift_similarity_entries", "gauge", "Near-duplicate index entries by tier",
+        {"memory": similar["memory_entries"], "disk": similar["entries"]}, "tier"
+    )
+    queue = admission_snapshot()
+    samples += metrics.stats_samples(
+        "devlift_admission_waiting", "gauge", "Upstream calls waiting in the fair queue", queue["waiting"], "priority"
+    )
+    samples += metrics.stats_samples(
+        "devlift_admission_slots", "gauge", "Fair queue dispatch slots",
+        {"in_use": queue["in_use"], "capacity": queue["capacity"]}, "state"
+    )
+    for provider, counts in parse_stats().items():
+        samples += metrics.stats_samples(
+            "devlift_parse_outcomes_total", "counter", "Structured output parse outcomes",
+            {k: v for k, v in counts.items() if not k.endswith("_rate")}, "outcome", provider=provider
+        )
+    return PlainTextResponse(metrics.registry.render(samples), media_type="text/plain; version=0.0.4")
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True) 
\ No newline at end of file
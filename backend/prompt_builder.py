@@ -1,17 +1,45 @@
-from typing import Optional, List
+from typing import Optional, Dict, List, Tuple
+import ast
+import os
+import re
+
+# Token budget for the code embedded in a single prompt; larger inputs are split
+PROMPT_CODE_BUDGET = int(os.getenv("PROMPT_CODE_BUDGET", "3000"))
+# Bounds for the adaptive completion token limit
+MIN_OUTPUT_TOKENS = int(os.getenv("MIN_OUTPUT_TOKENS", "512"))
+MAX_OUTPUT_TOKENS = int(os.getenv("MAX_OUTPUT_TOKENS", "4096"))
+
+# tiktoken loads (and may download) its vocabulary, so it is set up on first use
+_encoding = None
+_encoding_loaded = False
+
+# Lines that start a new top-level unit in brace/indent languages
+_UNIT_START = re.compile(
+    r"^(?:export\s+)?(?:default\s+)?(?:public|private|protected|static|final|abstract|async|func|fn|def|class|"
+    r"interface|enum|record|struct|impl|function|const|let|var|type)\b"
+)
+# Declarations whose body holds members (methods, fields, nested types)
+_SCOPE_START = re.compile(r"\b(?:class|interface|enum|record|struct|impl|trait|object|namespace|module)\b")
+# Import-like lines shared as context with every chunk
+_CONTEXT_LINE = re.compile(
+    r"^\s*(?:import\s|from\s+\S+\s+import\s|package\s|#include\s|using\s|"
+    r"(?:const|let|var)\s+\w+\s*=\s*require\()"
+)
 
 def build_stacktrace_prompt(
     stack_trace: str, 
     language: Optional[str] = None, 
-    framework: Optional[str] = None
+    framework: Optional[str] = None,
+    reference: Optional[str] = None
 ) -> str:
     """
     Build a prompt for analyzing stack traces
     
     Args:
-        stack_trace: The error stack trace
+        stack_trace: The error stack trace (normalized by services.stacktrace)
         language: The programming language (e.g., Python, Java)
         framework: The framework being used (e.g., Django, Spring)
+        reference: Answer to a near-duplicate earlier submission, if any
         
     Returns:
         A formatted prompt for the AI
@@ -32,6 +60,7 @@ def build_stacktrace_prompt(
     if framework:
         prompt.append(f"\nFramework: {framework}")
     
+    prompt.extend(_reference_notes(reference))
     prompt.append("\nPlease format your response as JSON with the following structure:")
     prompt.append("""
     {
@@ -49,7 +78,11 @@ def build_refactor_prompt(
     source_version: str,
     target_version: str,
     preserve_comments: bool = True,
-    modernization_level: str = "moderate"
+    modernization_level: str = "moderate",
+    part: Optional[Tuple[int, int]] = None,
+    context: Optional[str] = None,
+    reference: Optional[str] = None,
+    api_renames: Optional[Dict[str, str]] = None
 ) -> str:
     """
     Build a prompt for refactoring/modernizing code
@@ -61,6 +94,10 @@ def build_refactor_prompt(
         target_version: Target language version (e.g., Java 17)
         preserve_comments: Whether to keep comments
         modernization_level: How aggressive the refactoring should be
+        part: (index, total) when the code is one chunk of a larger file
+        context: Imports / declarations from the rest of the file
+        reference: Answer to a near-duplicate earlier submission, if any
+        api_renames: APIs renamed in code this file depends on (qualified old name -> new name)
         
     Returns:
         A formatted prompt for the AI
@@ -70,12 +107,15 @@ def build_refactor_prompt(
         f"Please refactor the following {source_language} {source_version} code to use {target_version} features.",
         f"\nModernization level: {modernization_level.upper()}",
         f"Preserve comments: {'Yes' if preserve_comments else 'No'}",
+        *_chunk_notes(part, context),
+        *_rename_notes(api_renames),
         "\nOriginal code:\n",
         "```",
         code,
         "```",
         "\nPlease refactor this code to use modern features and best practices.",
         "For each change you make, briefly explain the reasoning behind it.",
+        *_reference_notes(reference),
         "Format your response as JSON with the following structure:",
         """
         {
@@ -93,7 +133,10 @@ def build_optimizer_prompt(
     language: str,
     algorithm_type: Optional[str] = None,
     expected_complexity: Optional[str] = None,
-    include_explanation: bool = True
+    include_explanation: bool = True,
+    part: Optional[Tuple[int, int]] = None,
+    context: Optional[str] = None,
+    reference: Optional[str] = None
 ) -> str:
     """
     Build a prompt for optimizing algorithms
@@ -104,6 +147,9 @@ def build_optimizer_prompt(
         algorithm_type: What type of algorithm (sorting, searching, etc.)
         expected_complexity: Target complexity if known
         include_explanation: Whether to include a detailed explanation
+        part: (index, total) when the code is one chunk of a larger file
+        context: Imports / declarations from the rest of the file
+        reference: Answer to a near-duplicate earlier submission, if any
         
     Returns:
         A formatted prompt for the AI
@@ -111,6 +157,7 @@ def build_optimizer_prompt(
     prompt = [
         "You are an expert algorithm optimization assistant.",
         f"Please analyze and optimize the following {language} code for better time and space complexity:",
+        *_chunk_notes(part, context),
         "\n```",
         code,
         "```\n"
@@ -131,6 +178,7 @@ def build_optimizer_prompt(
         prompt.append("4. A detailed explanation of the optimizations made")
     
     prompt.append("5. A list of the optimization techniques used")
+    prompt.extend(_reference_notes(reference))
     
     prompt.append("\nFormat your response as JSON with the following structure:")
     prompt.append("""
@@ -145,4 +193,338 @@ def build_optimizer_prompt(
     }
     """)
     
-    return "\n".join(prompt) 
\ No newline at end of file
+    return "\n".join(prompt) 
+
+def build_followup_prompt(diff: str, code_field: str) -> str:
+    """
+    Build the prompt for a follow-up round of a session. It is sent after
+    the first round's prompt and answer, which stay byte-identical between
+    rounds so the provider can serve them from its prompt cache.
+
+    Args:
+        diff: Unified diff from the code answered before to the current code
+        code_field: The JSON field holding the code in the earlier answer
+
+    Returns:
+        A formatted prompt for the AI
+    """
+    prompt = [
+        "The code has changed since your answer above. Unified diff from the code you answered for:",
+        "```diff",
+        diff,
+        "```",
+        "\nAnswer again for the updated code with the same JSON structure, with two differences:",
+        f'- "{code_field}" must be a unified diff (with @@ hunk headers and 3 lines of context) '
+        f'against the "{code_field}" of your previous answer, not the complete code.',
+        "- Every other field describes the whole updated result, not only what changed."
+    ]
+    
+    return "\n".join(prompt)
+
+def normalize_prompt(prompt: str) -> str:
+    """
+    Normalize a prompt so that cosmetic differences map to the same cache key
+
+    Args:
+        prompt: The prompt produced by one of the builders above
+
+    Returns:
+        The prompt with trailing whitespace removed, line endings unified
+        and runs of blank lines collapsed
+    """
+    lines = [line.rstrip() for line in prompt.replace("\r\n", "\n").split("\n")]
+    normalized = []
+    for line in lines:
+        if not line and normalized and not normalized[-1]:
+            continue
+        normalized.append(line)
+    return "\n".join(normalized).strip()
+
+def _chunk_notes(part: Optional[Tuple[int, int]], context: Optional[str]) -> List[str]:
+    """
+    Extra prompt lines telling the model it only sees one chunk of a file
+    """
+    if part is None:
+        return []
+    notes = [
+        f"\nThis is part {part[0] + 1} of {part[1]} of a larger file.",
+        "Only work on the code in this part and return only this part, keeping its indentation."
+    ]
+    if context:
+        notes += ["Context from the rest of the file (do not return it):", "```", context, "```"]
+    return notes
+
+def _rename_notes(api_renames: Optional[Dict[str, str]]) -> List[str]:
+    """
+    Extra prompt lines listing APIs that other files of the same project
+    renamed, so references to them are updated consistently
+    """
+    if not api_renames:
+        return []
+    return [
+        "\nThese APIs were renamed elsewhere in the project; update every reference to them:",
+        *(f"- {old} -> {new}" for old, new in sorted(api_renames.items()))
+    ]
+
+def _reference_notes(reference: Optional[str]) -> List[str]:
+    """
+    Extra prompt lines offering the answer to a near-duplicate submission,
+    so the model only has to adapt it
+    """
+    if not reference:
+        return []
+    return [
+        "\nA very similar submission was answered before with:",
+        reference,
+        "Reuse whatever still applies and only change what this input requires."
+    ]
+
+def _get_encoding():
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        _encoding_loaded = True
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            _encoding = None
+    return _encoding
+
+def estimate_tokens(text: str) -> int:
+    """
+    Count tokens with tiktoken when it is installed, otherwise estimate
+    roughly four characters per token
+
+    Args:
+        text: The text to measure
+
+    Returns:
+        The (estimated) number of tokens
+    """
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return len(text) // 4 + 1
+
+def output_token_budget(code: str) -> int:
+    """
+    Pick a completion token limit that scales with the input instead of a
+    fixed 1000: the answer repeats the code plus some explanation
+
+    Args:
+        code: The code (or code chunk) sent to the model
+
+    Returns:
+        A max_tokens value between MIN_OUTPUT_TOKENS and MAX_OUTPUT_TOKENS
+    """
+    wanted = int(estimate_tokens(code) * 1.3) + 400
+    return max(MIN_OUTPUT_TOKENS, min(MAX_OUTPUT_TOKENS, wanted))
+
+def extract_context(code: str) -> str:
+    """
+    Collect import / package lines so every chunk knows what is in scope
+    """
+    return "\n".join(line for line in code.split("\n") if _CONTEXT_LINE.match(line))
+
+def chunk_context(context: Optional[str], scope: str) -> Optional[str]:
+    """
+    Context for one chunk: the file's imports and, for a chunk that
+    continues a class split between its members, the enclosing headers
+
+    Args:
+        context: Import lines from extract_context, if the chunk needs them
+        scope: The chunk's enclosing declaration headers ("" at top level)
+    """
+    parts = [context] if context else []
+    if scope:
+        indent = re.match(r"\s*", scope.split("\n")[-1]).group(0) + "    "
+        parts.append(f"{scope}\n{indent}...  (this part continues here)")
+    return "\n".join(parts) or None
+
+def _join_scope(scope: str, header: str) -> str:
+    return f"{scope}\n{header}" if scope else header
+
+def _python_units(code: str, budget: int) -> Optional[List[Tuple[str, str]]]:
+    """
+    Split Python at top-level statements, and classes over the budget
+    between their members
+
+    Returns:
+        (unit, enclosing class headers) pairs, or None if the code does not parse
+    """
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return None
+    lines = code.split("\n")
+    units: List[Tuple[str, str]] = []
+
+    def first_line(node: ast.AST) -> int:
+        decorators = getattr(node, "decorator_list", [])
+        return min([node.lineno] + [d.lineno for d in decorators]) - 1
+
+    def walk(body: List[ast.stmt], start: int, scope: str) -> int:
+        for node in body:
+            # Each unit runs from the end of the previous node, so decorators and
+            # leading comments stay with the definition they precede
+            end = node.end_lineno
+            text = "\n".join(lines[start:end])
+            members = node.body if isinstance(node, ast.ClassDef) else []
+            if len(members) > 1 and first_line(members[0]) >= node.lineno and estimate_tokens(text) > budget:
+                body_start = first_line(members[0])
+                units.append(("\n".join(lines[start:body_start]), scope))
+                header = "\n".join(lines[node.lineno - 1:body_start]).rstrip()
+                walk(members, body_start, _join_scope(scope, header))
+            else:
+                units.append((text, scope))
+            start = end
+        return start
+
+    start = walk(tree.body, 0, "")
+    if start < len(lines):
+        trailing = "\n".join(lines[start:])
+        if units:
+            units[-1] = (units[-1][0] + "\n" + trailing, units[-1][1])
+        else:
+            units.append((trailing, ""))
+    return units
+
+def _depth_change(line: str) -> int:
+    # Strings and comments can unbalance this; it only picks split points
+    return line.count("{") - line.count("}")
+
+def _is_comment(line: str) -> bool:
+    return line.strip().startswith(("//", "/*", "*", "#"))
+
+def _brace_members(lines: List[str], scope: str, budget: int, units: List[Tuple[str, str]]) -> None:
+    """
+    Add a declaration as one unit or, when it is over the budget and opens a
+    class-like body, as its header followed by its members (recursively)
+    """
+    depth, opener, close = 0, None, None
+    for i, line in enumerate(lines):
+        depth = max(0, depth + _depth_change(line))
+        if opener is None and depth > 0:
+            opener = i
+            if depth != 1:
+                break
+        elif opener is not None and depth == 0:
+            close = i
+            break
+    splittable = (
+        close is not None
+        and estimate_tokens("\n".join(lines)) > budget
+        and any(_SCOPE_START.search(line) for line in lines[:opener + 1] if not _is_comment(line))
+    )
+    if not splittable:
+        units.append(("\n".join(lines), scope))
+        return
+
+    units.append(("\n".join(lines[:opener + 1]), scope))
+    inner = _join_scope(scope, "\n".join(lines[:opener + 1]).rstrip())
+    member: List[str] = []
+    depth = 0
+    for line in lines[opener + 1:close]:
+        member.append(line)
+        depth = max(0, depth + _depth_change(line))
+        # A member ends where its block closes or its statement does
+        if depth == 0 and not _is_comment(line) and line.rstrip().endswith(("}", ";", "};")):
+            _brace_members(member, inner, budget, units)
+            member = []
+    # The closing brace (and anything after it) ends the last member
+    tail = "\n".join(member + lines[close:])
+    if member:
+        units.append((tail, inner))
+    else:
+        units[-1] = (units[-1][0] + "\n" + tail, units[-1][1])
+
+def _brace_units(code: str, budget: int) -> List[Tuple[str, str]]:
+    """
+    Split brace / indentation languages at top-level declarations, and
+    class-like declarations over the budget between their members
+    """
+    units: List[Tuple[str, str]] = []
+    current: List[str] = []
+    depth = 0
+    for line in code.split("\n"):
+        if depth == 0 and current and _UNIT_START.match(line) and not line.startswith((" ", "\t")):
+            _brace_members(current, "", budget, units)
+            current = []
+        current.append(line)
+        depth = max(0, depth + _depth_change(line))
+    if current:
+        _brace_members(current, "", budget, units)
+    return units
+
+def _split_lines(unit: str, budget: int) -> List[str]:
+    pieces: List[str] = []
+    current: List[str] = []
+    size = 0
+    for line in unit.split("\n"):
+        line_tokens = estimate_tokens(line)
+        if current and size + line_tokens > budget:
+            pieces.append("\n".join(current))
+            current, size = [], 0
+        current.append(line)
+        size += line_tokens
+    if current:
+        pieces.append("\n".join(current))
+    return pieces
+
+def split_code(code: str, language: str, budget: int = PROMPT_CODE_BUDGET) -> List[str]:
+    """
+    Split code into chunks of at most budget tokens at syntactic boundaries
+    (top-level functions / classes, and the members of classes too large
+    for one chunk), packing small units together
+
+    Args:
+        code: The full source
+        language: The programming language
+        budget: Token budget per chunk
+
+    Returns:
+        The chunks in source order; a single chunk when the code fits
+    """
+    return split_code_scoped(code, language, budget)[0]
+
+def split_code_scoped(code: str, language: str, budget: int = PROMPT_CODE_BUDGET) -> Tuple[List[str], List[str]]:
+    """
+    Like split_code, but also return each chunk's scope: the headers of the
+    classes it continues ("" for chunks that start at top level), to pass to
+    chunk_context
+
+    Returns:
+        (chunks, scopes), in source order
+    """
+    if estimate_tokens(code) <= budget:
+        return [code], [""]
+
+    units = _python_units(code, budget) if language.lower().startswith("python") else None
+    if units is None:
+        units = _brace_units(code, budget)
+
+    chunks: List[str] = []
+    scopes: List[str] = []
+    current: List[str] = []
+    size = 0
+    for unit, scope in units:
+        unit_tokens = estimate_tokens(unit)
+        if unit_tokens > budget:
+            # A single oversized unit is split on line boundaries as a last resort
+            if current:
+                chunks.append("\n".join(current))
+                current, size = [], 0
+            pieces = _split_lines(unit, budget)
+            chunks.extend(pieces)
+            scopes.extend([scope] * len(pieces))
+            continue
+        if current and size + unit_tokens > budget:
+            chunks.append("\n".join(current))
+            current, size = [], 0
+        if not current:
+            scopes.append(scope)
+        current.append(unit)
+        size += unit_tokens
+    if current:
+        chunks.append("\n".join(current))
+    return chunks, scopes
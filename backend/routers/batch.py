@@ -0,0 +1,122 @@
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field, ValidationError
+from typing import Optional, List, Dict, Any, Literal
+import asyncio
+import json
+import os
+import time
+from routers.explain import StackTraceRequest, explain_stacktrace
+from routers.optimize import OptimizationRequest, optimize_algorithm
+from routers.refactor import RefactorRequest, modernize_code
+from services.admission import admission
+
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "500"))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "16"))
+
+router = APIRouter(prefix="/batch", tags=["Batch"])
+
+# Per-client admission control; batch traffic yields upstream capacity to interactive requests
+admit = Depends(admission("batch"))
+
+# Request model and handler for each item type
+HANDLERS = {
+    "explain": (StackTraceRequest, explain_stacktrace),
+    "optimize": (OptimizationRequest, optimize_algorithm),
+    "refactor": (RefactorRequest, modernize_code),
+}
+
+class BatchItem(BaseModel):
+    id: Optional[str] = None
+    type: Literal["explain", "optimize", "refactor"]
+    payload: Dict[str, Any]
+
+class BatchRequest(BaseModel):
+    items: List[BatchItem] = Field(..., max_length=BATCH_MAX_ITEMS)
+    max_concurrency: Optional[int] = Field(None, ge=1)
+
+async def run_item(item: BatchItem) -> Dict[str, Any]:
+    """
+    Run one batch item through the same handler as its HTTP route
+
+    Returns:
+        {"status": "ok", "result": ...} or {"status": "error", "error": {...}}
+    """
+    model, handler = HANDLERS[item.type]
+    try:
+        result = await handler(model(**item.payload))
+        return {"status": "ok", "result": result.model_dump()}
+    except ValidationError as e:
+        return {"status": "error", "error": {"status_code": 422, "detail": e.errors(include_url=False)}}
+    except HTTPException as e:
+        return {"status": "error", "error": {"status_code": e.status_code, "detail": e.detail}}
+    except Exception as e:
+        return {"status": "error", "error": {"status_code": 500, "detail": str(e)}}
+
+def _dedup_key(item: BatchItem) -> str:
+    return json.dumps([item.type, item.payload], sort_keys=True)
+
+async def run_batch(items: List[BatchItem], max_concurrency: int):
+    """
+    Run batch items with at most max_concurrency in flight, running each
+    distinct payload only once
+
+    Yields:
+        One NDJSON line per item as it finishes, then a summary line
+    """
+    started = time.monotonic()
+    semaphore = asyncio.Semaphore(max_concurrency)
+    shared: Dict[str, asyncio.Task] = {}
+
+    async def limited(item: BatchItem) -> Dict[str, Any]:
+        async with semaphore:
+            return await run_item(item)
+
+    async def tracked(index: int, item: BatchItem, task: asyncio.Task, duplicate: bool):
+        outcome = await asyncio.shield(task)
+        return index, item, outcome, duplicate
+
+    waiters = []
+    for index, item in enumerate(items):
+        key = _dedup_key(item)
+        duplicate = key in shared
+        if not duplicate:
+            shared[key] = asyncio.create_task(limited(item))
+        waiters.append(tracked(index, item, shared[key], duplicate))
+
+    counts = {"ok": 0, "error": 0, "deduplicated": 0}
+    try:
+        for next_done in asyncio.as_completed(waiters):
+            index, item, outcome, duplicate = await next_done
+            counts[outcome["status"]] += 1
+            counts["deduplicated"] += duplicate
+            line = {"index": index, "id": item.id, "type": item.type, "deduplicated": duplicate, **outcome}
+            yield json.dumps(line) + "\n"
+        yield json.dumps({
+            "summary": {
+                "total": len(items),
+                **counts,
+                "elapsed_seconds": round(time.monotonic() - started, 3)
+            }
+        }) + "\n"
+    finally:
+        # Client went away or we are done: don't leave work running
+        for task in shared.values():
+            task.cancel()
+
+@router.post("", dependencies=[admit])
+async def submit_batch(request: BatchRequest):
+    """
+    Run a list of explain / optimize / refactor items concurrently.
+
+    Results are streamed back as NDJSON, one line per item in completion
+    order (use "index" or "id" to match them up), followed by a summary
+    line. A failing item reports its own error without failing the batch.
+    Identical items are only computed once.
+    """
+    max_concurrency = min(request.max_concurrency or BATCH_MAX_CONCURRENCY, BATCH_MAX_CONCURRENCY)
+    return StreamingResponse(
+        run_batch(request.items, max_concurrency),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
@@ -1,11 +1,21 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Query
 from pydantic import BaseModel
 from typing import Optional, List
-from services.ai_service import ai_service
+from services.ai_service import ai_service, ProviderOverloadedError
+from services.deadline import DeadlineExceeded
+from services.admission import admission, retry_after_headers
+from services.streaming import prime_stream, stream_structured, event_stream_response, single_result
+from services.stacktrace import preprocess_stacktrace, fingerprint_index
+from services.similarity import similarity_index, namespace, reference_note, SIMILARITY_REUSE_THRESHOLD
+from services.structured_output import parse_structured, make_reask, parse_stats
+from services.metrics import span
 from prompt_builder import build_stacktrace_prompt
 
 router = APIRouter(prefix="/explain", tags=["StackTraceGPT"])
 
+# Per-client admission control for the routes that call the model
+admit = Depends(admission("interactive"))
+
 class StackTraceRequest(BaseModel):
     stack_trace: str
     language: Optional[str] = None
@@ -18,47 +28,148 @@ class ExplanationResponse(BaseModel):
     references: Optional[List[str]] = None
     provider_used: str
 
-@router.post("/stacktrace", response_model=ExplanationResponse)
+async def parse_explanation(content: str, provider: str, prompt: Optional[str] = None) -> ExplanationResponse:
+    """
+    Parse the model output into an ExplanationResponse, repairing it and
+    asking only for missing fields when the prompt is given
+    """
+    return await parse_structured(
+        content,
+        ExplanationResponse,
+        provider,
+        extra={"provider_used": provider},
+        reask=make_reask(prompt, provider) if prompt else None,
+        text_field="explanation"
+    )
+
+def _similarity_space(request: StackTraceRequest) -> str:
+    return namespace("explain", {"language": request.language, "framework": request.framework})
+
+@router.post("/stacktrace", response_model=ExplanationResponse, dependencies=[admit])
 async def explain_stacktrace(request: StackTraceRequest):
     """
     Analyze a stack trace and provide an explanation with possible fixes
     """
+    # Compact the trace and serve known fingerprints without an upstream call
+    with span("prompt"):
+        stack_trace, fingerprint = preprocess_stacktrace(request.stack_trace, request.language, request.framework)
+    if fingerprint:
+        known = await fingerprint_index.get(fingerprint)
+        if known is not None:
+            return ExplanationResponse(**known)
+
+    # Near-duplicate traces reuse the earlier answer or start from it
+    space = _similarity_space(request)
+    with span("similarity"):
+        similar = await similarity_index.lookup(space, stack_trace, "trace")
+    if similar is not None and similar.similarity >= SIMILARITY_REUSE_THRESHOLD:
+        return ExplanationResponse(**similar.answer)
+
     # Build prompt for OpenAI
-    prompt = build_stacktrace_prompt(request.stack_trace, request.language, request.framework)
+    with span("prompt"):
+        prompt = build_stacktrace_prompt(
+            stack_trace,
+            request.language,
+            request.framework,
+            reference=reference_note(similar) if similar else None
+        )
     
     try:
         # Get response from AI service
-        response = await ai_service.generate_response(
+        with span("upstream"):
+            response = await ai_service.generate_response(
+                prompt=prompt,
+                preferred_provider=request.preferred_provider,
+                max_tokens=1000,
+                temperature=0.7,
+                json_mode=True
+            )
+        
+        with span("parse"):
+            result = await parse_explanation(response["content"], response["provider"], prompt)
+        # Only index complete answers
+        if result.possible_fixes:
+            if fingerprint:
+                await fingerprint_index.set(fingerprint, result.model_dump())
+            await similarity_index.add(space, stack_trace, result.model_dump(), "trace")
+        return result
+    except ProviderOverloadedError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e), headers=retry_after_headers(e))
+    except DeadlineExceeded as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to analyze stack trace: {str(e)}")
+
+@router.post("/stacktrace/stream", dependencies=[admit])
+async def explain_stacktrace_stream(
+    request: StackTraceRequest,
+    stream_format: str = Query("sse", alias="format", pattern="^(sse|ndjson)$")
+):
+    """
+    Stream the stack trace analysis as it is generated (SSE or NDJSON).
+    Emits "token" events for raw deltas, a "field" event as each JSON field
+    completes and a final "result" event matching ExplanationResponse.
+    """
+    stack_trace, fingerprint = preprocess_stacktrace(request.stack_trace, request.language, request.framework)
+    if fingerprint:
+        known = await fingerprint_index.get(fingerprint)
+        if known is not None:
+            return event_stream_response(single_result(ExplanationResponse(**known), stream_format), stream_format)
+
+    space = _similarity_space(request)
+    similar = await similarity_index.lookup(space, stack_trace, "trace")
+    if similar is not None and similar.similarity >= SIMILARITY_REUSE_THRESHOLD:
+        return event_stream_response(single_result(ExplanationResponse(**similar.answer), stream_format), stream_format)
+
+    prompt = build_stacktrace_prompt(
+        stack_trace,
+        request.language,
+        request.framework,
+        reference=reference_note(similar) if similar else None
+    )
+
+    try:
+        chunks = await prime_stream(ai_service.stream_response(
             prompt=prompt,
+            preferred_provider=request.preferred_provider,
             max_tokens=1000,
-            temperature=0.7
-        )
-        
-        # Parse the response based on the provider used
-        if response["provider"] == "openai":
-            content = response["response"].choices[0].message.content
-        else:
-            content = response["response"].text
-
-        # Parse the response into structured format
-        # This is a simple example - you might want to make this more sophisticated
-        parts = content.split("\n\n")
-        explanation = parts[0] if parts else "No explanation provided"
-        fixes = [fix.strip() for fix in parts[1].split("\n")] if len(parts) > 1 else []
-        references = [ref.strip() for ref in parts[2].split("\n")] if len(parts) > 2 else []
-
-        return ExplanationResponse(
-            explanation=explanation,
-            possible_fixes=fixes,
-            references=references,
-            provider_used=response["provider"]
-        )
+            temperature=0.7,
+            json_mode=True
+        ))
+    except ProviderOverloadedError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e), headers=retry_after_headers(e))
+    except DeadlineExceeded as e:
+        raise HTTPException(status_code=504, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to analyze stack trace: {str(e)}")
 
+    async def remember(result: ExplanationResponse) -> None:
+        if result.possible_fixes:
+            if fingerprint:
+                await fingerprint_index.set(fingerprint, result.model_dump())
+            await similarity_index.add(space, stack_trace, result.model_dump(), "trace")
+
+    return event_stream_response(
+        stream_structured(
+            chunks,
+            lambda content, provider: parse_explanation(content, provider, prompt),
+            stream_format,
+            on_result=remember
+        ),
+        stream_format
+    )
+
 @router.get("/providers")
 async def get_available_providers():
     """
     Get list of available AI providers
     """
-    return {"providers": ai_service.get_available_providers()} 
\ No newline at end of file
+    return {"providers": ai_service.get_available_providers()}
+
+@router.get("/providers/health")
+async def get_provider_health():
+    """
+    Get rolling p50/p95 latency, error rate and circuit breaker state per
+    provider, plus structured output parse / repair rates
+    """
+    return {"providers": ai_service.get_provider_health(), "parsing": parse_stats()}
\ No newline at end of file
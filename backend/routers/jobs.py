@@ -0,0 +1,161 @@
+from fastapi import APIRouter, Depends, HTTPException, Header, Query, Request, Response
+from pydantic import BaseModel, Field, ValidationError
+from typing import Optional, Dict, Any, Literal
+import asyncio
+from routers.batch import HANDLERS
+from services.admission import admission, client_id, bind_client
+from services.jobs import (
+    job_store,
+    register_job_handler,
+    public_job,
+    can_access,
+    check_webhook_url,
+    JobConflictError,
+    WebhookURLError,
+    PermanentJobError,
+    TERMINAL_STATUSES
+)
+from services.streaming import format_event, event_stream_response
+
+router = APIRouter(prefix="/jobs", tags=["Jobs"])
+
+# Per-client admission control; batch traffic yields upstream capacity to interactive requests
+admit = Depends(admission("batch"))
+
+class JobRequest(BaseModel):
+    type: Literal["explain", "optimize", "refactor"]
+    payload: Dict[str, Any]
+    webhook_url: Optional[str] = Field(None, pattern=r"^https?://")
+    idempotency_key: Optional[str] = Field(None, max_length=255)
+
+def _job_handler(job_type: str):
+    """
+    Run a job through the same handler as its HTTP route, splitting
+    failures into permanent (4xx, invalid payload) and retryable ones
+    """
+    model, handler = HANDLERS[job_type]
+
+    async def run(payload: Dict[str, Any], job: Dict[str, Any]) -> Dict[str, Any]:
+        bind_client(job["client"])
+        try:
+            request = model(**payload)
+        except ValidationError as e:
+            raise PermanentJobError(str(e))
+        try:
+            result = await handler(request)
+        except HTTPException as e:
+            if e.status_code < 500:
+                raise PermanentJobError(str(e.detail))
+            raise Exception(str(e.detail))
+        return result.model_dump()
+
+    return run
+
+for _job_type in HANDLERS:
+    register_job_handler(_job_type, _job_handler(_job_type))
+
+async def _client_job(job_id: str, request: Request) -> Dict[str, Any]:
+    """
+    The job, if the caller holds its access token or submitted it with an
+    API key or user id; other jobs are reported as missing so their ids
+    cannot be probed
+    """
+    job = await job_store.get(job_id)
+    if job is None or not can_access(job, request):
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@router.post("", status_code=202, dependencies=[admit])
+async def submit_job(
+    job: JobRequest,
+    request: Request,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key", max_length=255)
+):
+    """
+    Queue an explain / optimize / refactor request and return its job id
+    immediately. Poll GET /jobs/{id}, subscribe to GET /jobs/{id}/events
+    or pass a webhook_url to be notified when it finishes.
+
+    Resubmitting with the same Idempotency-Key returns the original job.
+    The webhook_url must resolve to public addresses only. The response's
+    access_token must be sent as X-Job-Token (or ?token=) to read or
+    cancel the job.
+    """
+    model, _ = HANDLERS[job.type]
+    try:
+        model(**job.payload)
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors(include_url=False))
+    if job.webhook_url:
+        try:
+            await asyncio.to_thread(check_webhook_url, job.webhook_url)
+        except WebhookURLError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+
+    try:
+        record, created = await job_store.create(
+            job.type,
+            job.payload,
+            idempotency_key=idempotency_key or job.idempotency_key,
+            webhook_url=job.webhook_url,
+            client=client_id(request)
+        )
+    except JobConflictError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+    if not created:
+        response.status_code = 200
+    response.headers["Location"] = f"/jobs/{record['id']}"
+    return {**public_job(record), "access_token": record["access_token"]}
+
+@router.get("/{job_id}")
+async def get_job(job_id: str, request: Request):
+    """
+    Get a job's status, progress and, once finished, its result or error
+    """
+    return public_job(await _client_job(job_id, request))
+
+@router.delete("/{job_id}")
+async def cancel_job(job_id: str, request: Request):
+    """
+    Cancel a queued or running job
+    """
+    await _client_job(job_id, request)
+    if not await job_store.cancel(job_id):
+        job = await job_store.get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="Job not found")
+        raise HTTPException(status_code=409, detail=f"Job already {job['status']}")
+    return public_job(await job_store.get(job_id))
+
+@router.get("/{job_id}/events")
+async def job_events(
+    job_id: str,
+    request: Request,
+    stream_format: str = Query("sse", alias="format", pattern="^(sse|ndjson)$")
+):
+    """
+    Stream a job's status changes. Emits a `status` event whenever the job
+    changes and a final `result` event with the finished job.
+    """
+    job = await _client_job(job_id, request)
+
+    async def events():
+        current = job
+        last = None
+        while True:
+            seen = (current["status"], current["updated_at"])
+            if current["status"] in TERMINAL_STATUSES:
+                yield format_event("result", public_job(current), stream_format)
+                return
+            if seen != last:
+                yield format_event("status", public_job(current), stream_format)
+                last = seen
+            await job_store.wait_for_change(job_id)
+            current = await job_store.get(job_id)
+            if current is None:
+                yield format_event("error", {"detail": "Job not found"}, stream_format)
+                return
+
+    return event_stream_response(events(), stream_format)
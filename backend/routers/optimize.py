@@ -1,17 +1,46 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Query
 from pydantic import BaseModel
-from typing import Optional
-from services.ai_service import ai_service
-from prompt_builder import build_optimizer_prompt
+from typing import Optional, Tuple, List
+from services.ai_service import ai_service, ProviderOverloadedError
+from services.deadline import DeadlineExceeded
+from services.admission import admission, retry_after_headers
+from services.map_reduce import map_chunks, gather_chunks, merge_values, merge_lists
+from services.structured_output import parse_structured, make_reask
+from services.metrics import span
+from services.complexity import verify_optimization
+from services.similarity import similarity_index, namespace, reference_note
+from services.sessions import session_store, resolve_code, answer_round, make_patch, Exchange, PatchError, SessionConflictError
+from services.streaming import prime_stream, stream_structured, stream_chunked, single_result, event_stream_response
+from prompt_builder import build_optimizer_prompt, split_code, split_code_scoped, extract_context, chunk_context, output_token_budget
 
 router = APIRouter(prefix="/optimize", tags=["DSA Optimizer"])
 
+# Per-client admission control for the routes that call the model
+admit = Depends(admission("interactive"))
+
 class OptimizationRequest(BaseModel):
     code: str
     language: str
     algorithm_type: Optional[str] = None  # sorting, searching, graph, etc.
     expected_complexity: Optional[str] = None  # O(n), O(log n), etc.
     include_explanation: Optional[bool] = True
+    verify: Optional[bool] = False  # benchmark both versions in a sandbox (Python only)
+
+class ComplexityVerification(BaseModel):
+    verified: bool
+    entry_point: Optional[str] = None
+    sizes: List[int] = []
+    timings_before: List[Optional[float]] = []
+    timings_after: List[Optional[float]] = []
+    measured_complexity_before: Optional[str] = None
+    measured_complexity_after: Optional[str] = None
+    exponent_before: Optional[float] = None
+    exponent_after: Optional[float] = None
+    speedup: Optional[float] = None
+    speedup_at: Optional[int] = None
+    outputs_match: Optional[bool] = None
+    notes: List[str] = []
+    elapsed_seconds: Optional[float] = None
 
 class OptimizationResponse(BaseModel):
     optimized_code: str
@@ -21,59 +50,308 @@ class OptimizationResponse(BaseModel):
     space_complexity_after: str
     explanation: Optional[str] = None
     optimization_techniques: list[str]
+    verification: Optional[ComplexityVerification] = None
 
-@router.post("/dsa", response_model=OptimizationResponse)
-async def optimize_algorithm(request: OptimizationRequest):
+class OptimizationSessionResponse(OptimizationResponse):
+    session_id: str
+    version: str  # version of the submitted code, sent back as base_version
+
+class OptimizationRoundRequest(BaseModel):
+    diff: Optional[str] = None  # unified diff against the code last submitted to the session
+    code: Optional[str] = None  # or the complete code, to resync
+    base_version: Optional[str] = None
+
+class OptimizationRoundResponse(BaseModel):
+    session_id: str
+    version: str
+    patch: str  # unified diff against the optimized_code received last
+    time_complexity_before: str
+    time_complexity_after: str
+    space_complexity_before: str
+    space_complexity_after: str
+    explanation: Optional[str] = None
+    optimization_techniques: list[str]
+    verification: Optional[ComplexityVerification] = None
+
+async def parse_optimization(content: str, provider: str, prompt: Optional[str] = None) -> OptimizationResponse:
     """
-    Optimize an algorithm for better time/space complexity
+    Parse the model output into an OptimizationResponse, repairing it and
+    asking only for missing fields when the prompt is given
     """
-    # Build prompt for OpenAI
-    prompt = build_optimizer_prompt(
-        request.code,
+    return await parse_structured(
+        content,
+        OptimizationResponse,
+        provider,
+        reask=make_reask(prompt, provider) if prompt else None,
+        text_field="explanation",
+        code_field="optimized_code"
+    )
+
+def merge_optimizations(results: list[OptimizationResponse]) -> OptimizationResponse:
+    """
+    Combine per-chunk optimizations of a large file into one response
+    """
+    explanations = [r.explanation for r in results if r.explanation]
+    return OptimizationResponse(
+        optimized_code="\n".join(r.optimized_code for r in results),
+        time_complexity_before=merge_values([r.time_complexity_before for r in results]),
+        time_complexity_after=merge_values([r.time_complexity_after for r in results]),
+        space_complexity_before=merge_values([r.space_complexity_before for r in results]),
+        space_complexity_after=merge_values([r.space_complexity_after for r in results]),
+        explanation="\n\n".join(explanations) if explanations else None,
+        optimization_techniques=merge_lists([r.optimization_techniques for r in results])
+    )
+
+def _build_prompt(
+    request: OptimizationRequest,
+    code: str,
+    part: Optional[Tuple[int, int]] = None,
+    context: Optional[str] = None,
+    reference: Optional[str] = None
+) -> str:
+    return build_optimizer_prompt(
+        code,
         request.language,
         request.algorithm_type,
         request.expected_complexity,
-        request.include_explanation
+        request.include_explanation,
+        part=part,
+        context=context,
+        reference=reference
     )
-    
-    try:
-        # Get response from AI service
+
+async def _optimize_chunk(
+    request: OptimizationRequest,
+    code: str,
+    part: Optional[Tuple[int, int]] = None,
+    context: Optional[str] = None,
+    reference: Optional[str] = None
+) -> OptimizationResponse:
+    with span("prompt"):
+        prompt = _build_prompt(request, code, part, context, reference)
+    # Get response from AI service
+    with span("upstream"):
         response = await ai_service.generate_response(
             prompt=prompt,
-            max_tokens=1000,
-            temperature=0.7
+            max_tokens=output_token_budget(code),
+            temperature=0.7,
+            json_mode=True
         )
-        
-        # Parse the response based on the provider used
-        if response["provider"] == "openai":
-            content = response["response"].choices[0].message.content
+    with span("parse"):
+        return await parse_optimization(response["content"], response["provider"], prompt)
+
+def _chunk_handler(request: OptimizationRequest, scopes: list[str]):
+    context = extract_context(request.code)
+
+    async def handle(index: int, chunk: str) -> OptimizationResponse:
+        # The first chunk already contains the file header; chunks inside a
+        # split class also get its header
+        scoped = chunk_context(context if index else None, scopes[index])
+        return await _optimize_chunk(request, chunk, (index, len(scopes)), scoped)
+
+    return handle
+
+async def _verify(request: OptimizationRequest, result: OptimizationResponse) -> OptimizationResponse:
+    """
+    Attach measured complexity, speedup and output equality to the model's
+    claims when the caller asked for verification
+    """
+    if request.verify:
+        with span("verify"):
+            report = await verify_optimization(request.code, result.optimized_code, request.language)
+        measured = report.get("measured_complexity_after")
+        if measured and measured.replace(" ", "").lower() != result.time_complexity_after.replace(" ", "").lower():
+            report["notes"].append(f"Measured {measured} differs from the claimed {result.time_complexity_after}")
+        result.verification = ComplexityVerification(**report)
+    return result
+
+def _similarity_space(request: OptimizationRequest) -> str:
+    return namespace("optimize", request.model_dump(exclude={"code"}))
+
+@router.post("/dsa", response_model=OptimizationResponse, dependencies=[admit])
+async def optimize_algorithm(request: OptimizationRequest):
+    """
+    Optimize an algorithm for better time/space complexity.
+    Inputs over the prompt budget are split at function/class boundaries,
+    optimized concurrently and merged.
+    With verify set, both versions are benchmarked on growing inputs in a
+    sandboxed subprocess pool and the measured growth is returned alongside.
+    Code that only differs from an earlier submission in naming reuses its
+    answer; similar code gets the earlier answer as a reference.
+    """
+    space = _similarity_space(request)
+    with span("similarity"):
+        similar = await similarity_index.lookup(space, request.code, language=request.language)
+    if similar is not None and similar.exact:
+        return OptimizationResponse(**similar.answer)
+
+    try:
+        chunks, scopes = split_code_scoped(request.code, request.language)
+        if len(chunks) == 1:
+            reference = reference_note(similar) if similar else None
+            result = await _verify(request, await _optimize_chunk(request, request.code, reference=reference))
         else:
-            content = response["response"].text
-
-        # Parse the JSON response
-        import json
-        try:
-            result = json.loads(content)
-            return OptimizationResponse(
-                optimized_code=result["optimized_code"],
-                time_complexity_before=result["time_complexity_before"],
-                time_complexity_after=result["time_complexity_after"],
-                space_complexity_before=result["space_complexity_before"],
-                space_complexity_after=result["space_complexity_after"],
-                explanation=result.get("explanation"),
-                optimization_techniques=result["optimization_techniques"]
-            )
-        except json.JSONDecodeError:
-            # If the response is not valid JSON, try to parse it as text
-            lines = content.split("\n")
-            return OptimizationResponse(
-                optimized_code=lines[0] if lines else "",
-                time_complexity_before="O(n)",
-                time_complexity_after="O(n)",
-                space_complexity_before="O(1)",
-                space_complexity_after="O(1)",
-                explanation=content,
-                optimization_techniques=["General optimization"]
-            )
+            results = await gather_chunks(chunks, _chunk_handler(request, scopes))
+            result = await _verify(request, merge_optimizations(results))
+        await similarity_index.add(space, request.code, result.model_dump(), language=request.language)
+        return result
+    except ProviderOverloadedError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e), headers=retry_after_headers(e))
+    except DeadlineExceeded as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to optimize algorithm: {str(e)}")
+
+@router.post("/dsa/stream", dependencies=[admit])
+async def optimize_algorithm_stream(
+    request: OptimizationRequest,
+    stream_format: str = Query("sse", alias="format", pattern="^(sse|ndjson)$")
+):
+    """
+    Stream the optimization as it is generated (SSE or NDJSON).
+    Emits "token", "field" and a final "result" event matching OptimizationResponse.
+    Large inputs are processed in chunks and emit one "chunk" event per part instead.
+    """
+    space = _similarity_space(request)
+    similar = await similarity_index.lookup(space, request.code, language=request.language)
+    if similar is not None and similar.exact:
+        return event_stream_response(single_result(OptimizationResponse(**similar.answer), stream_format), stream_format)
+
+    chunks, scopes = split_code_scoped(request.code, request.language)
+    if len(chunks) > 1:
+        results = map_chunks(chunks, _chunk_handler(request, scopes))
+        return event_stream_response(
+            stream_chunked(results, len(chunks), merge_optimizations, stream_format),
+            stream_format
+        )
+
+    async def parse_and_verify(content: str, provider: str) -> OptimizationResponse:
+        return await _verify(request, await parse_optimization(content, provider, prompt))
+
+    async def remember(result: OptimizationResponse) -> None:
+        await similarity_index.add(space, request.code, result.model_dump(), language=request.language)
+
+    prompt = _build_prompt(request, request.code, reference=reference_note(similar) if similar else None)
+    try:
+        deltas = await prime_stream(ai_service.stream_response(
+            prompt=prompt,
+            max_tokens=output_token_budget(request.code),
+            temperature=0.7,
+            json_mode=True
+        ))
+    except ProviderOverloadedError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e), headers=retry_after_headers(e))
+    except DeadlineExceeded as e:
+        raise HTTPException(status_code=504, detail=str(e))
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to optimize algorithm: {str(e)}") 
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Failed to optimize algorithm: {str(e)}")
+
+    return event_stream_response(
+        stream_structured(
+            deltas,
+            parse_and_verify,
+            stream_format,
+            on_result=remember
+        ),
+        stream_format
+    )
+
+async def _session_base(request: OptimizationRequest) -> Tuple[OptimizationResponse, Optional[Exchange]]:
+    """
+    Answer the round a session's prompt prefix is built from. Code that
+    fits one prompt goes to the model as submitted, without a similarity
+    reference, so that follow-up rounds replay exactly this prompt and
+    answer; larger code is answered like /optimize/dsa and has no prefix
+    to replay.
+    """
+    if len(split_code(request.code, request.language)) > 1:
+        return await optimize_algorithm(request), None
+    with span("prompt"):
+        prompt = _build_prompt(request, request.code)
+    with span("upstream"):
+        response = await ai_service.generate_response(
+            prompt=prompt,
+            max_tokens=output_token_budget(request.code),
+            temperature=0.7,
+            json_mode=True
+        )
+    with span("parse"):
+        result = await parse_optimization(response["content"], response["provider"], prompt)
+    exchange = {"prompt": prompt, "answer": response["content"], "output": result.optimized_code}
+    return await _verify(request, result), exchange
+
+@router.post("/sessions", response_model=OptimizationSessionResponse, dependencies=[admit])
+async def start_optimization_session(request: OptimizationRequest):
+    """
+    Optimize code like /optimize/dsa and keep the code and result on the
+    server, so follow-up rounds only need to send a diff.
+    Code that fits one prompt is sent to the model as submitted, so that
+    follow-up rounds can replay that exact exchange as a cached prefix.
+    """
+    try:
+        result, exchange = await _session_base(request)
+    except HTTPException:
+        raise
+    except ProviderOverloadedError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e), headers=retry_after_headers(e))
+    except DeadlineExceeded as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to optimize algorithm: {str(e)}")
+    session = await session_store.create(
+        "optimize", request.model_dump(exclude={"code"}), request.code, result.model_dump(), exchange
+    )
+    return OptimizationSessionResponse(**result.model_dump(), session_id=session["id"], version=session["version"])
+
+@router.post("/sessions/{session_id}", response_model=OptimizationRoundResponse, dependencies=[admit])
+async def optimization_session_round(session_id: str, submission: OptimizationRoundRequest):
+    """
+    Optimize the next version of a session's code, uploaded as a diff
+    against the previous one. The model gets the first round as a cached
+    prompt prefix plus the change, and the response is a unified diff
+    against the optimized code the client already has.
+    """
+    session = await session_store.get(session_id, "optimize")
+    if session is None:
+        raise HTTPException(status_code=404, detail="Session not found or expired")
+    try:
+        code = resolve_code(session, submission.diff, submission.code, submission.base_version)
+    except SessionConflictError as e:
+        raise HTTPException(status_code=409, detail={"message": str(e), "version": e.version})
+    except PatchError as e:
+        raise HTTPException(status_code=422, detail=f"Diff does not apply: {str(e)}")
+
+    request = OptimizationRequest(code=code, **session["params"])
+
+    async def full(code: str) -> Tuple[OptimizationResponse, Optional[Exchange]]:
+        return await _session_base(request.model_copy(update={"code": code}))
+
+    try:
+        result, rebased, exchange = await answer_round(session, code, "optimized_code", parse_optimization, full)
+        if not rebased and code != session["code"]:
+            # Full runs verify on their own
+            result = (await _verify(request, OptimizationResponse(**result))).model_dump()
+        updated = await session_store.advance(session, code, result, rebased, exchange)
+    except SessionConflictError as e:
+        raise HTTPException(status_code=409, detail={"message": str(e), "version": e.version})
+    except HTTPException:
+        raise
+    except ProviderOverloadedError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e), headers=retry_after_headers(e))
+    except DeadlineExceeded as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to optimize algorithm: {str(e)}")
+
+    return OptimizationRoundResponse(
+        **{k: v for k, v in result.items() if k != "optimized_code"},
+        session_id=session_id,
+        version=updated["version"],
+        patch=make_patch(session["result"]["optimized_code"], result["optimized_code"])
+    )
+
+@router.delete("/sessions/{session_id}")
+async def end_optimization_session(session_id: str):
+    if not await session_store.delete(session_id, "optimize"):
+        raise HTTPException(status_code=404, detail="Session not found or expired")
+    return {"deleted": True}
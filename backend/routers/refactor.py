@@ -1,11 +1,25 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Query
 from pydantic import BaseModel
-from typing import Optional
-from services.openai_service import get_openai_client
-from prompt_builder import build_refactor_prompt
+from typing import Optional, Dict, Tuple
+import re
+from services.ai_service import ai_service, ProviderOverloadedError
+from services.deadline import DeadlineExceeded
+from services.admission import admission, retry_after_headers
+from services.map_reduce import map_chunks, gather_chunks, merge_lists
+from services.structured_output import parse_structured, make_reask
+from services import metrics
+from services.metrics import span
+from services.rewrite import rewrite_code, RewriteResult
+from services.similarity import similarity_index, namespace, reference_note
+from services.sessions import session_store, resolve_code, answer_round, make_patch, Exchange, PatchError, SessionConflictError
+from services.streaming import prime_stream, stream_structured, stream_chunked, single_result, event_stream_response
+from prompt_builder import build_refactor_prompt, split_code, split_code_scoped, extract_context, chunk_context, output_token_budget
 
 router = APIRouter(prefix="/refactor", tags=["RefactorTool"])
 
+# Per-client admission control for the routes that call the model
+admit = Depends(admission("interactive"))
+
 class RefactorRequest(BaseModel):
     code: str
     source_language: str
@@ -13,34 +27,375 @@ class RefactorRequest(BaseModel):
     target_version: str
     preserve_comments: Optional[bool] = True
     modernization_level: Optional[str] = "moderate"  # conservative, moderate, aggressive
+    api_renames: Optional[Dict[str, str]] = None  # APIs renamed in other files: qualified old name -> new name
 
 class RefactorResponse(BaseModel):
     refactored_code: str
     changes_made: list[str]
     migration_notes: Optional[str] = None
 
-@router.post("/modernize", response_model=RefactorResponse)
-async def modernize_code(request: RefactorRequest, openai_client=Depends(get_openai_client)):
+class RefactorSessionResponse(RefactorResponse):
+    session_id: str
+    version: str  # version of the submitted code, sent back as base_version
+
+class RefactorRoundRequest(BaseModel):
+    diff: Optional[str] = None  # unified diff against the code last submitted to the session
+    code: Optional[str] = None  # or the complete code, to resync
+    base_version: Optional[str] = None
+
+class RefactorRoundResponse(BaseModel):
+    session_id: str
+    version: str
+    patch: str  # unified diff against the refactored_code received last
+    changes_made: list[str]
+    migration_notes: Optional[str] = None
+
+async def parse_refactor(content: str, provider: str, prompt: Optional[str] = None) -> RefactorResponse:
+    """
+    Parse the model output into a RefactorResponse, repairing it and
+    asking only for missing fields when the prompt is given
+    """
+    return await parse_structured(
+        content,
+        RefactorResponse,
+        provider,
+        reask=make_reask(prompt, provider) if prompt else None,
+        text_field="migration_notes",
+        code_field="refactored_code"
+    )
+
+def merge_refactors(results: list[RefactorResponse]) -> RefactorResponse:
     """
-    Modernize legacy code to use newer language features and conventions
+    Combine per-chunk refactors of a large file into one response
     """
-    # Build prompt for OpenAI
-    prompt = build_refactor_prompt(
-        request.code, 
+    notes = list(dict.fromkeys(r.migration_notes for r in results if r.migration_notes))
+    return RefactorResponse(
+        refactored_code="\n".join(r.refactored_code for r in results),
+        changes_made=merge_lists([r.changes_made for r in results]),
+        migration_notes="\n\n".join(notes) if notes else None
+    )
+
+def _build_prompt(
+    request: RefactorRequest,
+    code: str,
+    part: Optional[Tuple[int, int]] = None,
+    context: Optional[str] = None,
+    reference: Optional[str] = None
+) -> str:
+    return build_refactor_prompt(
+        code,
         request.source_language,
         request.source_version,
         request.target_version,
         request.preserve_comments,
-        request.modernization_level
+        request.modernization_level,
+        part=part,
+        context=context,
+        reference=reference,
+        api_renames=request.api_renames
     )
-    
+
+async def _refactor_chunk(
+    request: RefactorRequest,
+    code: str,
+    part: Optional[Tuple[int, int]] = None,
+    context: Optional[str] = None,
+    reference: Optional[str] = None
+) -> RefactorResponse:
+    with span("prompt"):
+        prompt = _build_prompt(request, code, part, context, reference)
+    # Get response from AI service
+    with span("upstream"):
+        response = await ai_service.generate_response(
+            prompt=prompt,
+            max_tokens=output_token_budget(code),
+            temperature=0.7,
+            json_mode=True
+        )
+    with span("parse"):
+        return await parse_refactor(response["content"], response["provider"], prompt)
+
+def _chunk_handler(request: RefactorRequest, scopes: list[str]):
+    context = extract_context(request.code)
+
+    async def handle(index: int, chunk: str) -> RefactorResponse:
+        # The first chunk already contains the file header; chunks inside a
+        # split class also get its header
+        scoped = chunk_context(context if index else None, scopes[index])
+        return await _refactor_chunk(request, chunk, (index, len(scopes)), scoped)
+
+    return handle
+
+def _mentions_renamed_api(code: str, api_renames: Optional[Dict[str, str]]) -> bool:
+    names = {old.rsplit(".", 1)[-1] for old in api_renames or {}}
+    return bool(names) and re.search(r"\b(?:%s)\b" % "|".join(map(re.escape, names)), code) is not None
+
+def _rewrite(request: RefactorRequest) -> Tuple[RefactorRequest, RewriteResult]:
+    """
+    Apply the mechanical modernizations locally; the returned request
+    carries the rewritten code for whatever is left to the model
+    """
+    with span("rewrite"):
+        rewrite = rewrite_code(
+            request.code,
+            request.source_language,
+            request.source_version,
+            request.target_version,
+            request.preserve_comments,
+            request.modernization_level
+        )
+    if _mentions_renamed_api(rewrite.code, request.api_renames):
+        # Renamed references need the model even when the rules covered the rest
+        rewrite.residual = [(1, rewrite.code.count("\n") + 1)]
+    if not rewrite.residual:
+        outcome = "local"
+    elif rewrite.whole_file:
+        outcome = "model"
+    else:
+        outcome = "partial"
+    metrics.rewrite_outcomes.inc(outcome=outcome)
+    return request.model_copy(update={"code": rewrite.code}), rewrite
+
+def _segments(rewrite: RewriteResult) -> list[str]:
+    lines = rewrite.code.split("\n")
+    return ["\n".join(lines[start - 1:end]) for start, end in rewrite.residual]
+
+def _segment_handler(request: RefactorRequest, total: int):
+    context = extract_context(request.code)
+
+    async def handle(index: int, segment: str) -> RefactorResponse:
+        return await _refactor_chunk(request, segment, (index, total), context)
+
+    return handle
+
+def _with_local_changes(rewrite: RewriteResult, result: RefactorResponse) -> RefactorResponse:
+    result.changes_made = rewrite.changes + result.changes_made
+    return result
+
+def _splice(rewrite: RewriteResult, results: list[RefactorResponse]) -> RefactorResponse:
+    """
+    Put the model's rewrite of each residual segment back into the locally
+    rewritten file
+    """
+    lines = rewrite.code.split("\n")
+    for (start, end), result in reversed(list(zip(rewrite.residual, results))):
+        lines[start - 1:end] = result.refactored_code.rstrip("\n").split("\n")
+    merged = merge_refactors(results)
+    merged.refactored_code = "\n".join(lines)
+    return _with_local_changes(rewrite, merged)
+
+def _similarity_space(request: RefactorRequest) -> str:
+    return namespace("refactor", request.model_dump(exclude={"code"}))
+
+@router.post("/modernize", response_model=RefactorResponse, dependencies=[admit])
+async def modernize_code(request: RefactorRequest):
+    """
+    Modernize legacy code to use newer language features and conventions.
+    Mechanical rewrites (f-strings, builtin generics, lambdas, ...) are done
+    locally; only the top-level definitions still holding legacy constructs
+    go to the model, and nothing does when the rules covered everything.
+    Inputs over the prompt budget are split at function/class boundaries,
+    refactored concurrently and merged.
+    Code that only differs from an earlier submission in naming reuses its
+    answer; similar code gets the earlier answer as a reference.
+    """
+    space = _similarity_space(request)
+    original = request.code
+    with span("similarity"):
+        similar = await similarity_index.lookup(space, original, language=request.source_language)
+    if similar is not None and similar.exact:
+        return RefactorResponse(**similar.answer)
+
+    try:
+        request, rewrite = _rewrite(request)
+        if not rewrite.residual:
+            return RefactorResponse(refactored_code=rewrite.code, changes_made=rewrite.changes)
+
+        if not rewrite.whole_file:
+            segments = _segments(rewrite)
+            results = await gather_chunks(segments, _segment_handler(request, len(segments)))
+            result = _splice(rewrite, results)
+        else:
+            chunks, scopes = split_code_scoped(request.code, request.source_language)
+            if len(chunks) == 1:
+                reference = reference_note(similar) if similar else None
+                result = _with_local_changes(rewrite, await _refactor_chunk(request, request.code, reference=reference))
+            else:
+                results = await gather_chunks(chunks, _chunk_handler(request, scopes))
+                result = _with_local_changes(rewrite, merge_refactors(results))
+        await similarity_index.add(space, original, result.model_dump(), language=request.source_language)
+        return result
+    except ProviderOverloadedError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e), headers=retry_after_headers(e))
+    except DeadlineExceeded as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to refactor code: {str(e)}")
+
+@router.post("/modernize/stream", dependencies=[admit])
+async def modernize_code_stream(
+    request: RefactorRequest,
+    stream_format: str = Query("sse", alias="format", pattern="^(sse|ndjson)$")
+):
+    """
+    Stream the modernized code as it is generated (SSE or NDJSON).
+    Emits "token", "field" and a final "result" event matching RefactorResponse.
+    Large inputs are processed in chunks and emit one "chunk" event per part instead.
+    Code fully handled by the local rewrite engine gets a single "result" event;
+    when only some definitions need the model, each emits a "chunk" event.
+    """
+    space = _similarity_space(request)
+    original = request.code
+    similar = await similarity_index.lookup(space, original, language=request.source_language)
+    if similar is not None and similar.exact:
+        return event_stream_response(single_result(RefactorResponse(**similar.answer), stream_format), stream_format)
+
+    request, rewrite = _rewrite(request)
+    if not rewrite.residual:
+        result = RefactorResponse(refactored_code=rewrite.code, changes_made=rewrite.changes)
+        return event_stream_response(single_result(result, stream_format), stream_format)
+
+    if not rewrite.whole_file:
+        segments = _segments(rewrite)
+        results = map_chunks(segments, _segment_handler(request, len(segments)))
+        return event_stream_response(
+            stream_chunked(results, len(segments), lambda parts: _splice(rewrite, parts), stream_format),
+            stream_format
+        )
+
+    chunks, scopes = split_code_scoped(request.code, request.source_language)
+    if len(chunks) > 1:
+        results = map_chunks(chunks, _chunk_handler(request, scopes))
+        return event_stream_response(
+            stream_chunked(results, len(chunks), lambda parts: _with_local_changes(rewrite, merge_refactors(parts)), stream_format),
+            stream_format
+        )
+
+    async def parse_with_local_changes(content: str, provider: str) -> RefactorResponse:
+        return _with_local_changes(rewrite, await parse_refactor(content, provider, prompt))
+
+    async def remember(result: RefactorResponse) -> None:
+        await similarity_index.add(space, original, result.model_dump(), language=request.source_language)
+
+    prompt = _build_prompt(request, request.code, reference=reference_note(similar) if similar else None)
     try:
-        # TODO: Implement actual OpenAI call
-        # For now, return placeholder data
-        return RefactorResponse(
-            refactored_code="// Placeholder for refactored code\npublic class Example { ... }",
-            changes_made=["Converted for loops to streams", "Replaced anonymous classes with lambdas"],
-            migration_notes="Successfully modernized the code from Java 8 to Java 21."
+        deltas = await prime_stream(ai_service.stream_response(
+            prompt=prompt,
+            max_tokens=output_token_budget(request.code),
+            temperature=0.7,
+            json_mode=True
+        ))
+    except ProviderOverloadedError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e), headers=retry_after_headers(e))
+    except DeadlineExceeded as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to refactor code: {str(e)}")
+
+    return event_stream_response(
+        stream_structured(
+            deltas,
+            parse_with_local_changes,
+            stream_format,
+            on_result=remember
+        ),
+        stream_format
+    )
+
+async def _session_base(request: RefactorRequest) -> Tuple[RefactorResponse, Optional[Exchange]]:
+    """
+    Answer the round a session's prompt prefix is built from. Code that
+    fits one prompt goes to the model as submitted, without the local
+    rewrites or a similarity reference, so that follow-up rounds replay
+    exactly this prompt and answer; larger code is answered like
+    /refactor/modernize and has no prefix to replay.
+    """
+    if len(split_code(request.code, request.source_language)) > 1:
+        return await modernize_code(request), None
+    with span("prompt"):
+        prompt = _build_prompt(request, request.code)
+    with span("upstream"):
+        response = await ai_service.generate_response(
+            prompt=prompt,
+            max_tokens=output_token_budget(request.code),
+            temperature=0.7,
+            json_mode=True
         )
+    with span("parse"):
+        result = await parse_refactor(response["content"], response["provider"], prompt)
+    exchange = {"prompt": prompt, "answer": response["content"], "output": result.refactored_code}
+    return result, exchange
+
+@router.post("/sessions", response_model=RefactorSessionResponse, dependencies=[admit])
+async def start_refactor_session(request: RefactorRequest):
+    """
+    Modernize code like /refactor/modernize and keep the code and result on
+    the server, so follow-up rounds only need to send a diff.
+    Code that fits one prompt is sent to the model as submitted, so that
+    follow-up rounds can replay that exact exchange as a cached prefix.
+    """
+    try:
+        result, exchange = await _session_base(request)
+    except HTTPException:
+        raise
+    except ProviderOverloadedError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e), headers=retry_after_headers(e))
+    except DeadlineExceeded as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to refactor code: {str(e)}")
+    session = await session_store.create(
+        "refactor", request.model_dump(exclude={"code"}), request.code, result.model_dump(), exchange
+    )
+    return RefactorSessionResponse(**result.model_dump(), session_id=session["id"], version=session["version"])
+
+@router.post("/sessions/{session_id}", response_model=RefactorRoundResponse, dependencies=[admit])
+async def refactor_session_round(session_id: str, submission: RefactorRoundRequest):
+    """
+    Refactor the next version of a session's code, uploaded as a diff
+    against the previous one. The model gets the first round as a cached
+    prompt prefix plus the change, and the response is a unified diff
+    against the refactored code the client already has.
+    """
+    session = await session_store.get(session_id, "refactor")
+    if session is None:
+        raise HTTPException(status_code=404, detail="Session not found or expired")
+    try:
+        code = resolve_code(session, submission.diff, submission.code, submission.base_version)
+    except SessionConflictError as e:
+        raise HTTPException(status_code=409, detail={"message": str(e), "version": e.version})
+    except PatchError as e:
+        raise HTTPException(status_code=422, detail=f"Diff does not apply: {str(e)}")
+
+    request = RefactorRequest(code=code, **session["params"])
+
+    async def full(code: str) -> Tuple[RefactorResponse, Optional[Exchange]]:
+        return await _session_base(request.model_copy(update={"code": code}))
+
+    try:
+        result, rebased, exchange = await answer_round(session, code, "refactored_code", parse_refactor, full)
+        updated = await session_store.advance(session, code, result, rebased, exchange)
+    except SessionConflictError as e:
+        raise HTTPException(status_code=409, detail={"message": str(e), "version": e.version})
+    except HTTPException:
+        raise
+    except ProviderOverloadedError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e), headers=retry_after_headers(e))
+    except DeadlineExceeded as e:
+        raise HTTPException(status_code=504, detail=str(e))
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to refactor code: {str(e)}") 
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Failed to refactor code: {str(e)}")
+
+    return RefactorRoundResponse(
+        session_id=session_id,
+        version=updated["version"],
+        patch=make_patch(session["result"]["refactored_code"], result["refactored_code"]),
+        changes_made=result["changes_made"],
+        migration_notes=result.get("migration_notes")
+    )
+
+@router.delete("/sessions/{session_id}")
+async def end_refactor_session(session_id: str):
+    if not await session_store.delete(session_id, "refactor"):
+        raise HTTPException(status_code=404, detail="Session not found or expired")
+    return {"deleted": True}
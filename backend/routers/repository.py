@@ -0,0 +1,246 @@
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import FileResponse
+from typing import Dict, Any
+import asyncio
+import os
+from routers.refactor import RefactorRequest, RefactorResponse, modernize_code
+from services.admission import admission, client_id, bind_client
+from services.jobs import job_store, register_job_handler, public_job, can_access, TERMINAL_STATUSES
+from services.repository import (
+    Workspace,
+    ArchiveError,
+    extract_archive,
+    build_graph,
+    break_cycles,
+    run_in_order,
+    renamed_definitions,
+    module_name,
+    purge_workspaces,
+    file_language,
+    REPOSITORY_CONCURRENCY
+)
+from services.rewrite import normalize_language
+from services.streaming import format_event, event_stream_response
+
+router = APIRouter(prefix="/refactor/repository", tags=["RefactorTool"])
+
+# Per-client admission control; batch traffic yields upstream capacity to interactive requests
+admit = Depends(admission("batch"))
+
+async def run_repository(payload: Dict[str, Any], job: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Job handler: refactor every source file of an extracted repository in
+    dependency order. Each finished file is appended to the workspace's
+    result log, so a retried or re-claimed job skips what is already done.
+    """
+    bind_client(job["client"])
+    workspace = Workspace(payload["workspace"])
+    options = payload["options"]
+    graph = {path: set(deps) for path, deps in payload["graph"].items()}
+    deps, levels = break_cycles(graph)
+    level_of = {path: index for index, level in enumerate(levels) for path in level}
+
+    entries = await workspace.results()
+    renames = {entry["path"]: entry["renames"] for entry in entries if entry["status"] == "ok"}
+    failed = sum(1 for entry in entries if entry["status"] == "error")
+    modules: Dict[str, str] = {}
+
+    def module(path: str) -> str:
+        if path not in modules:
+            modules[path] = module_name(path, workspace.read(path))
+        return modules[path]
+
+    async def handle(path: str) -> None:
+        nonlocal failed
+        code = await asyncio.to_thread(workspace.read, path)
+        # Only renames in files this one imports can affect it
+        api_renames = {
+            f"{module(dep)}.{old}": new for dep in graph[path] for old, new in renames.get(dep, {}).items()
+        }
+        request = RefactorRequest(code=code, **options, api_renames=api_renames or None)
+        entry = {"path": path, "level": level_of[path]}
+        try:
+            if code.strip():
+                result = await modernize_code(request)
+                # Models tend to drop the final newline; keep the file's own
+                if code.endswith("\n") and not result.refactored_code.endswith("\n"):
+                    result.refactored_code += "\n"
+            else:
+                result = RefactorResponse(refactored_code=code, changes_made=[])
+        except HTTPException as e:
+            if e.status_code in (429, 503):
+                # Upstream overload or spent token quota: fail this attempt and resume from the log on retry
+                raise Exception(str(e.detail))
+            failed += 1
+            entry.update(status="error", error=str(e.detail))
+        else:
+            entry.update(
+                status="ok",
+                **result.model_dump(),
+                renames=renamed_definitions(code, result.refactored_code, options["source_language"])
+            )
+            renames[path] = entry["renames"]
+        await workspace.record(entry)
+        await job_store.set_progress(job["id"], {
+            "total": len(graph),
+            "completed": len(renames) + failed,
+            "failed": failed,
+            "levels": len(levels),
+            "last": path
+        })
+
+    await run_in_order(deps, handle, {entry["path"] for entry in entries}, REPOSITORY_CONCURRENCY)
+
+    entries = await workspace.results()
+    await workspace.write_patch(entries)
+    return {
+        "workspace": workspace.id,
+        "files": len(graph),
+        "changed": sum(1 for e in entries if e["status"] == "ok" and e["refactored_code"] != workspace.read(e["path"])),
+        "failed": sum(1 for e in entries if e["status"] == "error"),
+        "copied": payload["copied"],
+        "levels": len(levels),
+        "patch_url": f"/refactor/repository/{job['id']}/patch"
+    }
+
+register_job_handler("repository", run_repository)
+
+def _repository_events(job_id: str, workspace: Workspace, stream_format: str):
+    """
+    Follow a repository job: one "file" event per refactored file (from
+    the start of the result log), "progress" events and a final "result"
+    with the finished job
+    """
+    async def events():
+        offset = 0
+        last = None
+        while True:
+            job = await job_store.get(job_id)
+            entries, offset = await asyncio.to_thread(workspace.tail, offset)
+            for entry in entries:
+                yield format_event("file", entry, stream_format)
+            if job is None:
+                yield format_event("error", {"detail": "Job not found"}, stream_format)
+                return
+            if job["status"] in TERMINAL_STATUSES:
+                yield format_event("result", public_job(job), stream_format)
+                return
+            if job["progress"] != last:
+                last = job["progress"]
+                yield format_event("progress", {"status": job["status"], **(last or {})}, stream_format)
+            await job_store.wait_for_change(job_id)
+
+    return events()
+
+async def _repository_job(job_id: str, request: Request) -> Dict[str, Any]:
+    job = await job_store.get(job_id)
+    # Jobs the caller may not see are reported as missing
+    if job is None or job["type"] != "repository" or not can_access(job, request):
+        raise HTTPException(status_code=404, detail="Repository job not found")
+    return job
+
+@router.post("", dependencies=[admit])
+async def refactor_repository(
+    request: Request,
+    source_language: str = Query(..., description="Only files in this language are refactored (python, java)"),
+    source_version: str = Query(...),
+    target_version: str = Query(...),
+    preserve_comments: bool = Query(True),
+    modernization_level: str = Query("moderate", pattern="^(conservative|moderate|aggressive)$"),
+    stream_format: str = Query("ndjson", alias="format", pattern="^(sse|ndjson)$")
+):
+    """
+    Modernize a whole repository uploaded as the raw request body (zip, or
+    tar optionally gzip/bzip2/xz compressed). The archive is extracted
+    while it streams in, files are refactored in import order with leaves
+    running concurrently, and APIs renamed in one file are passed on to
+    the files importing it.
+
+    The work runs as a job (see /jobs/{id}) that survives worker restarts.
+    The response streams a "file" event per finished file and a final
+    "result"; reconnect with GET /refactor/repository/{job_id}/events and
+    download the patch archive from GET /refactor/repository/{job_id}/patch,
+    passing the access_token from the "accepted" event as X-Job-Token or
+    ?token=.
+    """
+    language = normalize_language(source_language)
+    if language not in ("python", "java"):
+        raise HTTPException(status_code=422, detail="source_language must be python or java")
+
+    await asyncio.to_thread(purge_workspaces)
+    workspace = await asyncio.to_thread(Workspace.create)
+    try:
+        paths = await extract_archive(request.stream(), workspace.src)
+        sources, _ = await asyncio.to_thread(workspace.source_files, paths)
+        sources = [path for path in sources if file_language(path) == language]
+        graph = await asyncio.to_thread(build_graph, workspace.src, sources)
+    except ArchiveError as e:
+        await asyncio.to_thread(workspace.remove)
+        raise HTTPException(status_code=400, detail=str(e))
+    except BaseException:
+        await asyncio.to_thread(workspace.remove)
+        raise
+    if not graph:
+        await asyncio.to_thread(workspace.remove)
+        raise HTTPException(status_code=422, detail=f"The archive contains no {language} source files")
+
+    options = {
+        "source_language": language,
+        "source_version": source_version,
+        "target_version": target_version,
+        "preserve_comments": preserve_comments,
+        "modernization_level": modernization_level
+    }
+    job, _ = await job_store.create(
+        "repository",
+        {
+            "workspace": workspace.id,
+            "options": options,
+            "graph": {path: sorted(deps) for path, deps in graph.items()},
+            "copied": len(paths) - len(graph)
+        },
+        client=client_id(request)
+    )
+    _, levels = break_cycles(graph)
+
+    async def events():
+        yield format_event("accepted", {
+            "job_id": job["id"],
+            "access_token": job["access_token"],
+            "files": len(graph),
+            "copied": len(paths) - len(graph),
+            "levels": len(levels)
+        }, stream_format)
+        async for event in _repository_events(job["id"], workspace, stream_format):
+            yield event
+
+    response = event_stream_response(events(), stream_format)
+    response.headers["Location"] = f"/jobs/{job['id']}"
+    return response
+
+@router.get("/{job_id}/events")
+async def repository_events(
+    job_id: str,
+    request: Request,
+    stream_format: str = Query("ndjson", alias="format", pattern="^(sse|ndjson)$")
+):
+    """
+    Replay the per-file results of a repository job and follow it until it finishes
+    """
+    job = await _repository_job(job_id, request)
+    workspace = Workspace(job["payload"]["workspace"])
+    return event_stream_response(_repository_events(job_id, workspace, stream_format), stream_format)
+
+@router.get("/{job_id}/patch")
+async def repository_patch(job_id: str, request: Request):
+    """
+    Download the patch archive of a finished repository job: repository.patch
+    (apply with git apply), the refactored files under files/ and results.json
+    """
+    job = await _repository_job(job_id, request)
+    if job["status"] != "succeeded":
+        raise HTTPException(status_code=409, detail=f"Job is {job['status']}")
+    workspace = Workspace(job["payload"]["workspace"])
+    if not os.path.exists(workspace.patch_archive):
+        raise HTTPException(status_code=410, detail="The patch archive has expired")
+    return FileResponse(workspace.patch_archive, media_type="application/gzip", filename=f"refactor-{job_id}.tar.gz")
@@ -0,0 +1,199 @@
+"""
+Production launcher: one API worker process per core, forked from a parent
+that has already imported the heavy libraries, all accepting on one socket.
+
+Run from the backend directory:
+
+    python serve.py                 # WEB_CONCURRENCY workers, default one per core
+    python serve.py --workers 4 --port 8000
+
+The workers share the response cache (its SQLite tier), the job store and,
+through SHARED_STATE_PATH, the per-client and upstream rate limits. The
+parent restarts workers that die and shuts them down gracefully on SIGTERM.
+Where fork is unavailable it falls back to uvicorn's own worker processes.
+"""
+from typing import Dict, List
+import argparse
+import importlib
+import logging
+import math
+import os
+import signal
+import socket
+import time
+
+# Imported in the parent so forked workers share them instead of each paying
+# for the import. Nothing here may open files, sockets or threads at import.
+PRELOAD_MODULES = ("fastapi", "pydantic", "starlette.routing", "uvicorn", "httpx", "openai")
+
+# Seconds workers get to finish in-flight requests after SIGTERM
+GRACEFUL_TIMEOUT = float(os.getenv("SERVE_GRACEFUL_TIMEOUT", "30"))
+# A worker dying sooner than this after starting counts as a crash loop
+MIN_UPTIME = 5.0
+# Comma-separated proxy addresses whose X-Forwarded-For is believed, "*" for any.
+# Rate limits and client identity use the address it resolves to.
+FORWARDED_ALLOW_IPS = os.getenv("FORWARDED_ALLOW_IPS", "127.0.0.1")
+
+logger = logging.getLogger("devlift.serve")
+
+
+def cpu_count() -> int:
+    """
+    Cores this process may actually use: the CPU affinity mask, capped by
+    a cgroup v2 CPU quota (as set by container platforms)
+    """
+    try:
+        count = len(os.sched_getaffinity(0))
+    except AttributeError:
+        count = os.cpu_count() or 1
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            count = min(count, max(1, math.ceil(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return count
+
+
+def bind_socket(host: str, port: int) -> socket.socket:
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+class Prefork:
+    """
+    Minimal pre-fork supervisor: forks the workers, replaces the ones that
+    exit and stops them all on SIGTERM/SIGINT
+    """
+
+    def __init__(self, sock: socket.socket, workers: int, uvicorn_options: Dict):
+        self.sock = sock
+        self.workers = workers
+        self.uvicorn_options = uvicorn_options
+        self.children: Dict[int, float] = {}
+        self.stopping = False
+        self.crashes: List[float] = []
+
+    def spawn(self) -> None:
+        # Hold SIGINT/SIGTERM until the child has dropped the parent's handlers
+        stop_signals = {signal.SIGINT, signal.SIGTERM}
+        signal.pthread_sigmask(signal.SIG_BLOCK, stop_signals)
+        pid = os.fork()
+        if pid:
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, stop_signals)
+            self.children[pid] = time.monotonic()
+            return
+        # Worker: uvicorn installs its own SIGINT/SIGTERM handlers
+        status = 0
+        try:
+            for sig in stop_signals:
+                signal.signal(sig, signal.SIG_DFL)
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, stop_signals)
+            import uvicorn
+
+            config = uvicorn.Config("main:app", **self.uvicorn_options)
+            uvicorn.Server(config).run(sockets=[self.sock])
+        except BaseException:
+            logger.exception("Worker %d failed", os.getpid())
+            status = 1
+        finally:
+            os._exit(status)
+
+    def _stop(self, signum, frame) -> None:
+        if not self.stopping:
+            logger.info("Stopping %d workers", len(self.children))
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def _reap(self) -> None:
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self.children.clear()
+                return
+            if pid == 0:
+                return
+            started = self.children.pop(pid, None)
+            if self.stopping or started is None:
+                continue
+            logger.warning("Worker %d exited with status %d, restarting", pid, os.waitstatus_to_exitcode(status))
+            if time.monotonic() - started < MIN_UPTIME:
+                self.crashes = [t for t in self.crashes if time.monotonic() - t < 60] + [time.monotonic()]
+                # Back off instead of forking in a tight loop when workers cannot start
+                time.sleep(min(30.0, 0.5 * 2 ** len(self.crashes)))
+                if self.stopping:
+                    continue
+            self.spawn()
+
+    def run(self) -> None:
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        for _ in range(self.workers):
+            self.spawn()
+        logger.info("Started %d workers on %s", self.workers, self.sock.getsockname())
+
+        kill_at = None
+        while self.children:
+            self._reap()
+            if self.stopping:
+                kill_at = kill_at or time.monotonic() + GRACEFUL_TIMEOUT
+                if time.monotonic() > kill_at:
+                    for pid in list(self.children):
+                        os.kill(pid, signal.SIGKILL)
+            time.sleep(0.2)
+        self.sock.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run the DevLift API with one worker process per core")
+    parser.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")))
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(os.getenv("WEB_CONCURRENCY", "0")) or None,
+        help="Worker processes (default: WEB_CONCURRENCY, else one per available core)"
+    )
+    parser.add_argument("--log-level", default=os.getenv("LOG_LEVEL", "info"))
+    args = parser.parse_args()
+    workers = args.workers or cpu_count()
+
+    logging.basicConfig(level=args.log_level.upper(), format="%(levelname)s:     [serve] %(message)s")
+    # Must be set before any worker imports the app
+    if workers > 1:
+        os.environ.setdefault("SHARED_STATE_PATH", "data/shared_state.sqlite3")
+
+    uvicorn_options = {
+        "log_level": args.log_level,
+        "timeout_graceful_shutdown": GRACEFUL_TIMEOUT,
+        "proxy_headers": True,
+        "forwarded_allow_ips": FORWARDED_ALLOW_IPS,
+    }
+    if workers == 1 or not hasattr(os, "fork"):
+        import uvicorn
+
+        uvicorn.run("main:app", host=args.host, port=args.port, workers=workers, **uvicorn_options)
+        return
+
+    for module in PRELOAD_MODULES:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            pass
+    sock = bind_socket(args.host, args.port)
+    Prefork(sock, workers, uvicorn_options).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,393 @@
+from typing import Optional, Dict, Any, AsyncIterator, Union
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+import asyncio
+import hashlib
+import math
+import os
+import time
+from fastapi import HTTPException, Request
+from services import metrics
+from services.deadline import DeadlineExceeded, bounded_timeout, check_deadline
+from services.providers import ProviderOverloadedError
+from services.shared_state import shared_state
+
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "true").lower() == "true"
+REQUESTS_PER_MINUTE = float(os.getenv("ADMISSION_REQUESTS_PER_MINUTE", "60"))
+REQUEST_BURST = float(os.getenv("ADMISSION_REQUEST_BURST", "20"))
+TOKENS_PER_MINUTE = float(os.getenv("ADMISSION_TOKENS_PER_MINUTE", "100000"))
+TOKEN_BURST = float(os.getenv("ADMISSION_TOKEN_BURST", str(TOKENS_PER_MINUTE)))
+MAX_CLIENTS = int(os.getenv("ADMISSION_MAX_CLIENTS", "10000"))
+# Upstream calls dispatched at once across all clients, handed out by the fair queue
+MAX_INFLIGHT = int(os.getenv("ADMISSION_MAX_INFLIGHT", "64"))
+QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "30"))
+WEIGHTS = {
+    "interactive": float(os.getenv("ADMISSION_INTERACTIVE_WEIGHT", "4")),
+    "batch": float(os.getenv("ADMISSION_BATCH_WEIGHT", "1")),
+}
+
+# API keys that identify a client, comma separated, as the keys themselves or
+# as "sha256:<hex digest>". Unlisted keys are ignored: the app does not
+# authenticate, so an unverified key would let a caller pick a fresh bucket.
+API_KEY_DIGESTS = {
+    key[len("sha256:"):].lower() if key.startswith("sha256:") else hashlib.sha256(key.encode()).hexdigest()
+    for key in (k.strip() for k in os.getenv("ADMISSION_API_KEYS", "").split(","))
+    if key
+}
+# Only set behind a proxy that authenticates users and sets X-User-Id itself
+TRUST_USER_HEADER = os.getenv("ADMISSION_TRUST_USER_HEADER", "false").lower() == "true"
+
+PRIORITY_HEADER = "x-devlift-priority"
+
+
+class QuotaExceededError(ProviderOverloadedError):
+    """
+    Raised before an upstream call when the client's LLM-token balance is
+    exhausted. Routers translate this into a 429 with Retry-After.
+    """
+    status_code = 429
+
+
+class TokenBucket:
+    """
+    Classic token bucket refilled continuously at rate per second, holding
+    at most capacity. The level may go negative when actual usage exceeds
+    what was available; the client then waits until it is paid back.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self, amount: float = 1) -> float:
+        """
+        Take amount if available
+
+        Returns:
+            0 when taken, else the seconds until it would be available
+        """
+        self._refill()
+        if self.level >= amount:
+            self.level -= amount
+            return 0.0
+        if self.rate <= 0:
+            return math.inf
+        return (amount - self.level) / self.rate
+
+    def charge(self, amount: float) -> None:
+        """
+        Debit usage that has already happened, going into debt if needed
+        """
+        self._refill()
+        self.level -= amount
+
+
+class SharedTokenBucket:
+    """
+    TokenBucket kept in the shared state store, so every worker process
+    draws on the same balance for a client
+    """
+
+    def __init__(self, key: str, rate: float, capacity: float):
+        self.key = key
+        self.rate = rate
+        self.capacity = capacity
+
+    def try_take(self, amount: float = 1) -> float:
+        return shared_state.take(self.key, self.rate, self.capacity, amount)
+
+    def charge(self, amount: float) -> None:
+        shared_state.take(self.key, self.rate, self.capacity, amount, debt=True)
+
+
+def _bucket(key: str, rate: float, capacity: float):
+    if shared_state is not None:
+        return SharedTokenBucket(key, rate, capacity)
+    return TokenBucket(rate, capacity)
+
+
+@dataclass
+class Ticket:
+    """
+    Admission state for one API request, visible to the AI service through
+    a context variable so upstream calls can be queued and charged to it
+    """
+    client: str
+    priority: str
+    tokens: Optional[Union[TokenBucket, SharedTokenBucket]] = None
+
+
+_ticket: ContextVar[Optional[Ticket]] = ContextVar("admission_ticket", default=None)
+
+
+def current_ticket() -> Optional[Ticket]:
+    return _ticket.get()
+
+
+def client_id(request: Request) -> str:
+    """
+    Identify the caller by a configured API key, then by X-User-Id when a
+    trusted proxy sets it, then by address. The address is the one uvicorn
+    takes from X-Forwarded-For when the connection comes from a proxy in
+    FORWARDED_ALLOW_IPS. API keys are hashed so they are never held in
+    memory in the clear.
+    """
+    api_key = request.headers.get("x-api-key")
+    if not api_key:
+        auth = request.headers.get("authorization", "")
+        if auth.lower().startswith("bearer "):
+            api_key = auth[7:]
+    if api_key:
+        digest = hashlib.sha256(api_key.encode()).hexdigest()
+        if digest in API_KEY_DIGESTS:
+            return "key:" + digest[:16]
+    user = request.headers.get("x-user-id")
+    if user and TRUST_USER_HEADER:
+        return f"user:{user}"
+    return f"ip:{request.client.host if request.client else 'unknown'}"
+
+
+class ClientLimiter:
+    """
+    Per-client request and LLM-token buckets, keeping the most recently
+    seen MAX_CLIENTS clients
+    """
+
+    def __init__(self, max_clients: int = MAX_CLIENTS):
+        self.max_clients = max_clients
+        self._buckets: OrderedDict[str, Dict[str, TokenBucket]] = OrderedDict()
+
+    def buckets(self, client: str) -> Dict[str, TokenBucket]:
+        buckets = self._buckets.get(client)
+        if buckets is None:
+            buckets = {
+                "requests": _bucket(f"{client}:requests", REQUESTS_PER_MINUTE / 60, REQUEST_BURST),
+                "tokens": _bucket(f"{client}:tokens", TOKENS_PER_MINUTE / 60, TOKEN_BURST),
+            }
+            self._buckets[client] = buckets
+            if len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(client)
+        return buckets
+
+    def admit(self, client: str) -> Dict[str, TokenBucket]:
+        """
+        Take one request from the client's bucket and require a non-negative
+        token balance
+
+        Raises:
+            HTTPException: 429 with Retry-After when either limit is exhausted
+        """
+        buckets = self.buckets(client)
+        tokens = buckets["tokens"].try_take(0)
+        if tokens:
+            metrics.admission_rejections.inc(reason="tokens")
+            raise _too_many(QUOTA_MESSAGE, tokens)
+        wait = buckets["requests"].try_take(1)
+        if wait:
+            metrics.admission_rejections.inc(reason="requests")
+            raise _too_many("Request rate limit exceeded", wait)
+        return buckets
+
+
+QUOTA_MESSAGE = "LLM token quota exceeded"
+
+
+def _too_many(message: str, wait: float) -> HTTPException:
+    return HTTPException(status_code=429, detail=message, headers={"Retry-After": str(max(1, math.ceil(wait)))})
+
+
+class FairQueue:
+    """
+    Hands out a fixed number of dispatch slots. Waiting requests are served
+    by weighted stride scheduling across priorities (interactive gets
+    WEIGHTS["interactive"] slots for every batch slot when both wait) and
+    round robin across clients within a priority, so one heavy client
+    cannot starve the rest.
+    """
+
+    def __init__(self, capacity: int = MAX_INFLIGHT, weights: Optional[Dict[str, float]] = None):
+        self.capacity = capacity
+        self.weights = weights or WEIGHTS
+        self.in_use = 0
+        # priority -> client -> waiting futures
+        self._waiting: Dict[str, OrderedDict[str, deque]] = {p: OrderedDict() for p in self.weights}
+        self._pass: Dict[str, float] = {p: 0.0 for p in self.weights}
+
+    def waiting(self) -> int:
+        return sum(len(q) for clients in self._waiting.values() for q in clients.values())
+
+    async def acquire(self, client: str, priority: str) -> None:
+        if priority not in self._waiting:
+            priority = "batch"
+        if self.in_use < self.capacity and not self.waiting():
+            self.in_use += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[priority].setdefault(client, deque()).append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Slot was handed over just as we were cancelled
+                self.release()
+            else:
+                self._discard(priority, client, future)
+            raise
+
+    def _discard(self, priority: str, client: str, future: asyncio.Future) -> None:
+        queue = self._waiting[priority].get(client)
+        if queue is not None and future in queue:
+            queue.remove(future)
+            if not queue:
+                del self._waiting[priority][client]
+
+    def _next(self) -> Optional[asyncio.Future]:
+        active = [p for p, clients in self._waiting.items() if clients]
+        if not active:
+            return None
+        priority = min(active, key=lambda p: self._pass[p])
+        # Keep idle priorities from banking credit while they had nothing queued
+        floor = self._pass[priority]
+        for p in self._pass:
+            if p not in active:
+                self._pass[p] = max(self._pass[p], floor)
+        self._pass[priority] += 1 / self.weights[priority]
+
+        clients = self._waiting[priority]
+        client, queue = next(iter(clients.items()))
+        future = queue.popleft()
+        del clients[client]
+        if queue:
+            # Rotate the client to the back of its priority's round robin
+            clients[client] = queue
+        return future
+
+    def release(self) -> None:
+        while True:
+            future = self._next()
+            if future is None:
+                self.in_use -= 1
+                return
+            if not future.done():
+                future.set_result(None)
+                return
+
+
+def retry_after_headers(error: BaseException) -> Optional[Dict[str, str]]:
+    """
+    Retry-After header for an overload error that knows when capacity returns
+    """
+    retry_after = getattr(error, "retry_after", None)
+    if not retry_after:
+        return None
+    return {"Retry-After": str(max(1, math.ceil(retry_after)))}
+
+
+client_limiter = ClientLimiter()
+fair_queue = FairQueue()
+
+
+@asynccontextmanager
+async def dispatch_slot() -> AsyncIterator[None]:
+    """
+    Hold a fair-queue slot for one upstream call, on behalf of the current
+    request's client and priority. Every call first checks the client's
+    token balance, so a batch or job cannot spend past the quota it was
+    admitted under.
+
+    Raises:
+        QuotaExceededError: The client's token balance is exhausted
+    """
+    if not ADMISSION_ENABLED:
+        yield
+        return
+    ticket = current_ticket()
+    client = ticket.client if ticket else "internal"
+    priority = ticket.priority if ticket else "batch"
+    if ticket is not None and ticket.tokens is not None:
+        wait = ticket.tokens.try_take(0)
+        if wait:
+            metrics.admission_rejections.inc(reason="tokens")
+            raise QuotaExceededError(QUOTA_MESSAGE, retry_after=wait)
+    check_deadline("admission_queue")
+    # Give up when the request's deadline comes before the queue timeout
+    timeout, bounded = bounded_timeout(QUEUE_TIMEOUT)
+    started = time.perf_counter()
+    try:
+        await asyncio.wait_for(fair_queue.acquire(client, priority), timeout=timeout)
+    except asyncio.TimeoutError:
+        if bounded:
+            metrics.deadline_expired.inc(stage="admission_queue")
+            raise DeadlineExceeded()
+        metrics.admission_rejections.inc(reason="queue_timeout")
+        raise ProviderOverloadedError("Server is at capacity, try again shortly", retry_after=5)
+    metrics.admission_queue_wait.observe(time.perf_counter() - started, priority=priority)
+    try:
+        yield
+    finally:
+        fair_queue.release()
+
+
+def charge_tokens(tokens: float) -> None:
+    """
+    Charge LLM tokens to the current request's client
+    """
+    ticket = current_ticket()
+    if ticket is not None and ticket.tokens is not None and tokens:
+        ticket.tokens.charge(tokens)
+
+
+def bind_client(client: Optional[str], priority: str = "batch") -> None:
+    """
+    Attribute upstream calls made outside an HTTP request (job workers) to
+    the client that submitted the work
+    """
+    if not ADMISSION_ENABLED or not client:
+        return
+    _ticket.set(Ticket(client=client, priority=priority, tokens=client_limiter.buckets(client)["tokens"]))
+
+
+def admission(default_priority: str = "interactive"):
+    """
+    Build the FastAPI dependency that admits a request: rate-limits the
+    client and tags the request with its client id and priority. Clients
+    may lower their own priority with the X-DevLift-Priority: batch header.
+
+    Args:
+        default_priority: Priority for routes using this dependency
+    """
+    async def admit(request: Request) -> None:
+        if not ADMISSION_ENABLED:
+            return
+        client = client_id(request)
+        priority = default_priority
+        if request.headers.get(PRIORITY_HEADER, "").lower() == "batch":
+            priority = "batch"
+        buckets = client_limiter.admit(client)
+        _ticket.set(Ticket(client=client, priority=priority, tokens=buckets["tokens"]))
+
+    return admit
+
+
+def snapshot() -> Dict[str, Any]:
+    """
+    Current queue depth and slot usage
+    """
+    return {
+        "enabled": ADMISSION_ENABLED,
+        "in_use": fair_queue.in_use,
+        "capacity": fair_queue.capacity,
+        "waiting": {p: sum(len(q) for q in clients.values()) for p, clients in fair_queue._waiting.items()},
+        "clients": len(client_limiter._buckets)
+    }
@@ -1,46 +1,263 @@
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, AsyncIterator, List, TYPE_CHECKING
 import os
-from openai import OpenAI
+from prompt_builder import normalize_prompt, estimate_tokens
+from services.admission import dispatch_slot, charge_tokens
+from services.cache import response_cache, make_cache_key
+from services.deadline import check_deadline, fit_completion
+from services.providers import Provider, load_providers, ProviderOverloadedError
+from services.provider_router import ProviderRouter
+
+if TYPE_CHECKING:
+    import httpx
+
+# Connection pool settings, overridable through the environment
+HTTP2_ENABLED = os.getenv("AI_HTTP2", "true").lower() == "true"
+MAX_CONNECTIONS = int(os.getenv("AI_MAX_CONNECTIONS", "200"))
+MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("AI_MAX_KEEPALIVE_CONNECTIONS", "50"))
+KEEPALIVE_EXPIRY = float(os.getenv("AI_KEEPALIVE_EXPIRY", "30"))
+REQUEST_TIMEOUT = float(os.getenv("AI_REQUEST_TIMEOUT", "120"))
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def create_http_client() -> "httpx.AsyncClient":
+    """
+    Build the pooled HTTP client shared by every provider.
+
+    Returns:
+        An httpx.AsyncClient with keep-alive and connection limits applied
+    """
+    import httpx
+
+    limits = httpx.Limits(
+        max_connections=MAX_CONNECTIONS,
+        max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=KEEPALIVE_EXPIRY
+    )
+    return httpx.AsyncClient(
+        http2=HTTP2_ENABLED and _http2_available(),
+        limits=limits,
+        timeout=httpx.Timeout(REQUEST_TIMEOUT, connect=10.0)
+    )
+
+
+def _build_messages(
+    prompt: str,
+    system_prompt: Optional[str],
+    history: Optional[List[Dict[str, str]]] = None
+) -> list[Dict[str, str]]:
+    # Stable parts first, so providers can reuse the cached prompt prefix
+    messages = [*(history or []), {"role": "user", "content": prompt}]
+    if system_prompt:
+        messages.insert(0, {"role": "system", "content": system_prompt})
+    return messages
+
 
 class AIService:
+    """
+    Entry point for completions. The HTTP pool, providers and provider
+    router are built on first use rather than at import, which keeps the
+    SDK imports and TLS setup out of process startup.
+    """
+
     def __init__(self):
-        self.provider = self._init_openai()
+        self._http_client: Optional["httpx.AsyncClient"] = None
+        self._providers: Optional[Dict[str, Provider]] = None
+        self._router: Optional[ProviderRouter] = None
+
+    @property
+    def http_client(self) -> "httpx.AsyncClient":
+        if self._http_client is None:
+            self._http_client = create_http_client()
+        return self._http_client
 
-    def _init_openai(self) -> Optional[OpenAI]:
-        try:
-            api_key = os.getenv("OPENAI_API_KEY")
-            if not api_key:
-                return None
-            return OpenAI(api_key=api_key)
-        except Exception:
-            return None
+    @property
+    def providers(self) -> Dict[str, Provider]:
+        if self._providers is None:
+            self._providers = load_providers(self.http_client)
+        return self._providers
 
-    async def generate_response(self, prompt: str, **kwargs) -> Dict[str, Any]:
+    @property
+    def router(self) -> ProviderRouter:
+        if self._router is None:
+            self._router = ProviderRouter(self.providers)
+        return self._router
+
+    def _check_providers(self) -> None:
+        if not self.providers:
+            raise Exception(
+                "No AI provider initialized. Please set OPENAI_API_KEY (or another provider key) in .env file."
+            )
+
+    def _cache_key(
+        self,
+        prompt: str,
+        system_prompt: Optional[str],
+        preferred_provider: Optional[str],
+        history: Optional[List[Dict[str, str]]],
+        kwargs: Dict[str, Any]
+    ) -> str:
+        return make_cache_key(
+            prompt,
+            kwargs.get("model"),
+            kwargs.get("temperature"),
+            kwargs.get("max_tokens"),
+            system_prompt,
+            preferred_provider,
+            history
+        )
+
+    async def generate_response(
+        self,
+        prompt: str,
+        system_prompt: Optional[str] = None,
+        preferred_provider: Optional[str] = None,
+        use_cache: bool = True,
+        history: Optional[List[Dict[str, str]]] = None,
+        **kwargs
+    ) -> Dict[str, Any]:
         """
-        Generate a response using OpenAI
+        Generate a response on the fastest healthy provider, served from the
+        response cache when possible. When little of the request's deadline
+        is left the completion is shortened (see fit_completion); such a
+        shortened answer is not cached.
+
+        Args:
+            prompt: The user prompt
+            system_prompt: Optional system message sent before the prompt
+            preferred_provider: Provider to try first when it is healthy
+            use_cache: Whether to read and populate the response cache
+            history: Earlier user/assistant turns sent before the prompt
+            **kwargs: Extra completion parameters (max_tokens, temperature, model, hedge, ...)
+
+        Returns:
+            A dict with the provider name, the completion text and token usage
         """
-        if not self.provider:
-            raise Exception("OpenAI provider not initialized. Please set OPENAI_API_KEY in .env file.")
+        self._check_providers()
+        check_deadline("prompt")
+        fitted = fit_completion(kwargs)
 
-        try:
-            response = await self.provider.chat.completions.create(
-                messages=[{"role": "user", "content": prompt}],
+        if not use_cache or response_cache is None:
+            return await self._complete(prompt, system_prompt, preferred_provider, history, **fitted)
+
+        prompt = normalize_prompt(prompt)
+        key = self._cache_key(prompt, system_prompt, preferred_provider, history, kwargs)
+        if fitted is not kwargs:
+            cached = await response_cache.get(key)
+            if cached is not None:
+                return cached
+            return await self._complete(prompt, system_prompt, preferred_provider, history, **fitted)
+        return await response_cache.get_or_compute(
+            key, lambda: self._complete(prompt, system_prompt, preferred_provider, history, **kwargs)
+        )
+
+    async def _complete(
+        self,
+        prompt: str,
+        system_prompt: Optional[str] = None,
+        preferred_provider: Optional[str] = None,
+        history: Optional[List[Dict[str, str]]] = None,
+        **kwargs
+    ) -> Dict[str, Any]:
+        """
+        Send a single chat completion request through the provider router,
+        queued fairly against other clients and charged to the caller
+        """
+        async with dispatch_slot():
+            response = await self.router.complete(
+                _build_messages(prompt, system_prompt, history),
+                preferred=preferred_provider,
                 **kwargs
             )
-            
-            return {
-                "provider": "openai",
-                "response": response,
+        usage = response.get("usage") or {}
+        charge_tokens(usage.get("total_tokens") or estimate_tokens(prompt) + estimate_tokens(response["content"]))
+        return {**response, "success": True}
+
+    async def stream_response(
+        self,
+        prompt: str,
+        system_prompt: Optional[str] = None,
+        preferred_provider: Optional[str] = None,
+        use_cache: bool = True,
+        history: Optional[List[Dict[str, str]]] = None,
+        **kwargs
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Stream a response token by token. A cached completion is replayed as a
+        single chunk, and a completed stream populates the cache unless it
+        was shortened to fit the request's deadline.
+
+        Args:
+            prompt: The user prompt
+            system_prompt: Optional system message sent before the prompt
+            preferred_provider: Provider to try first when it is healthy
+            use_cache: Whether to read and populate the response cache
+            history: Earlier user/assistant turns sent before the prompt
+            **kwargs: Extra completion parameters (max_tokens, temperature, model, ...)
+
+        Yields:
+            Dicts with the provider name and the next text delta
+        """
+        self._check_providers()
+        check_deadline("prompt")
+        fitted = fit_completion(kwargs)
+
+        key = None
+        if use_cache and response_cache is not None:
+            prompt = normalize_prompt(prompt)
+            key = self._cache_key(prompt, system_prompt, preferred_provider, history, kwargs)
+            cached = await response_cache.get(key)
+            if cached is not None:
+                yield {"provider": cached["provider"], "delta": cached["content"]}
+                return
+            if fitted is not kwargs:
+                key = None
+
+        provider = None
+        parts = []
+        async with dispatch_slot():
+            async for provider, delta in self.router.stream(
+                _build_messages(prompt, system_prompt, history),
+                preferred=preferred_provider,
+                **fitted
+            ):
+                parts.append(delta)
+                yield {"provider": provider, "delta": delta}
+        # Streams carry no usage, so charge an estimate
+        charge_tokens(estimate_tokens(prompt) + estimate_tokens("".join(parts)))
+
+        if key is not None and provider is not None:
+            await response_cache.set(key, {
+                "provider": provider,
+                "content": "".join(parts),
+                "usage": None,
                 "success": True
-            }
-        except Exception as e:
-            raise Exception(f"OpenAI request failed: {str(e)}")
+            })
 
     def get_available_providers(self) -> list[str]:
         """
         Return list of available AI providers
         """
-        return ["openai"] if self.provider is not None else []
+        return list(self.providers)
+
+    def get_provider_health(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Return rolling latency, error rate and circuit state per provider
+        """
+        return self.router.snapshot()
+
+    async def aclose(self) -> None:
+        """
+        Close the shared HTTP connection pool, if it was ever opened
+        """
+        if self._http_client is not None:
+            await self._http_client.aclose()
 
 # Create a singleton instance
-ai_service = AIService() 
\ No newline at end of file
+ai_service = AIService()
@@ -0,0 +1,285 @@
+from typing import Optional, Dict, Any, Awaitable, Callable, List, Tuple
+from collections import OrderedDict
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from services.deadline import DeadlineExceeded
+
+CACHE_ENABLED = os.getenv("CACHE_ENABLED", "true").lower() == "true"
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "1024"))
+CACHE_TTL_SECONDS = float(os.getenv("CACHE_TTL_SECONDS", "86400"))
+CACHE_DB_PATH = os.getenv("CACHE_DB_PATH", "data/response_cache.sqlite3")
+CACHE_MAX_DB_MB = float(os.getenv("CACHE_MAX_DB_MB", "256"))
+
+
+def make_cache_key(
+    prompt: str,
+    model: Optional[str],
+    temperature: Optional[float],
+    max_tokens: Optional[int],
+    system_prompt: Optional[str] = None,
+    preferred_provider: Optional[str] = None,
+    history: Optional[List[Dict[str, str]]] = None
+) -> str:
+    """
+    Build a stable cache key for a completion request
+
+    Args:
+        prompt: The normalized prompt
+        model: The model name
+        temperature: Sampling temperature
+        max_tokens: Completion token limit
+        system_prompt: Optional system message
+        preferred_provider: Provider the caller asked for, if any
+        history: Earlier conversation turns sent before the prompt
+
+    Returns:
+        A hex SHA-256 digest
+    """
+    payload = json.dumps(
+        [prompt, system_prompt, model, temperature, max_tokens, preferred_provider, history or None],
+        separators=(",", ":")
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _gave_up(future: asyncio.Future) -> bool:
+    """
+    Whether a coalesced computation ended for reasons of its own caller
+    (cancellation or deadline) rather than with a result or a real error
+    """
+    if not future.done():
+        return False
+    return future.cancelled() or isinstance(future.exception(), DeadlineExceeded)
+
+
+class SQLiteStore:
+    """
+    Persistent cache tier backed by a single SQLite file.
+    All methods are blocking and are run in a worker thread by ResponseCache.
+    """
+
+    def __init__(self, path: str, ttl: float, max_bytes: int):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        # The file is shared by every worker process; wait out their write locks
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at)")
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > self.ttl:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+            self._conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def set(self, key: str, value: Dict[str, Any]) -> int:
+        """
+        Store a value and enforce the size limit
+
+        Returns:
+            The number of rows evicted
+        """
+        data = json.dumps(value)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, data, len(data), now, now)
+            )
+            return self._evict(now)
+
+    def _evict(self, now: float) -> int:
+        evicted = self._conn.execute(
+            "DELETE FROM responses WHERE created_at < ?", (now - self.ttl,)
+        ).rowcount
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        while total > self.max_bytes:
+            # Drop the least recently used tenth of the rows until we fit again
+            count = max(1, self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0] // 10)
+            evicted += self._conn.execute(
+                "DELETE FROM responses WHERE key IN "
+                "(SELECT key FROM responses ORDER BY accessed_at LIMIT ?)",
+                (count,)
+            ).rowcount
+            total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        return evicted
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+
+class ResponseCache:
+    """
+    Two-tier response cache: a bounded in-memory LRU in front of a
+    persistent SQLite store, with single-flight deduplication of
+    concurrent identical requests.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = CACHE_MAX_ENTRIES,
+        ttl: float = CACHE_TTL_SECONDS,
+        db_path: Optional[str] = CACHE_DB_PATH,
+        max_db_bytes: int = int(CACHE_MAX_DB_MB * 1024 * 1024)
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._memory: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._disk = SQLiteStore(db_path, ttl, max_db_bytes) if db_path else None
+        self._stats = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "coalesced": 0,
+            "evictions": 0
+        }
+
+    def _memory_get(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self._memory.get(key)
+        if entry is None:
+            return None
+        created_at, value = entry
+        if time.time() - created_at > self.ttl:
+            del self._memory[key]
+            return None
+        self._memory.move_to_end(key)
+        return value
+
+    def _memory_set(self, key: str, value: Dict[str, Any]) -> None:
+        self._memory[key] = (time.time(), value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    async def _disk_get(self, key: str) -> Optional[Dict[str, Any]]:
+        if self._disk is None:
+            return None
+        value = await asyncio.to_thread(self._disk.get, key)
+        if value is not None:
+            self._stats["disk_hits"] += 1
+            self._memory_set(key, value)
+        return value
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """
+        Look a key up in memory first, then on disk (promoting disk hits)
+        """
+        value = self._memory_get(key)
+        if value is not None:
+            self._stats["memory_hits"] += 1
+            return value
+        value = await self._disk_get(key)
+        if value is None:
+            self._stats["misses"] += 1
+        return value
+
+    async def set(self, key: str, value: Dict[str, Any]) -> None:
+        self._memory_set(key, value)
+        if self._disk is not None:
+            self._stats["evictions"] += await asyncio.to_thread(self._disk.set, key, value)
+
+    async def get_or_compute(
+        self,
+        key: str,
+        factory: Callable[[], Awaitable[Dict[str, Any]]]
+    ) -> Dict[str, Any]:
+        """
+        Return the cached value for key, or compute it exactly once
+
+        Args:
+            key: Cache key from make_cache_key
+            factory: Coroutine function producing the value on a miss
+
+        Returns:
+            The cached or freshly computed value
+        """
+        value = self._memory_get(key)
+        if value is not None:
+            self._stats["memory_hits"] += 1
+            return value
+
+        # Register as the leader before touching the disk so that identical
+        # requests arriving meanwhile wait on us instead of racing upstream
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self._stats["coalesced"] += 1
+            try:
+                return await asyncio.shield(inflight)
+            except (asyncio.CancelledError, DeadlineExceeded):
+                # The leader's client went away or ran out of time, which says
+                # nothing about this request: compute it ourselves instead
+                if asyncio.current_task().cancelling() or not _gave_up(inflight):
+                    raise
+                return await self.get_or_compute(key, factory)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await self._disk_get(key)
+            if value is None:
+                self._stats["misses"] += 1
+                value = await factory()
+                await self.set(key, value)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved in case nobody else was waiting
+            future.exception()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+        future.set_result(value)
+        return value
+
+    async def stats(self) -> Dict[str, Any]:
+        """
+        Return hit / miss / coalesce counters and current tier sizes
+        """
+        lookups = self._stats["memory_hits"] + self._stats["disk_hits"] + self._stats["misses"]
+        hits = self._stats["memory_hits"] + self._stats["disk_hits"]
+        return {
+            **self._stats,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            "memory_entries": len(self._memory),
+            "disk_entries": await asyncio.to_thread(self._disk.count) if self._disk else 0,
+            "inflight": len(self._inflight)
+        }
+
+# Create a singleton instance
+response_cache = ResponseCache() if CACHE_ENABLED else None
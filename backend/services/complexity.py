@@ -0,0 +1,479 @@
+from typing import Optional, Dict, Any, List, Tuple
+import ast
+import asyncio
+import json
+import math
+import os
+import re
+import shlex
+import shutil
+import signal
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# Off by default: it runs submitted code, which needs the OS sandbox below
+COMPLEXITY_VERIFY_ENABLED = os.getenv("COMPLEXITY_VERIFY_ENABLED", "false").lower() == "true"
+# Command prefix that runs the benchmark isolated (e.g. an nsjail or container
+# invocation); empty means bubblewrap with the options in _bwrap_command
+COMPLEXITY_SANDBOX_COMMAND = shlex.split(os.getenv("COMPLEXITY_SANDBOX_COMMAND", ""))
+# Interpreter inside the sandbox, for commands that bring their own runtime
+COMPLEXITY_SANDBOX_PYTHON = os.getenv("COMPLEXITY_SANDBOX_PYTHON") or os.path.realpath(sys.executable)
+# Unprivileged user (and group) the code runs as inside bubblewrap
+COMPLEXITY_SANDBOX_UID = int(os.getenv("COMPLEXITY_SANDBOX_UID", "65534"))
+# Parallel benchmark subprocesses; defaults to one per core
+COMPLEXITY_WORKERS = int(os.getenv("COMPLEXITY_WORKERS", str(os.cpu_count() or 2)))
+COMPLEXITY_RUN_TIMEOUT = float(os.getenv("COMPLEXITY_RUN_TIMEOUT", "10"))
+COMPLEXITY_MEMORY_MB = int(os.getenv("COMPLEXITY_MEMORY_MB", "512"))
+COMPLEXITY_MAX_SIZE = int(os.getenv("COMPLEXITY_MAX_SIZE", "4096"))
+
+# Input sizes for sequence inputs (geometric) and integer-only inputs such
+# as fib(n) (linear, so exponential growth stays measurable)
+SEQUENCE_SIZES = [2 ** p for p in range(6, 20) if 2 ** p <= COMPLEXITY_MAX_SIZE]
+INTEGER_SIZES = [8, 12, 16, 20, 24, 28]
+
+# Candidate growth curves, simplest first
+MODELS = [
+    ("O(1)", lambda n: 1.0),
+    ("O(log n)", lambda n: math.log2(n)),
+    ("O(n)", lambda n: float(n)),
+    ("O(n log n)", lambda n: n * math.log2(n)),
+    ("O(n^2)", lambda n: float(n) ** 2),
+    ("O(n^3)", lambda n: float(n) ** 3),
+    ("O(2^n)", lambda n: 2.0 ** n),
+]
+
+_INT_NAMES = {"n", "m", "num", "count", "size", "length", "limit", "steps", "depth"}
+_SCALAR_NAMES = {"k", "target", "x", "key", "value", "val", "goal", "total"}
+_STR_NAMES = {"s", "t", "text", "string", "word", "pattern", "sentence"}
+_GRAPH_NAMES = {"graph", "adj", "adjacency", "adj_list", "neighbors"}
+_MATRIX_NAMES = {"matrix", "grid", "board", "mat"}
+
+# Failures are reported as one of these codes, never as the child's own
+# output, which the submitted code controls
+ERROR_NOTES = {
+    "load_failed": "The code could not be loaded or its entry point was not found",
+    "raised": "The code raised an exception on a generated input",
+    "out_of_memory": f"The code exceeded the {COMPLEXITY_MEMORY_MB} MB memory limit",
+    "recursion_limit": "The code exceeded the recursion limit",
+    "crashed": "The benchmark process crashed",
+    "invalid_output": "The benchmark did not report a valid result",
+    "sandbox_failed": "The benchmark sandbox could not be started",
+}
+HARNESS_FAILED = 3
+_DIGEST = re.compile(r"^[0-9a-f]{64}$")
+
+# Runs inside the sandboxed subprocess. Reads a JSON job from stdin and
+# prints the best per-call time and a hash of the output. The audit hook is
+# only a second line of defence; the isolation comes from the OS sandbox.
+HARNESS = r'''
+import copy, hashlib, json, os, random, string, sys, time
+
+BLOCKED = ("socket.", "subprocess.", "os.system", "os.exec", "os.spawn", "os.fork", "os.posix_spawn",
+           "os.kill", "os.remove", "os.unlink", "os.rmdir", "os.rename", "shutil.", "ctypes.")
+
+def audit(event, args):
+    if event.startswith(BLOCKED) or (event == "open" and args[1] not in (None, "r", "rb") and isinstance(args[0], str)):
+        raise PermissionError(f"{event} is not allowed in the benchmark sandbox")
+
+def fail(code):
+    print(json.dumps({"error": code}), flush=True)
+    os._exit(3)
+
+def failure(error):
+    if isinstance(error, MemoryError):
+        return "out_of_memory"
+    if isinstance(error, RecursionError):
+        return "recursion_limit"
+    return "raised"
+
+def generate(kind, n, rng):
+    if kind == "int_n":
+        return n
+    if kind == "int":
+        return rng.randint(0, max(1, n))
+    if kind == "float":
+        return rng.random() * n
+    if kind == "str":
+        return "".join(rng.choice(string.ascii_lowercase[:8]) for _ in range(n))
+    if kind == "list_str":
+        return ["".join(rng.choice(string.ascii_lowercase) for _ in range(6)) for _ in range(n)]
+    if kind == "dict":
+        return {i: rng.randint(0, n) for i in range(n)}
+    if kind == "graph":
+        return {i: sorted({rng.randrange(n) for _ in range(2)} - {i}) for i in range(n)}
+    if kind == "matrix":
+        side = max(1, int(n ** 0.5))
+        return [[rng.randint(0, 9) for _ in range(side)] for _ in range(side)]
+    # Distinct values, so early exits on duplicates do not hide the worst case
+    return rng.sample(range(4 * n), n)
+
+def canonical(value):
+    if isinstance(value, (set, frozenset)):
+        return sorted(canonical(v) for v in value)
+    if isinstance(value, dict):
+        return sorted((repr(canonical(k)), canonical(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [canonical(v) for v in value]
+    if hasattr(value, "__iter__") and not isinstance(value, (str, bytes)):
+        return [canonical(v) for v in value]
+    if isinstance(value, float):
+        return round(value, 9)
+    return value
+
+job = json.loads(sys.stdin.read())
+namespace = {"__name__": "__benchmark__"}
+sys.setrecursionlimit(10000)
+sys.addaudithook(audit)
+try:
+    exec(compile(job["code"], "<submitted>", "exec"), namespace)
+    cls, _, method = job["entry"].rpartition(".")
+    func = getattr(namespace[cls](), method) if cls else namespace[method]
+except BaseException as error:
+    fail("out_of_memory" if isinstance(error, MemoryError) else "load_failed")
+
+def timed(calls):
+    # Copy inputs up front so in-place algorithms always see fresh data
+    batch = [copy.deepcopy(args) for _ in range(calls)]
+    t0 = time.perf_counter()
+    for call_args in batch:
+        result = func(*call_args)
+    return (time.perf_counter() - t0) / calls, result, batch[-1]
+
+try:
+    rng = random.Random(job["seed"])
+    args = [generate(kind, job["n"], rng) for kind in job["kinds"]]
+    # Batch fast calls so each sample is well above timer noise
+    first, result, call_args = timed(1)
+    calls = max(1, min(1000, int(0.002 / max(first, 1e-7))))
+    best = first
+    rounds = 1
+    started = time.perf_counter()
+    while rounds < 3 or (time.perf_counter() - started < 0.2 and rounds < 20):
+        elapsed, result, call_args = timed(calls)
+        best = min(best, elapsed)
+        rounds += 1
+
+    # In-place algorithms return None: compare the mutated arguments instead
+    observed = canonical(call_args if result is None else result)
+    digest = hashlib.sha256(repr(observed).encode()).hexdigest()
+except BaseException as error:
+    fail(failure(error))
+print(json.dumps({"time": best, "rounds": rounds, "output": digest}))
+'''
+
+
+def _arg_kind(arg: ast.arg) -> str:
+    annotation = ast.unparse(arg.annotation).lower() if arg.annotation is not None else ""
+    name = arg.arg.lower()
+    if annotation:
+        if any(t in annotation for t in ("list", "sequence", "iterable", "tuple")):
+            return "list_str" if "str" in annotation else "list"
+        if "dict" in annotation or "mapping" in annotation:
+            return "graph" if name in _GRAPH_NAMES else "dict"
+        if annotation == "str":
+            return "str"
+        if annotation == "float":
+            return "float"
+        if annotation == "int":
+            return "int" if name in _SCALAR_NAMES else "int_n"
+    if name in _INT_NAMES:
+        return "int_n"
+    if name in _SCALAR_NAMES:
+        return "int"
+    if name in _STR_NAMES:
+        return "str"
+    if name in _GRAPH_NAMES:
+        return "graph"
+    if name in _MATRIX_NAMES:
+        return "matrix"
+    return "list"
+
+
+def _functions(tree: ast.Module) -> Dict[str, List[str]]:
+    """
+    Top-level functions and methods of top-level classes (as Class.method),
+    mapped to their argument kinds
+    """
+    found = {}
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef) and not node.name.startswith("_"):
+            found[node.name] = [_arg_kind(a) for a in node.args.args]
+        elif isinstance(node, ast.ClassDef):
+            for item in node.body:
+                if isinstance(item, ast.FunctionDef) and not item.name.startswith("_"):
+                    found[f"{node.name}.{item.name}"] = [_arg_kind(a) for a in item.args.args[1:]]
+    return {name: kinds for name, kinds in found.items() if kinds}
+
+
+def find_entry_points(original: str, optimized: str) -> Tuple[str, str, List[str]]:
+    """
+    Pick the function to benchmark in each version: a function present in
+    both under the same name, else the first function of each with the
+    same number of arguments
+
+    Returns:
+        (original entry, optimized entry, argument kinds)
+
+    Raises:
+        ValueError: If the code does not parse or no comparable function exists
+    """
+    try:
+        before = _functions(ast.parse(original))
+        after = _functions(ast.parse(optimized))
+    except SyntaxError as e:
+        raise ValueError(f"Code does not parse: {e.msg} (line {e.lineno})")
+    for name, kinds in before.items():
+        if name in after and len(after[name]) == len(kinds):
+            return name, name, kinds
+    for name, kinds in before.items():
+        for other, other_kinds in after.items():
+            if len(other_kinds) == len(kinds):
+                return name, other, kinds
+    raise ValueError("No function with matching arguments found in both versions")
+
+
+def _limit_resources() -> None:
+    cpu = int(COMPLEXITY_RUN_TIMEOUT) + 1
+    memory = COMPLEXITY_MEMORY_MB * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_CPU, (cpu, cpu))
+    resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+    resource.setrlimit(resource.RLIMIT_FSIZE, (0, 0))
+    resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+    resource.setrlimit(resource.RLIMIT_NOFILE, (64, 64))
+
+
+def _runtime_paths() -> List[str]:
+    """
+    Directories the interpreter needs to start: its installation and the
+    system libraries it links against
+    """
+    paths = {sys.base_prefix, os.path.dirname(os.path.dirname(COMPLEXITY_SANDBOX_PYTHON))}
+    paths.update(("/lib", "/lib64", "/usr/lib", "/usr/lib64", "/etc/ld.so.cache"))
+    return sorted(p for p in paths if os.path.exists(p))
+
+
+def _bwrap_command(workdir: str) -> List[str]:
+    """
+    Bubblewrap invocation: new user, PID, network, IPC and mount namespaces,
+    an unprivileged uid with no capabilities, a private /proc that shows only
+    the sandbox, and nothing on the filesystem but the Python runtime
+    (read-only) and an empty scratch directory
+    """
+    command = [
+        "bwrap", "--unshare-all", "--unshare-user", "--disable-userns", "--die-with-parent", "--new-session",
+        "--clearenv", "--uid", str(COMPLEXITY_SANDBOX_UID), "--gid", str(COMPLEXITY_SANDBOX_UID),
+        "--cap-drop", "ALL", "--hostname", "sandbox",
+    ]
+    for path in _runtime_paths():
+        command += ["--ro-bind", path, path]
+    command += ["--proc", "/proc", "--dev", "/dev", "--bind", workdir, "/sandbox", "--chdir", "/sandbox", "--"]
+    return command
+
+
+def sandbox_command(workdir: str) -> Optional[List[str]]:
+    """
+    The command prefix that isolates a benchmark run, or None when no
+    sandbox is available (verification is then skipped, never run bare)
+    """
+    if COMPLEXITY_SANDBOX_COMMAND:
+        return COMPLEXITY_SANDBOX_COMMAND
+    if shutil.which("bwrap") is None:
+        return None
+    return _bwrap_command(workdir)
+
+
+def sandbox_available() -> bool:
+    return bool(COMPLEXITY_SANDBOX_COMMAND) or shutil.which("bwrap") is not None
+
+
+def _result(returncode: int, stdout: bytes) -> Dict[str, Any]:
+    """
+    Map the harness's exit status and output to a result or an error code
+    """
+    if returncode < 0:
+        return {"error": "timeout" if -returncode in (signal.SIGXCPU, signal.SIGKILL) else "crashed"}
+    try:
+        report = json.loads(stdout.decode().strip().splitlines()[-1])
+    except (ValueError, IndexError):
+        return {"error": "sandbox_failed" if returncode not in (0, HARNESS_FAILED) else "invalid_output"}
+    if not isinstance(report, dict):
+        return {"error": "invalid_output"}
+    if returncode == HARNESS_FAILED:
+        return {"error": report["error"] if report.get("error") in ERROR_NOTES else "invalid_output"}
+    valid = (
+        returncode == 0
+        and isinstance(report.get("time"), (int, float)) and report["time"] >= 0
+        and isinstance(report.get("rounds"), int)
+        and isinstance(report.get("output"), str) and _DIGEST.match(report["output"])
+    )
+    if not valid:
+        return {"error": "invalid_output"}
+    return {"time": float(report["time"]), "rounds": report["rounds"], "output": report["output"]}
+
+
+async def run_sandboxed(code: str, entry: str, kinds: List[str], n: int, seed: int = 0) -> Dict[str, Any]:
+    """
+    Time one call of entry on a generated input of size n in a
+    resource-limited Python subprocess inside the OS sandbox
+
+    Returns:
+        {"time": seconds, "rounds": int, "output": hash} or {"error": code},
+        with code "timeout" or a key of ERROR_NOTES
+    """
+    job = json.dumps({"code": code, "entry": entry, "kinds": kinds, "n": n, "seed": seed}).encode()
+    with tempfile.TemporaryDirectory() as workdir:
+        prefix = sandbox_command(workdir)
+        if prefix is None:
+            return {"error": "sandbox_failed"}
+        process = await asyncio.create_subprocess_exec(
+            *prefix, COMPLEXITY_SANDBOX_PYTHON, "-I", "-S", "-c", HARNESS,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+            cwd=workdir,
+            env={},
+            preexec_fn=_limit_resources
+        )
+        try:
+            stdout, _ = await asyncio.wait_for(process.communicate(job), timeout=COMPLEXITY_RUN_TIMEOUT)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            return {"error": "timeout"}
+        except asyncio.CancelledError:
+            process.kill()
+            await process.wait()
+            raise
+    return _result(process.returncode, stdout)
+
+
+def fit_complexity(samples: List[Tuple[int, float]]) -> Optional[Dict[str, Any]]:
+    """
+    Pick the growth curve f for which t / f(n) stays flattest across the
+    larger input sizes, where fixed call overhead no longer dominates
+
+    Args:
+        samples: (input size, seconds) pairs in increasing size
+
+    Returns:
+        {"complexity": label, "exponent": log-log slope} or None with fewer
+        than three samples
+    """
+    samples = [(n, t) for n, t in samples if t > 0]
+    if len(samples) >= 5:
+        samples = samples[len(samples) // 3:]
+    if len(samples) < 3:
+        return None
+    logs = [math.log(n) for n, _ in samples]
+
+    def slope(ys: List[float]) -> float:
+        mean_x = sum(logs) / len(logs)
+        mean_y = sum(ys) / len(ys)
+        return sum((x - mean_x) * (y - mean_y) for x, y in zip(logs, ys)) / sum((x - mean_x) ** 2 for x in logs)
+
+    times = [math.log(t) for _, t in samples]
+    best = None
+    for label, f in MODELS:
+        try:
+            residual = abs(slope([t - math.log(f(n)) for t, (n, _) in zip(times, samples)]))
+        except (OverflowError, ValueError):
+            continue
+        if best is None or residual < best[1]:
+            best = (label, residual)
+    return {"complexity": best[0] if best else None, "exponent": round(slope(times), 2)}
+
+
+# Shared by all verifications so that together they run at most
+# COMPLEXITY_WORKERS benchmarks; created on first use in the serving loop
+_workers: Optional[asyncio.Semaphore] = None
+_workers_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def _worker_slots() -> asyncio.Semaphore:
+    global _workers, _workers_loop
+    loop = asyncio.get_running_loop()
+    if _workers is None or _workers_loop is not loop:
+        _workers, _workers_loop = asyncio.Semaphore(COMPLEXITY_WORKERS), loop
+    return _workers
+
+
+async def verify_optimization(original: str, optimized: str, language: str) -> Dict[str, Any]:
+    """
+    Benchmark the original and optimized code across growing input sizes,
+    check that both produce the same outputs and fit their growth curves
+
+    Args:
+        original: Code submitted for optimization
+        optimized: Code returned by the model
+        language: Source language (only Python is measured)
+
+    Returns:
+        A verification report: verified flag, entry points, sizes, timings,
+        fitted complexities, speedup, output equality and notes
+    """
+    started = time.monotonic()
+    report: Dict[str, Any] = {"verified": False, "notes": []}
+    if not COMPLEXITY_VERIFY_ENABLED or resource is None or not sandbox_available():
+        report["notes"].append("Sandboxed verification is not available on this server")
+        return report
+    if language.lower() not in ("python", "py", "python3"):
+        report["notes"].append(f"Verification is only supported for Python, not {language}")
+        return report
+    try:
+        entry_before, entry_after, kinds = find_entry_points(original, optimized)
+    except ValueError as e:
+        report["notes"].append(str(e))
+        return report
+
+    sizes = INTEGER_SIZES if all(k in ("int_n", "int", "float") for k in kinds) else SEQUENCE_SIZES
+    report.update({"entry_point": entry_before, "argument_kinds": kinds, "sizes": sizes})
+    semaphore = _worker_slots()
+
+    async def measure(code: str, entry: str, n: int) -> Dict[str, Any]:
+        async with semaphore:
+            return await run_sandboxed(code, entry, kinds, n, seed=n)
+
+    runs = await asyncio.gather(
+        *[measure(original, entry_before, n) for n in sizes],
+        *[measure(optimized, entry_after, n) for n in sizes]
+    )
+    before, after = runs[:len(sizes)], runs[len(sizes):]
+
+    errors = {r["error"] for r in before + after if "error" in r and r["error"] != "timeout"}
+    report["notes"].extend(ERROR_NOTES[e] for e in sorted(errors))
+    for label, results in (("original", before), ("optimized", after)):
+        timed_out = [n for n, r in zip(sizes, results) if r.get("error") == "timeout"]
+        if timed_out:
+            report["notes"].append(f"The {label} code timed out for n >= {timed_out[0]}")
+
+    report["timings_before"] = [r.get("time") for r in before]
+    report["timings_after"] = [r.get("time") for r in after]
+    compared = [(n, b["output"], a["output"]) for n, b, a in zip(sizes, before, after) if "output" in b and "output" in a]
+    if compared:
+        mismatches = [n for n, b, a in compared if b != a]
+        report["outputs_match"] = not mismatches
+        if mismatches:
+            report["notes"].append(f"Outputs differ for n = {', '.join(map(str, mismatches))}")
+
+    fit_before = fit_complexity([(n, r["time"]) for n, r in zip(sizes, before) if "time" in r])
+    fit_after = fit_complexity([(n, r["time"]) for n, r in zip(sizes, after) if "time" in r])
+    report["measured_complexity_before"] = fit_before["complexity"] if fit_before else None
+    report["measured_complexity_after"] = fit_after["complexity"] if fit_after else None
+    report["exponent_before"] = fit_before["exponent"] if fit_before else None
+    report["exponent_after"] = fit_after["exponent"] if fit_after else None
+
+    # Speedup at the largest size both versions finished
+    both = [(b["time"], a["time"]) for b, a in zip(before, after) if "time" in b and "time" in a and a["time"] > 0]
+    if both:
+        report["speedup"] = round(both[-1][0] / both[-1][1], 2)
+        report["speedup_at"] = [n for n, b, a in zip(sizes, before, after) if "time" in b and "time" in a][-1]
+
+    report["verified"] = bool(compared) and fit_after is not None
+    report["elapsed_seconds"] = round(time.monotonic() - started, 2)
+    return report
@@ -0,0 +1,275 @@
+from typing import Optional, Dict, Any, Tuple
+from contextvars import ContextVar
+import asyncio
+import json
+import math
+import os
+import re
+import time
+from services import metrics
+
+DEADLINE_ENABLED = os.getenv("DEADLINE_ENABLED", "true").lower() == "true"
+# Client-supplied deadlines are clamped to this many seconds from now
+DEADLINE_MAX_SECONDS = float(os.getenv("DEADLINE_MAX_SECONDS", "600"))
+# Below this much remaining time completions are shortened (and moved to a fast model)
+DEADLINE_SHORT_SECONDS = float(os.getenv("DEADLINE_SHORT_SECONDS", "15"))
+# Rough decode speed used to size max_tokens to the time left
+DEADLINE_TOKENS_PER_SECOND = float(os.getenv("DEADLINE_TOKENS_PER_SECOND", "40"))
+# Time reserved for the request itself, parsing and the response
+DEADLINE_OVERHEAD_SECONDS = float(os.getenv("DEADLINE_OVERHEAD_SECONDS", "1.5"))
+DEADLINE_MIN_TOKENS = int(os.getenv("DEADLINE_MIN_TOKENS", "128"))
+
+
+def _route_default(name: str, default: str) -> Optional[float]:
+    value = float(os.getenv(name, default))
+    return value if value > 0 else None
+
+
+# Default deadline per path prefix; the longest matching prefix wins and
+# None means no deadline (long-lived job and event streams)
+ROUTE_DEADLINES: Dict[str, Optional[float]] = {
+    "/explain": _route_default("DEADLINE_EXPLAIN_SECONDS", "60"),
+    "/refactor": _route_default("DEADLINE_REFACTOR_SECONDS", "180"),
+    "/optimize": _route_default("DEADLINE_OPTIMIZE_SECONDS", "180"),
+    "/refactor/repository": None,
+    "/batch": None,
+    "/jobs": None,
+}
+
+DEADLINE_HEADER = "x-request-deadline"
+TIMEOUT_HEADER = "x-request-timeout"
+
+# Absolute time.monotonic() by which the current request must be answered
+_deadline: ContextVar[Optional[float]] = ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    """
+    Raised when the current request's deadline passed, or will pass before
+    a queued or upstream call could finish. Routers translate this into a 504.
+    """
+
+    def __init__(self, message: str = "Request deadline exceeded"):
+        super().__init__(message)
+
+
+def remaining() -> Optional[float]:
+    """
+    Seconds left until the current request's deadline, None without one
+    """
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def check_deadline(stage: str) -> None:
+    """
+    Raise DeadlineExceeded if the current request has run out of time
+
+    Args:
+        stage: Where the check happens, for the expired-work metric
+    """
+    left = remaining()
+    if left is not None and left <= 0:
+        metrics.deadline_expired.inc(stage=stage)
+        raise DeadlineExceeded()
+
+
+def bounded_timeout(timeout: float) -> Tuple[float, bool]:
+    """
+    Cap a queueing timeout at the time left
+
+    Returns:
+        (timeout, whether the deadline is what limits it)
+    """
+    left = remaining()
+    if left is None or left >= timeout:
+        return timeout, False
+    return max(left, 0.0), True
+
+
+def fit_completion(kwargs: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Shrink a completion to what can be generated before the deadline: a
+    lower max_tokens, and fast=True so providers switch to their fast
+    model. Returns kwargs itself when the deadline is not short.
+    """
+    left = remaining()
+    if left is None or left >= DEADLINE_SHORT_SECONDS:
+        return kwargs
+    affordable = max(DEADLINE_MIN_TOKENS, int((left - DEADLINE_OVERHEAD_SECONDS) * DEADLINE_TOKENS_PER_SECOND))
+    route = metrics.request_path()
+    fitted = {**kwargs, "fast": True}
+    metrics.deadline_adjustments.inc(route=route, adjustment="fast_model")
+    if kwargs.get("max_tokens") is None or kwargs["max_tokens"] > affordable:
+        fitted["max_tokens"] = affordable
+        metrics.deadline_adjustments.inc(route=route, adjustment="max_tokens")
+    return fitted
+
+
+_DURATION = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+
+
+def _parse_timeout(value: str) -> Optional[float]:
+    """
+    Parse a relative timeout such as "30", "30s", "1500ms" or "2m" into seconds
+    """
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    parts = _DURATION.findall(value)
+    if not parts:
+        return None
+    return sum(float(number) * units[unit] for number, unit in parts)
+
+
+def request_budget(path: str, headers: Dict[str, str]) -> Optional[float]:
+    """
+    Seconds the request may take: from X-Request-Timeout (relative) or
+    X-Request-Deadline (Unix time in seconds or milliseconds), else the
+    route default. Client values are clamped to DEADLINE_MAX_SECONDS.
+
+    Returns:
+        The budget in seconds, or None for no deadline
+    """
+    budget = None
+    if headers.get(TIMEOUT_HEADER):
+        budget = _parse_timeout(headers[TIMEOUT_HEADER].strip())
+    elif headers.get(DEADLINE_HEADER):
+        try:
+            at = float(headers[DEADLINE_HEADER])
+        except ValueError:
+            at = None
+        if at is not None:
+            # Browsers hand out Date.now() in milliseconds
+            budget = (at / 1000 if at > 1e11 else at) - time.time()
+    if budget is not None and math.isfinite(budget):
+        return min(budget, DEADLINE_MAX_SECONDS)
+
+    matches = [prefix for prefix in ROUTE_DEADLINES if path == prefix or path.startswith(prefix + "/")]
+    if not matches:
+        return None
+    return ROUTE_DEADLINES[max(matches, key=len)]
+
+
+class DeadlineMiddleware:
+    """
+    ASGI middleware that gives each request a deadline and cancels its
+    handler, and with it every upstream call awaiting on its behalf, when
+    the client disconnects or the deadline passes. A request that runs out
+    of time before responding gets a 504; one whose response already
+    started (a stream) is ended.
+
+    It is plain ASGI rather than an HTTP middleware because it has to keep
+    listening for http.disconnect while the handler is running.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not DEADLINE_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        headers = {key.decode("latin-1"): value.decode("latin-1") for key, value in scope["headers"]}
+        budget = request_budget(scope["path"], headers)
+        token = _deadline.set(time.monotonic() + budget if budget is not None else None)
+
+        # The listener is the only reader of the client's messages; the
+        # handler gets them through this queue. It is small so a body
+        # upload is still read no faster than the handler consumes it.
+        messages: asyncio.Queue = asyncio.Queue(maxsize=4)
+        disconnected = asyncio.Event()
+        response = {"started": False, "finished": False}
+
+        async def listen() -> None:
+            while True:
+                message = await receive()
+                if message["type"] == "http.disconnect":
+                    disconnected.set()
+                    return
+                await messages.put(message)
+
+        async def wrapped_receive():
+            if disconnected.is_set() and messages.empty():
+                return {"type": "http.disconnect"}
+            getter = asyncio.ensure_future(messages.get())
+            waiter = asyncio.ensure_future(disconnected.wait())
+            try:
+                await asyncio.wait((getter, waiter), return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                waiter.cancel()
+                if not getter.done():
+                    getter.cancel()
+            if getter.done() and not getter.cancelled():
+                return getter.result()
+            return {"type": "http.disconnect"}
+
+        async def wrapped_send(message) -> None:
+            if message["type"] == "http.response.start":
+                response["started"] = True
+            elif message["type"] == "http.response.body" and not message.get("more_body", False):
+                response["finished"] = True
+            await send(message)
+
+        handler = asyncio.create_task(self.app(scope, wrapped_receive, wrapped_send))
+        listener = asyncio.create_task(listen())
+        try:
+            waiting = {handler, listener}
+            reason = None
+            while handler in waiting:
+                left = remaining()
+                timeout = max(left, 0.0) if left is not None else None
+                done, _ = await asyncio.wait(waiting, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if handler in done:
+                    break
+                if not done:
+                    reason = "deadline"
+                    break
+                waiting.discard(listener)
+                # The client went away before the response was complete
+                if not response["finished"]:
+                    reason = "client_disconnect"
+                    break
+                waiting = {handler}
+
+            if reason is not None:
+                handler.cancel()
+                try:
+                    await handler
+                except asyncio.CancelledError:
+                    # Ours, unless this task was cancelled too
+                    if asyncio.current_task().cancelling():
+                        raise
+                metrics.cancelled_requests.inc(route=metrics.route_of(scope), reason=reason)
+                # Complete the response even for a client that is gone, so the
+                # outer middleware sees one (499 is nginx's "client closed request")
+                await self._finish(send, response, 504 if reason == "deadline" else 499)
+            else:
+                handler.result()
+        finally:
+            listener.cancel()
+            if not handler.done():
+                handler.cancel()
+            _deadline.reset(token)
+
+    @staticmethod
+    async def _finish(send, response: Dict[str, bool], status: int) -> None:
+        if response["finished"]:
+            return
+        if not response["started"]:
+            body = json.dumps({"detail": "Request deadline exceeded" if status == 504 else "Client closed request"})
+            body = body.encode("utf-8")
+            await send({
+                "type": "http.response.start",
+                "status": status,
+                "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]
+            })
+            await send({"type": "http.response.body", "body": body})
+        else:
+            # A stream cut short: end it instead of leaving it open
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
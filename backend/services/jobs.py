@@ -0,0 +1,531 @@
+from typing import Optional, Dict, Any, Awaitable, Callable, List, Tuple
+import asyncio
+import hashlib
+import hmac
+import ipaddress
+import json
+import logging
+import os
+import secrets
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from urllib.parse import urlsplit
+from fastapi import Request
+from services.admission import client_id
+
+JOBS_DB_PATH = os.getenv("JOBS_DB_PATH", "data/jobs.sqlite3")
+JOBS_WORKERS = int(os.getenv("JOBS_WORKERS", "4"))
+# Run workers inside the API process; set to false when running worker.py separately
+JOBS_RUN_IN_API = os.getenv("JOBS_RUN_IN_API", "true").lower() == "true"
+JOBS_MAX_ATTEMPTS = int(os.getenv("JOBS_MAX_ATTEMPTS", "3"))
+JOBS_RETRY_BACKOFF = float(os.getenv("JOBS_RETRY_BACKOFF", "2"))
+# A running job whose lease expires (worker crashed) is picked up again
+JOBS_LEASE_SECONDS = float(os.getenv("JOBS_LEASE_SECONDS", "300"))
+JOBS_POLL_INTERVAL = float(os.getenv("JOBS_POLL_INTERVAL", "0.5"))
+JOBS_RESULT_TTL_SECONDS = float(os.getenv("JOBS_RESULT_TTL_SECONDS", str(7 * 24 * 3600)))
+WEBHOOK_TIMEOUT = float(os.getenv("JOBS_WEBHOOK_TIMEOUT", "10"))
+WEBHOOK_ATTEMPTS = int(os.getenv("JOBS_WEBHOOK_ATTEMPTS", "3"))
+# Comma-separated hosts webhooks may target; empty allows any host that
+# resolves only to public addresses
+WEBHOOK_ALLOWED_HOSTS = {
+    host.strip().lower() for host in os.getenv("JOBS_WEBHOOK_ALLOWED_HOSTS", "").split(",") if host.strip()
+}
+
+TERMINAL_STATUSES = ("succeeded", "failed", "cancelled")
+# Carries the access token issued when a job is submitted (or ?token= where headers cannot be set)
+JOB_TOKEN_HEADER = "x-job-token"
+
+logger = logging.getLogger(__name__)
+
+
+class JobConflictError(Exception):
+    """
+    Raised when an idempotency key is reused with a different request
+    """
+
+
+class WebhookURLError(ValueError):
+    """
+    Raised when a webhook URL is not allowed, e.g. it points at an
+    internal address
+    """
+
+
+class PermanentJobError(Exception):
+    """
+    Raised by a job handler for failures that retrying cannot fix
+    (invalid payload, 4xx from the handler)
+    """
+
+
+# Job type -> coroutine taking (payload, job) and returning the JSON result
+JobHandler = Callable[[Dict[str, Any], Dict[str, Any]], Awaitable[Dict[str, Any]]]
+JOB_HANDLERS: Dict[str, JobHandler] = {}
+
+
+def register_job_handler(job_type: str, handler: JobHandler) -> None:
+    """
+    Register the coroutine that runs jobs of job_type
+
+    Args:
+        job_type: Job type, as submitted in POST /jobs
+        handler: Coroutine taking (payload, job) and returning a JSON-able dict
+    """
+    JOB_HANDLERS[job_type] = handler
+
+
+def check_webhook_url(url: str) -> None:
+    """
+    Make sure a webhook URL may be called: http(s), a host on
+    WEBHOOK_ALLOWED_HOSTS when that is set, and every address the host
+    resolves to public, so webhooks cannot reach loopback, private,
+    link-local (cloud metadata) or other internal networks. Blocks on DNS.
+
+    Raises:
+        WebhookURLError: If the URL is not allowed
+    """
+    try:
+        parts = urlsplit(url)
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+    except ValueError:
+        raise WebhookURLError("webhook_url is not a valid URL")
+    host = (parts.hostname or "").lower()
+    if parts.scheme not in ("http", "https") or not host:
+        raise WebhookURLError("webhook_url must be an http(s) URL with a host")
+    if WEBHOOK_ALLOWED_HOSTS and host not in WEBHOOK_ALLOWED_HOSTS:
+        raise WebhookURLError(f"webhook_url host {host} is not allowed")
+    try:
+        addresses = socket.getaddrinfo(host, port, proto=socket.IPPROTO_TCP)
+    except (socket.gaierror, UnicodeError):
+        raise WebhookURLError(f"webhook_url host {host} does not resolve")
+    for _, _, _, _, sockaddr in addresses:
+        address = ipaddress.ip_address(sockaddr[0].split("%")[0])
+        if isinstance(address, ipaddress.IPv6Address) and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        if not address.is_global or address.is_multicast:
+            raise WebhookURLError(f"webhook_url host {host} resolves to a non-public address")
+
+
+def request_hash(job_type: str, payload: Dict[str, Any]) -> str:
+    return hashlib.sha256(json.dumps([job_type, payload], sort_keys=True).encode()).hexdigest()
+
+
+_COLUMNS = (
+    "id", "type", "payload", "status", "attempts", "max_attempts", "idempotency_key", "request_hash",
+    "client", "webhook_url", "webhook_delivered", "result", "error", "progress",
+    "created_at", "updated_at", "run_after", "lease_until", "worker", "access_token"
+)
+
+
+class JobStore:
+    """
+    SQLite-backed job queue. Safe to share between the API process and any
+    number of worker processes: claims happen in an immediate transaction
+    and running jobs hold a lease that expires if their worker dies.
+    """
+
+    def __init__(self, path: str = JOBS_DB_PATH):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, type TEXT NOT NULL, payload TEXT NOT NULL, status TEXT NOT NULL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, max_attempts INTEGER NOT NULL, "
+            "idempotency_key TEXT UNIQUE, request_hash TEXT NOT NULL, client TEXT, "
+            "webhook_url TEXT, webhook_delivered INTEGER NOT NULL DEFAULT 0, "
+            "result TEXT, error TEXT, progress TEXT, "
+            "created_at REAL NOT NULL, updated_at REAL NOT NULL, run_after REAL NOT NULL, "
+            "lease_until REAL, worker TEXT, access_token TEXT)"
+        )
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")]
+        if "access_token" not in columns:
+            # Jobs queued before tokens were issued stay reachable by API-key and user clients only
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN access_token TEXT")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (status, run_after)")
+        self._lock = threading.Lock()
+        # Wakes in-process workers and subscribers without waiting for a poll
+        self._changed: Dict[str, List[asyncio.Event]] = {}
+
+    @staticmethod
+    def _row(row: Optional[tuple]) -> Optional[Dict[str, Any]]:
+        if row is None:
+            return None
+        job = dict(zip(_COLUMNS, row))
+        for key in ("payload", "result", "progress"):
+            if job[key] is not None:
+                job[key] = json.loads(job[key])
+        job["webhook_delivered"] = bool(job["webhook_delivered"])
+        return job
+
+    def _select(self, where: str, params: tuple) -> Optional[Dict[str, Any]]:
+        return self._row(self._conn.execute(f"SELECT {', '.join(_COLUMNS)} FROM jobs WHERE {where}", params).fetchone())
+
+    def _create(
+        self,
+        job_type: str,
+        payload: Dict[str, Any],
+        idempotency_key: Optional[str],
+        webhook_url: Optional[str],
+        client: Optional[str],
+        max_attempts: int
+    ) -> Tuple[Dict[str, Any], bool]:
+        digest = request_hash(job_type, payload)
+        now = time.time()
+        with self._lock:
+            if idempotency_key:
+                # Keys are per client, so one client cannot fetch another's job by guessing its key
+                idempotency_key = hashlib.sha256(f"{client}\n{idempotency_key}".encode()).hexdigest()
+                existing = self._select("idempotency_key = ?", (idempotency_key,))
+                if existing is not None:
+                    if existing["request_hash"] != digest:
+                        raise JobConflictError("Idempotency key was already used for a different request")
+                    return existing, False
+            job_id = uuid.uuid4().hex
+            self._conn.execute(
+                "INSERT INTO jobs (id, type, payload, status, max_attempts, idempotency_key, request_hash, "
+                "client, webhook_url, created_at, updated_at, run_after, access_token) "
+                "VALUES (?, ?, ?, 'queued', ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, job_type, json.dumps(payload), max_attempts, idempotency_key, digest,
+                 client, webhook_url, now, now, now, secrets.token_urlsafe(32))
+            )
+            return self._select("id = ?", (job_id,)), True
+
+    def _get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self._select("id = ?", (job_id,))
+
+    def _claim(self, worker: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT id FROM jobs WHERE (status = 'queued' AND run_after <= ?) "
+                    "OR (status = 'running' AND lease_until < ?) ORDER BY run_after LIMIT 1",
+                    (now, now)
+                ).fetchone()
+                if row is None:
+                    self._conn.execute("COMMIT")
+                    return None
+                self._conn.execute(
+                    "UPDATE jobs SET status = 'running', attempts = attempts + 1, worker = ?, "
+                    "lease_until = ?, updated_at = ? WHERE id = ?",
+                    (worker, now + JOBS_LEASE_SECONDS, now, row[0])
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            return self._select("id = ?", (row[0],))
+
+    def _update(self, job_id: str, where: str, params: tuple, **fields: Any) -> bool:
+        fields["updated_at"] = time.time()
+        for key in ("result", "progress"):
+            if key in fields and fields[key] is not None:
+                fields[key] = json.dumps(fields[key])
+        assignments = ", ".join(f"{key} = ?" for key in fields)
+        with self._lock:
+            cursor = self._conn.execute(
+                f"UPDATE jobs SET {assignments} WHERE id = ? AND {where}",
+                (*fields.values(), job_id, *params)
+            )
+        return cursor.rowcount > 0
+
+    def _release(self, job_id: str, worker: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'queued', attempts = MAX(attempts - 1, 0), lease_until = NULL, "
+                "run_after = ?, updated_at = ? WHERE id = ? AND status = 'running' AND worker = ?",
+                (now, now, job_id, worker)
+            )
+
+    def _purge(self) -> int:
+        with self._lock:
+            cursor = self._conn.execute(
+                "DELETE FROM jobs WHERE status IN ('succeeded', 'failed', 'cancelled') AND updated_at < ?",
+                (time.time() - JOBS_RESULT_TTL_SECONDS,)
+            )
+        return cursor.rowcount
+
+    def _notify(self, job_id: str) -> None:
+        for event in self._changed.get(job_id, []) + self._changed.get("*", []):
+            event.set()
+
+    async def create(
+        self,
+        job_type: str,
+        payload: Dict[str, Any],
+        idempotency_key: Optional[str] = None,
+        webhook_url: Optional[str] = None,
+        client: Optional[str] = None,
+        max_attempts: int = JOBS_MAX_ATTEMPTS
+    ) -> Tuple[Dict[str, Any], bool]:
+        """
+        Enqueue a job, or return the existing one for an idempotency key the
+        same client used before. Each job gets an access_token that the
+        submitter needs to read or cancel it.
+
+        Returns:
+            (job, created)
+
+        Raises:
+            JobConflictError: If the idempotency key belongs to a different request
+        """
+        job, created = await asyncio.to_thread(
+            self._create, job_type, payload, idempotency_key, webhook_url, client, max_attempts
+        )
+        if created:
+            self._notify("*")
+        return job, created
+
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return await asyncio.to_thread(self._get, job_id)
+
+    async def claim(self, worker: str) -> Optional[Dict[str, Any]]:
+        """
+        Take the oldest runnable job (queued, or running with an expired lease)
+        """
+        return await asyncio.to_thread(self._claim, worker)
+
+    async def heartbeat(self, job_id: str, worker: str) -> bool:
+        """
+        Extend the lease of a running job
+
+        Returns:
+            False if the job is no longer ours (cancelled or re-claimed)
+        """
+        return await asyncio.to_thread(
+            self._update, job_id, "status = 'running' AND worker = ?", (worker,),
+            lease_until=time.time() + JOBS_LEASE_SECONDS
+        )
+
+    async def set_progress(self, job_id: str, progress: Dict[str, Any]) -> None:
+        """
+        Record progress for a running job, visible to pollers and subscribers
+        """
+        await asyncio.to_thread(self._update, job_id, "status = 'running'", (), progress=progress)
+        self._notify(job_id)
+
+    async def complete(self, job_id: str, worker: str, result: Dict[str, Any]) -> bool:
+        done = await asyncio.to_thread(
+            self._update, job_id, "status = 'running' AND worker = ?", (worker,),
+            status="succeeded", result=result, error=None, lease_until=None
+        )
+        self._notify(job_id)
+        return done
+
+    async def fail(self, job_id: str, worker: str, error: str, retry_in: Optional[float] = None) -> bool:
+        """
+        Record a failed attempt: requeue after retry_in seconds, or mark the
+        job failed when retry_in is None
+        """
+        if retry_in is None:
+            fields = {"status": "failed", "error": error, "lease_until": None}
+        else:
+            fields = {"status": "queued", "error": error, "lease_until": None, "run_after": time.time() + retry_in}
+        done = await asyncio.to_thread(
+            self._update, job_id, "status = 'running' AND worker = ?", (worker,), **fields
+        )
+        self._notify(job_id)
+        return done
+
+    async def release(self, job_id: str, worker: str) -> None:
+        """
+        Hand a running job back to the queue without counting the attempt
+        (graceful worker shutdown)
+        """
+        await asyncio.to_thread(self._release, job_id, worker)
+        self._notify("*")
+
+    async def cancel(self, job_id: str) -> bool:
+        """
+        Cancel a job that has not finished yet
+        """
+        done = await asyncio.to_thread(
+            self._update, job_id, "status IN ('queued', 'running')", (), status="cancelled", lease_until=None
+        )
+        self._notify(job_id)
+        return done
+
+    async def mark_webhook_delivered(self, job_id: str) -> None:
+        await asyncio.to_thread(self._update, job_id, "1 = 1", (), webhook_delivered=1)
+
+    async def purge(self) -> int:
+        """
+        Delete finished jobs older than JOBS_RESULT_TTL_SECONDS
+        """
+        return await asyncio.to_thread(self._purge)
+
+    async def wait_for_change(self, job_id: str, timeout: float = JOBS_POLL_INTERVAL) -> None:
+        """
+        Sleep until this process changes the job ("*" for any new job) or
+        the timeout passes, whichever comes first. Changes made by other
+        processes are picked up by the caller's next poll.
+        """
+        event = asyncio.Event()
+        self._changed.setdefault(job_id, []).append(event)
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            waiters = self._changed[job_id]
+            waiters.remove(event)
+            if not waiters:
+                del self._changed[job_id]
+
+
+def can_access(job: Dict[str, Any], request: Request) -> bool:
+    """
+    Whether the request may see a job: it presents the job's access token,
+    or it comes from the API-key or user client that submitted it. An
+    address is never enough, since many users can share one.
+    """
+    token = request.headers.get(JOB_TOKEN_HEADER) or request.query_params.get("token")
+    if token and job["access_token"] and hmac.compare_digest(token.encode(), job["access_token"].encode()):
+        return True
+    client = client_id(request)
+    return not client.startswith("ip:") and job["client"] == client
+
+
+def public_job(job: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    The fields of a job returned to API clients
+    """
+    return {
+        key: job[key]
+        for key in ("id", "type", "status", "attempts", "max_attempts", "result", "error", "progress",
+                    "webhook_url", "webhook_delivered", "created_at", "updated_at")
+    }
+
+
+class JobWorker:
+    """
+    Pool of async workers that claim jobs from the store, run their
+    handlers, retry failures with exponential backoff and deliver webhooks
+    """
+
+    def __init__(self, store: JobStore, concurrency: int = JOBS_WORKERS):
+        self.store = store
+        self.concurrency = concurrency
+        self.name = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self._tasks: List[asyncio.Task] = []
+        self._stopping = False
+        # Created on the first webhook, so httpx is not imported at startup
+        self._http: Optional["httpx.AsyncClient"] = None
+
+    async def start(self) -> None:
+        self._stopping = False
+        self._tasks = [asyncio.create_task(self._loop(i)) for i in range(self.concurrency)]
+        self._tasks.append(asyncio.create_task(self._janitor()))
+
+    async def stop(self) -> None:
+        """
+        Stop claiming work; jobs still running are handed back to the queue
+        """
+        self._stopping = True
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+    async def _loop(self, index: int) -> None:
+        worker = f"{self.name}/{index}"
+        while not self._stopping:
+            job = await self.store.claim(worker)
+            if job is None:
+                await self.store.wait_for_change("*")
+                continue
+            await self._run(job, worker)
+
+    async def _janitor(self) -> None:
+        while not self._stopping:
+            removed = await self.store.purge()
+            if removed:
+                logger.info("Purged %d finished jobs", removed)
+            await asyncio.sleep(3600)
+
+    async def _heartbeat(self, job_id: str, worker: str, task: asyncio.Task) -> None:
+        while True:
+            await asyncio.sleep(JOBS_LEASE_SECONDS / 3)
+            if not await self.store.heartbeat(job_id, worker):
+                # Cancelled through the API (or re-claimed): stop working on it
+                task.cancel()
+                return
+
+    async def _run(self, job: Dict[str, Any], worker: str) -> None:
+        handler = JOB_HANDLERS.get(job["type"])
+        if handler is None:
+            await self.store.fail(job["id"], worker, f"Unknown job type: {job['type']}")
+            return
+        if job["attempts"] > job["max_attempts"]:
+            # Lease expired on the last attempt, e.g. the worker kept crashing
+            await self.store.fail(job["id"], worker, job["error"] or "Job exceeded its maximum attempts")
+            return
+
+        task = asyncio.create_task(handler(job["payload"], job))
+        heartbeat = asyncio.create_task(self._heartbeat(job["id"], worker, task))
+        try:
+            result = await task
+        except asyncio.CancelledError:
+            if self._stopping:
+                await self.store.release(job["id"], worker)
+                raise
+            # Cancelled through the API; the store already says so
+            return
+        except PermanentJobError as e:
+            await self.store.fail(job["id"], worker, str(e))
+        except Exception as e:
+            retry_in = None
+            if job["attempts"] < job["max_attempts"]:
+                retry_in = JOBS_RETRY_BACKOFF * 2 ** (job["attempts"] - 1)
+            await self.store.fail(job["id"], worker, str(e), retry_in)
+            if retry_in is not None:
+                return
+        else:
+            if not await self.store.complete(job["id"], worker, result):
+                return
+        finally:
+            heartbeat.cancel()
+            if not task.done():
+                task.cancel()
+
+        finished = await self.store.get(job["id"])
+        if finished is not None and finished["webhook_url"]:
+            await self._deliver_webhook(finished)
+
+    async def _deliver_webhook(self, job: Dict[str, Any]) -> None:
+        import httpx
+
+        if self._http is None:
+            # A redirect could point anywhere, including internal addresses
+            self._http = httpx.AsyncClient(timeout=WEBHOOK_TIMEOUT, follow_redirects=False)
+        for attempt in range(WEBHOOK_ATTEMPTS):
+            try:
+                # Checked again on delivery: the host may resolve elsewhere by now
+                await asyncio.to_thread(check_webhook_url, job["webhook_url"])
+            except WebhookURLError as e:
+                logger.warning("Webhook for job %s not sent: %s", job["id"], e)
+                return
+            try:
+                response = await self._http.post(job["webhook_url"], json=public_job(job))
+                if response.status_code < 300:
+                    await self.store.mark_webhook_delivered(job["id"])
+                    return
+            except httpx.HTTPError as e:
+                logger.warning("Webhook for job %s failed: %s", job["id"], e)
+            await asyncio.sleep(JOBS_RETRY_BACKOFF * 2 ** attempt)
+
+
+# Create a singleton instance
+job_store = JobStore()
@@ -0,0 +1,69 @@
+from typing import Any, AsyncIterator, Awaitable, Callable, List, Tuple, TypeVar
+import asyncio
+import os
+
+MAP_REDUCE_CONCURRENCY = int(os.getenv("MAP_REDUCE_CONCURRENCY", "4"))
+
+T = TypeVar("T")
+
+
+async def map_chunks(
+    chunks: List[str],
+    handler: Callable[[int, str], Awaitable[T]],
+    max_concurrency: int = MAP_REDUCE_CONCURRENCY
+) -> AsyncIterator[Tuple[int, T]]:
+    """
+    Run handler over every chunk with a bounded fan-out
+
+    Args:
+        chunks: The input chunks
+        handler: Coroutine function called with (index, chunk)
+        max_concurrency: Maximum number of chunks processed at once
+
+    Yields:
+        (index, result) pairs in completion order. If any chunk fails, the
+        remaining ones are cancelled and the error is raised.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def run(index: int, chunk: str) -> Tuple[int, T]:
+        async with semaphore:
+            return index, await handler(index, chunk)
+
+    tasks = [asyncio.create_task(run(i, chunk)) for i, chunk in enumerate(chunks)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def gather_chunks(
+    chunks: List[str],
+    handler: Callable[[int, str], Awaitable[T]],
+    max_concurrency: int = MAP_REDUCE_CONCURRENCY
+) -> List[T]:
+    """
+    Like map_chunks, but collect the results in chunk order
+    """
+    results: List[Any] = [None] * len(chunks)
+    async for index, result in map_chunks(chunks, handler, max_concurrency):
+        results[index] = result
+    return results
+
+
+def merge_values(values: List[str]) -> str:
+    """
+    Merge per-chunk scalar answers (e.g. complexities): identical values
+    collapse to one, different ones are listed in order
+    """
+    unique = list(dict.fromkeys(v for v in values if v))
+    return ", ".join(unique)
+
+
+def merge_lists(lists: List[List[str]]) -> List[str]:
+    """
+    Concatenate per-chunk lists, dropping duplicates but keeping order
+    """
+    return list(dict.fromkeys(item for items in lists for item in items))
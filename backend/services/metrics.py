@@ -0,0 +1,317 @@
+from typing import Optional, Dict, Any, Iterator, List, Tuple
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+import bisect
+import os
+import time
+
+SERVER_TIMING_ENABLED = os.getenv("METRICS_SERVER_TIMING", "true").lower() == "true"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+# Spans recorded during the current request, for the Server-Timing header
+_request_spans: ContextVar[Optional[List[Tuple[str, float]]]] = ContextVar("request_spans", default=None)
+# ASGI scope of the current request; routing adds the matched route to it
+_request_scope: ContextVar[Optional[Dict[str, Any]]] = ContextVar("request_scope", default=None)
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"] + self._samples()
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, labels)
+        self.values: Dict[Tuple[str, ...], float] = defaultdict(float)
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        self.values[self._key(labels)] += amount
+
+    def _samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labels, key)} {value}" for key, value in self.values.items()]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.values[self._key(labels)] -= amount
+
+    def set(self, value: float, **labels: str) -> None:
+        self.values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = LATENCY_BUCKETS
+    ):
+        super().__init__(name, documentation, labels)
+        self.buckets = buckets
+        self.counts: Dict[Tuple[str, ...], List[int]] = {}
+        self.sums: Dict[Tuple[str, ...], float] = defaultdict(float)
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        counts = self.counts.setdefault(key, [0] * (len(self.buckets) + 1))
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sums[key] += value
+
+    def _samples(self) -> List[str]:
+        lines = []
+        for key, counts in self.counts.items():
+            cumulative = 0
+            for bound, count in zip(list(self.buckets) + [float("inf")], counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {self.sums[key]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+# (name, type, help, labels, value) for values snapshotted at scrape time
+Sample = Tuple[str, str, str, Dict[str, str], float]
+
+
+class Registry:
+    """
+    Holds every metric and renders them, plus samples snapshotted from
+    other components (cache, parser), in the Prometheus text format
+    """
+
+    def __init__(self):
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self, samples: Optional[List[Sample]] = None) -> str:
+        """
+        Render all metrics in the Prometheus text exposition format
+
+        Args:
+            samples: Extra samples to append, grouped by metric name
+
+        Returns:
+            The exposition text
+        """
+        lines: List[str] = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        seen = set()
+        for name, kind, documentation, labels, value in samples or []:
+            if name not in seen:
+                lines += [f"# HELP {name} {documentation}", f"# TYPE {name} {kind}"]
+                seen.add(name)
+            lines.append(f"{name}{_format_labels(tuple(labels), tuple(labels.values()))} {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+http_request_duration = registry.register(Histogram(
+    "devlift_http_request_duration_seconds", "HTTP request latency by route", ("route", "method", "status")
+))
+http_in_flight = registry.register(Gauge(
+    "devlift_http_requests_in_flight", "HTTP requests currently being served"
+))
+provider_request_duration = registry.register(Histogram(
+    "devlift_provider_request_duration_seconds", "Upstream completion latency", ("provider", "mode")
+))
+provider_ttft = registry.register(Histogram(
+    "devlift_provider_time_to_first_token_seconds", "Time to first streamed token", ("provider",)
+))
+provider_queue_wait = registry.register(Histogram(
+    "devlift_provider_queue_wait_seconds", "Time spent waiting for a provider concurrency slot", ("provider",)
+))
+provider_in_flight = registry.register(Gauge(
+    "devlift_provider_requests_in_flight", "Upstream completions currently in flight", ("provider",)
+))
+provider_errors = registry.register(Counter(
+    "devlift_provider_errors_total", "Upstream errors by class", ("provider", "error")
+))
+tokens_total = registry.register(Counter(
+    "devlift_tokens_total", "Prompt and completion tokens reported by providers", ("provider", "kind")
+))
+admission_rejections = registry.register(Counter(
+    "devlift_admission_rejections_total", "Requests rejected by admission control", ("reason",)
+))
+admission_queue_wait = registry.register(Histogram(
+    "devlift_admission_queue_wait_seconds", "Time spent in the fair dispatch queue", ("priority",)
+))
+upstream_pacing = registry.register(Histogram(
+    "devlift_upstream_pacing_seconds", "Delay added to stay under upstream rate limits", ("provider",)
+))
+span_duration = registry.register(Histogram(
+    "devlift_span_duration_seconds", "Duration of traced request phases", ("route", "span")
+))
+rewrite_rules = registry.register(Counter(
+    "devlift_rewrite_rules_applied_total", "Local modernization rewrites applied by rule", ("rule",)
+))
+rewrite_outcomes = registry.register(Counter(
+    "devlift_rewrite_outcomes_total", "Refactor requests by how much was left for the model", ("outcome",)
+))
+session_rounds = registry.register(Counter(
+    "devlift_session_rounds_total", "Incremental session rounds by how they were answered", ("tool", "outcome")
+))
+cancelled_requests = registry.register(Counter(
+    "devlift_cancelled_requests_total", "Requests cancelled on client disconnect or deadline", ("route", "reason")
+))
+deadline_expired = registry.register(Counter(
+    "devlift_deadline_expired_total", "Work abandoned because the request deadline passed", ("stage",)
+))
+deadline_adjustments = registry.register(Counter(
+    "devlift_deadline_adjustments_total", "Completions shortened to fit the request deadline", ("route", "adjustment")
+))
+provider_cancelled = registry.register(Counter(
+    "devlift_provider_cancelled_total", "Upstream calls cancelled while in flight", ("provider", "mode")
+))
+
+
+def error_class(error: BaseException) -> str:
+    """
+    Classify an upstream error by HTTP status when available, else by type
+    """
+    cause = error.__cause__ or error.__context__ or error
+    status = getattr(cause, "status_code", None) or getattr(error, "status_code", None)
+    if status:
+        return f"http_{status}"
+    return type(cause).__name__
+
+
+def route_of(scope: Dict[str, Any]) -> str:
+    """
+    Route template a request matched ("/refactor/sessions/{session_id}"),
+    or "unmatched": raw paths would make label cardinality unbounded
+    """
+    return getattr(scope.get("route"), "path", "unmatched")
+
+
+def request_path() -> str:
+    """
+    Route template of the request being handled, empty outside of one
+    """
+    scope = _request_scope.get()
+    return route_of(scope) if scope is not None else ""
+
+
+def stats_samples(
+    name: str,
+    kind: str,
+    documentation: str,
+    values: Dict[str, Any],
+    label: str,
+    **labels: str
+) -> List[Sample]:
+    """
+    Turn a flat stats dict (e.g. cache counters) into samples, one per
+    numeric key, with the key as the value of label
+    """
+    return [
+        (name, kind, documentation, {**labels, label: key}, value)
+        for key, value in values.items()
+        if isinstance(value, (int, float)) and not isinstance(value, bool)
+    ]
+
+
+def record_usage(provider: str, usage: Optional[Dict[str, Any]]) -> None:
+    if not usage:
+        return
+    tokens_total.inc(usage.get("prompt_tokens") or 0, provider=provider, kind="prompt")
+    tokens_total.inc(usage.get("completion_tokens") or 0, provider=provider, kind="completion")
+    # Prompt prefix tokens served from the provider's prompt cache (OpenAI-style usage)
+    cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens")
+    if cached:
+        tokens_total.inc(cached, provider=provider, kind="cached_prompt")
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    """
+    Time a phase of request handling (prompt building, upstream call,
+    response parsing). The duration goes to the span histogram and, when
+    enabled, to the request's Server-Timing header.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        span_duration.observe(elapsed, route=request_path(), span=name)
+        spans = _request_spans.get()
+        if spans is not None:
+            spans.append((name, elapsed))
+
+
+def _server_timing(spans: List[Tuple[str, float]], total: float) -> str:
+    totals: Dict[str, float] = defaultdict(float)
+    for name, elapsed in spans:
+        totals[name] += elapsed
+    parts = [f"{name};dur={elapsed * 1000:.1f}" for name, elapsed in totals.items()]
+    parts.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(parts)
+
+
+async def metrics_middleware(request, call_next):
+    """
+    HTTP middleware recording per-route latency and in-flight counts and
+    adding a Server-Timing header built from the request's spans
+    """
+    if request.url.path == "/metrics":
+        return await call_next(request)
+
+    spans: List[Tuple[str, float]] = []
+    token = _request_spans.set(spans)
+    # The scope, not its path: the route is only known once routing has matched
+    scope_token = _request_scope.set(request.scope)
+    started = time.perf_counter()
+    http_in_flight.inc()
+    status = "500"
+    try:
+        response = await call_next(request)
+        status = str(response.status_code)
+        if SERVER_TIMING_ENABLED:
+            response.headers["Server-Timing"] = _server_timing(spans, time.perf_counter() - started)
+        return response
+    finally:
+        http_in_flight.dec()
+        http_request_duration.observe(
+            time.perf_counter() - started, route=route_of(request.scope), method=request.method, status=status
+        )
+        _request_spans.reset(token)
+        _request_scope.reset(scope_token)
@@ -1,7 +1,8 @@
 import os
 from typing import Optional
-from openai import OpenAI
+from openai import AsyncOpenAI
 import logging
+from services.ai_service import ai_service
 
 logger = logging.getLogger(__name__)
 
@@ -10,8 +11,9 @@ _openai_client = None
 
 def get_openai_client():
     """
-    Returns a singleton OpenAI client instance.
-    Creates the client if it doesn't exist yet.
+    Returns a singleton AsyncOpenAI client instance.
+    Creates the client if it doesn't exist yet. The client shares the
+    pooled HTTP connections of the AI service.
     """
     global _openai_client
     
@@ -22,13 +24,13 @@ def get_openai_client():
             # Use a dummy key for development if needed
             api_key = "dummy_key_for_development"
         
-        _openai_client = OpenAI(api_key=api_key)
+        _openai_client = AsyncOpenAI(api_key=api_key, http_client=ai_service.http_client)
     
     return _openai_client
 
 async def generate_completion(
     prompt: str, 
-    model: str = "gpt-4",
+    model: Optional[str] = None,
     temperature: float = 0.7,
     max_tokens: int = 2000
 ) -> Optional[str]:
@@ -37,27 +39,23 @@ async def generate_completion(
     
     Args:
         prompt: The prompt to send to OpenAI
-        model: The model to use
+        model: The model to use (defaults to the routed provider's model)
         temperature: Controls randomness (0-1)
         max_tokens: Maximum number of tokens to generate
         
     Returns:
         The generated text or None if an error occurred
     """
-    client = get_openai_client()
-    
     try:
-        response = client.chat.completions.create(
+        response = await ai_service.generate_response(
+            prompt=prompt,
+            system_prompt="You are DevLift, an AI assistant that helps developers with debugging, refactoring, and optimizing code.",
             model=model,
-            messages=[
-                {"role": "system", "content": "You are DevLift, an AI assistant that helps developers with debugging, refactoring, and optimizing code."},
-                {"role": "user", "content": prompt}
-            ],
             temperature=temperature,
             max_tokens=max_tokens
         )
         
-        return response.choices[0].message.content
+        return response["content"]
     except Exception as e:
         logger.error(f"Error generating OpenAI completion: {str(e)}")
-        return None 
\ No newline at end of file
+        return None
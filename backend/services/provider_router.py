@@ -0,0 +1,294 @@
+from typing import Optional, Dict, Any, AsyncIterator, List, Tuple
+from collections import deque
+import asyncio
+import os
+import time
+from services.providers import Provider, ProviderOverloadedError
+from services.deadline import DeadlineExceeded
+
+STATS_WINDOW = int(os.getenv("AI_STATS_WINDOW", "200"))
+HEDGE_ENABLED = os.getenv("AI_HEDGE_REQUESTS", "false").lower() == "true"
+HEDGE_DEFAULT_DELAY = float(os.getenv("AI_HEDGE_DEFAULT_DELAY", "2.0"))
+HEDGE_MIN_DELAY = float(os.getenv("AI_HEDGE_MIN_DELAY", "0.25"))
+BREAKER_FAILURES = int(os.getenv("AI_BREAKER_FAILURES", "5"))
+BREAKER_ERROR_RATE = float(os.getenv("AI_BREAKER_ERROR_RATE", "0.5"))
+BREAKER_COOLDOWN = float(os.getenv("AI_BREAKER_COOLDOWN", "30"))
+
+# Minimum number of samples before percentiles and error rates are trusted
+MIN_SAMPLES = 10
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class ProviderStats:
+    """
+    Rolling latency and error statistics for one provider
+    """
+
+    def __init__(self, window: int = STATS_WINDOW):
+        self.latencies: deque = deque(maxlen=window)
+        self.outcomes: deque = deque(maxlen=window)
+
+    def record(self, latency: Optional[float], success: bool) -> None:
+        if success and latency is not None:
+            self.latencies.append(latency)
+        self.outcomes.append(success)
+
+    def percentile(self, pct: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        return _percentile(list(self.latencies), pct)
+
+    @property
+    def error_rate(self) -> float:
+        if not self.outcomes:
+            return 0.0
+        return 1 - sum(self.outcomes) / len(self.outcomes)
+
+
+class CircuitBreaker:
+    """
+    Closed -> open after BREAKER_FAILURES consecutive failures or a windowed
+    error rate above BREAKER_ERROR_RATE; open -> half-open after the
+    cooldown, where a single probe request decides whether to close again.
+    """
+
+    def __init__(self):
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open" and time.monotonic() - self.opened_at >= BREAKER_COOLDOWN:
+            self.state = "half_open"
+        if self.state == "half_open" and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        return False
+
+    def available(self) -> bool:
+        """
+        Like allow() but without claiming the half-open probe
+        """
+        if self.state == "closed":
+            return True
+        if self.state == "open":
+            return time.monotonic() - self.opened_at >= BREAKER_COOLDOWN
+        return not self._probe_in_flight
+
+    def record_success(self) -> None:
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self._probe_in_flight = False
+
+    def record_failure(self, stats: ProviderStats) -> None:
+        self.consecutive_failures += 1
+        self._probe_in_flight = False
+        too_many = self.consecutive_failures >= BREAKER_FAILURES
+        error_rate_high = len(stats.outcomes) >= MIN_SAMPLES and stats.error_rate >= BREAKER_ERROR_RATE
+        if self.state == "half_open" or too_many or error_rate_high:
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def release_probe(self) -> None:
+        """
+        Give the half-open probe back when the attempt ended without a verdict
+        (cancelled hedge loser or local overload)
+        """
+        self._probe_in_flight = False
+
+
+class ProviderRouter:
+    """
+    Routes each request to the fastest healthy provider, with optional
+    hedging and failover to the next candidate on errors.
+    """
+
+    def __init__(self, providers: Dict[str, Provider]):
+        self.providers = providers
+        self.stats: Dict[str, ProviderStats] = {name: ProviderStats() for name in providers}
+        self.breakers: Dict[str, CircuitBreaker] = {name: CircuitBreaker() for name in providers}
+
+    def candidates(self, preferred: Optional[str] = None) -> List[Provider]:
+        """
+        Order providers by rolling p50 latency, healthy ones only, with the
+        preferred provider first when it is healthy. Providers without
+        samples sort first so they get explored; rate-limited ones last.
+        """
+        healthy = [p for p in self.providers.values() if self.breakers[p.name].available()]
+        # Providers paused by an upstream rate limit go last
+        healthy.sort(key=lambda p: (p.rate_limit.retry_after() is not None, self.stats[p.name].percentile(50) or 0.0))
+        if preferred:
+            healthy.sort(key=lambda p: p.name != preferred)
+        return healthy
+
+    def _hedge_delay(self, provider: Provider) -> float:
+        stats = self.stats[provider.name]
+        if len(stats.latencies) < MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY
+        return max(HEDGE_MIN_DELAY, stats.percentile(95))
+
+    def _record(self, provider: Provider, started: float, success: bool) -> None:
+        stats = self.stats[provider.name]
+        stats.record(time.monotonic() - started, success)
+        if success:
+            self.breakers[provider.name].record_success()
+        else:
+            self.breakers[provider.name].record_failure(stats)
+
+    async def _attempt(self, provider: Provider, messages: List[Dict[str, str]], **kwargs) -> Dict[str, Any]:
+        breaker = self.breakers[provider.name]
+        if not breaker.allow():
+            raise ProviderOverloadedError(f"{provider.name} circuit is open")
+        started = time.monotonic()
+        try:
+            result = await provider.complete(messages, **kwargs)
+        except (ProviderOverloadedError, DeadlineExceeded, asyncio.CancelledError):
+            breaker.release_probe()
+            raise
+        except Exception:
+            self._record(provider, started, False)
+            raise
+        self._record(provider, started, True)
+        return {"provider": provider.name, **result}
+
+    async def complete(
+        self,
+        messages: List[Dict[str, str]],
+        preferred: Optional[str] = None,
+        hedge: Optional[bool] = None,
+        **kwargs
+    ) -> Dict[str, Any]:
+        """
+        Run a completion on the best provider, failing over on errors
+
+        Args:
+            messages: Chat messages
+            preferred: Provider to try first when healthy
+            hedge: Send a backup request to the next provider if the first one
+                is slower than its p95 (defaults to AI_HEDGE_REQUESTS)
+            **kwargs: Completion parameters
+
+        Returns:
+            The completion dict with the name of the provider that answered
+        """
+        hedge = HEDGE_ENABLED if hedge is None else hedge
+        queue = self.candidates(preferred)
+        if not queue:
+            raise Exception("No healthy AI providers available. Configure at least one provider API key.")
+
+        last_error: Optional[BaseException] = None
+        pending: Dict[asyncio.Task, Provider] = {}
+
+        def launch() -> None:
+            provider = queue.pop(0)
+            task = asyncio.create_task(self._attempt(provider, messages, **kwargs))
+            pending[task] = provider
+
+        launch()
+        try:
+            while pending:
+                timeout = None
+                if hedge and queue and len(pending) == 1:
+                    timeout = self._hedge_delay(next(iter(pending.values())))
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # Primary is slower than its p95: hedge on the next provider
+                    launch()
+                    continue
+                for task in done:
+                    pending.pop(task)
+                    if task.exception() is None:
+                        return task.result()
+                    last_error = task.exception()
+                # Out of time: another provider cannot answer before the deadline either
+                if isinstance(last_error, DeadlineExceeded) and not pending:
+                    raise last_error
+                if not pending and queue:
+                    launch()
+        finally:
+            # Cancel the hedge loser (or everything, if we were cancelled)
+            for task in pending:
+                task.cancel()
+
+        raise last_error
+
+    async def stream(
+        self,
+        messages: List[Dict[str, str]],
+        preferred: Optional[str] = None,
+        **kwargs
+    ) -> AsyncIterator[Tuple[str, str]]:
+        """
+        Stream a completion from the best provider. Fails over to the next
+        provider if the stream errors before its first token; latency is
+        recorded as time to first token.
+
+        Yields:
+            (provider name, text delta) tuples
+        """
+        candidates = self.candidates(preferred)
+        if not candidates:
+            raise Exception("No healthy AI providers available. Configure at least one provider API key.")
+
+        last_error: Optional[BaseException] = None
+        for provider in candidates:
+            breaker = self.breakers[provider.name]
+            if not breaker.allow():
+                continue
+            started = time.monotonic()
+            deltas = provider.stream(messages, **kwargs)
+            try:
+                first = await deltas.__anext__()
+            except StopAsyncIteration:
+                first = None
+            except ProviderOverloadedError as e:
+                breaker.release_probe()
+                last_error = e
+                continue
+            except (DeadlineExceeded, asyncio.CancelledError):
+                breaker.release_probe()
+                raise
+            except Exception as e:
+                self._record(provider, started, False)
+                last_error = e
+                continue
+
+            self._record(provider, started, True)
+            if first is not None:
+                yield provider.name, first
+            try:
+                async for delta in deltas:
+                    yield provider.name, delta
+            except DeadlineExceeded:
+                raise
+            except Exception:
+                self.stats[provider.name].record(None, False)
+                self.breakers[provider.name].record_failure(self.stats[provider.name])
+                raise
+            return
+
+        raise last_error or ProviderOverloadedError("All AI providers are unavailable")
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Current latency, error rate and breaker state per provider
+        """
+        return {
+            name: {
+                "p50": self.stats[name].percentile(50),
+                "p95": self.stats[name].percentile(95),
+                "error_rate": round(self.stats[name].error_rate, 4),
+                "samples": len(self.stats[name].outcomes),
+                "circuit": self.breakers[name].state,
+                "in_flight": provider.in_flight
+            }
+            for name, provider in self.providers.items()
+        }
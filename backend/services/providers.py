@@ -0,0 +1,482 @@
+from typing import Optional, Dict, Any, AsyncIterator, Callable, List, Mapping, Tuple, TYPE_CHECKING
+import asyncio
+import os
+import re
+import time
+from services import metrics
+from services.deadline import DeadlineExceeded, remaining, bounded_timeout, check_deadline
+from services.shared_state import shared_state
+
+if TYPE_CHECKING:
+    import httpx
+
+MAX_CONCURRENCY = int(os.getenv("AI_MAX_CONCURRENCY", "100"))
+QUEUE_TIMEOUT = float(os.getenv("AI_QUEUE_TIMEOUT", "10"))
+MAX_RETRIES = int(os.getenv("AI_MAX_RETRIES", "1"))
+# Start pacing once less than this fraction of the upstream rate limit remains
+UPSTREAM_HEADROOM = float(os.getenv("AI_UPSTREAM_HEADROOM", "0.1"))
+
+
+class ProviderOverloadedError(Exception):
+    """
+    Raised when a request waited longer than the queue timeout for a
+    free provider slot, or the provider is rate limiting us. Routers
+    translate this into status_code (503), with Retry-After when
+    retry_after is known.
+    """
+    status_code = 503
+
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class ProviderError(Exception):
+    """
+    Raised when an upstream provider call fails
+    """
+
+    def __init__(self, provider: str, message: str):
+        super().__init__(f"{provider} request failed: {message}")
+        self.provider = provider
+
+
+class UpstreamRateLimit:
+    """
+    Paces dispatch to one provider from its x-ratelimit-* response headers:
+    pauses until the reset when a limit is exhausted and spaces requests
+    evenly over the reset window once less than UPSTREAM_HEADROOM of the
+    limit remains
+    """
+
+    _clock = staticmethod(time.monotonic)
+
+    def __init__(self, name: str):
+        self.name = name
+        self.interval = 0.0
+        self.next_at = 0.0
+        self.paused_until = 0.0
+        self.tokens_per_request = 1000.0
+
+    def update(self, headers: Mapping[str, str]) -> None:
+        now = self._clock()
+        intervals = [0.0]
+        paused_until = None
+        for kind, per_request in (("requests", 1.0), ("tokens", self.tokens_per_request)):
+            limit = _header_float(headers, f"x-ratelimit-limit-{kind}")
+            remaining = _header_float(headers, f"x-ratelimit-remaining-{kind}")
+            reset = parse_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+            if remaining is None or reset is None:
+                continue
+            if remaining < per_request:
+                paused_until = max(paused_until or 0.0, now + reset)
+            elif limit and remaining < limit * UPSTREAM_HEADROOM:
+                intervals.append(reset / (remaining / per_request))
+        self._set(max(intervals), paused_until)
+
+    def record_usage(self, usage: Optional[Dict[str, Any]]) -> None:
+        if usage and usage.get("total_tokens"):
+            self.tokens_per_request = 0.9 * self.tokens_per_request + 0.1 * usage["total_tokens"]
+
+    def pause(self, seconds: float) -> None:
+        self._set(paused_until=self._clock() + seconds)
+
+    def retry_after(self) -> Optional[float]:
+        remaining = self._paused_until() - self._clock()
+        return remaining if remaining > 0 else None
+
+    def _set(self, interval: Optional[float] = None, paused_until: Optional[float] = None) -> None:
+        if interval is not None:
+            self.interval = interval
+        if paused_until is not None:
+            self.paused_until = max(self.paused_until, paused_until)
+
+    def _paused_until(self) -> float:
+        return self.paused_until
+
+    def _reserve(self, now: float, max_wait: float) -> Tuple[float, bool]:
+        slot = max(now, self.next_at, self.paused_until)
+        if slot - now > max_wait:
+            return slot, False
+        self.next_at = slot + self.interval
+        return slot, True
+
+    async def wait(self) -> None:
+        """
+        Reserve the next dispatch time and sleep until it
+
+        Raises:
+            ProviderOverloadedError: If that is more than QUEUE_TIMEOUT away
+            DeadlineExceeded: If it comes after the request's deadline
+        """
+        now = self._clock()
+        max_wait, bounded = bounded_timeout(QUEUE_TIMEOUT)
+        slot, reserved = self._reserve(now, max_wait)
+        if not reserved:
+            if bounded and slot - now <= QUEUE_TIMEOUT:
+                metrics.deadline_expired.inc(stage="upstream_pacing")
+                raise DeadlineExceeded()
+            raise ProviderOverloadedError(f"{self.name} is rate limiting requests", retry_after=slot - now)
+        if slot > now:
+            metrics.upstream_pacing.observe(slot - now, provider=self.name)
+            await asyncio.sleep(slot - now)
+
+
+class SharedUpstreamRateLimit(UpstreamRateLimit):
+    """
+    UpstreamRateLimit whose pause and dispatch schedule live in the shared
+    state store, so worker processes pace one provider together
+    """
+
+    _clock = staticmethod(time.time)
+
+    def _set(self, interval: Optional[float] = None, paused_until: Optional[float] = None) -> None:
+        shared_state.pace(self.name, interval, paused_until)
+
+    def _paused_until(self) -> float:
+        return shared_state.paused_until(self.name)
+
+    def _reserve(self, now: float, max_wait: float) -> Tuple[float, bool]:
+        return shared_state.reserve(self.name, now, max_wait)
+
+
+_DURATION = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+
+
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    """
+    Parse a rate-limit reset value such as "20ms", "1s", "6m0s" or "30"
+    into seconds
+    """
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    parts = _DURATION.findall(value)
+    if not parts:
+        return None
+    return sum(float(number) * units[unit] for number, unit in parts)
+
+
+def _header_float(headers: Mapping[str, str], name: str) -> Optional[float]:
+    try:
+        return float(headers.get(name))
+    except (TypeError, ValueError):
+        return None
+
+
+class Provider:
+    """
+    Base class for AI providers. Subclasses implement _complete and _stream;
+    this class handles the per-provider concurrency limit and backpressure.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        model: str,
+        max_concurrency: int = MAX_CONCURRENCY,
+        json_mode: bool = False,
+        fast_model: Optional[str] = None
+    ):
+        self.name = name
+        self.model = model
+        # Smaller, quicker model used when little of the request's deadline is left
+        self.fast_model = fast_model
+        self.max_concurrency = max_concurrency
+        # Whether the provider/model accepts response_format={"type": "json_object"}
+        self.json_mode = json_mode
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.in_flight = 0
+        # Shared with the other worker processes when serve.py runs several
+        self.rate_limit = SharedUpstreamRateLimit(name) if shared_state else UpstreamRateLimit(name)
+
+    def _prepare(self, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Fill in the default model (the fast one for fast=True), translate
+        json_mode=True into the provider's JSON response format when it
+        supports one, and bound the call by the request's deadline
+        """
+        fast = kwargs.pop("fast", False)
+        kwargs["model"] = kwargs.get("model") or (fast and self.fast_model) or self.model
+        if kwargs.pop("json_mode", False) and self.json_mode:
+            kwargs["response_format"] = {"type": "json_object"}
+        left = remaining()
+        if left is not None:
+            kwargs["timeout"] = max(left, 0.0)
+        return kwargs
+
+    async def _acquire_slot(self) -> None:
+        """
+        Wait for a free concurrency slot, giving up after QUEUE_TIMEOUT seconds
+        or at the request's deadline, whichever comes first
+        """
+        timeout, bounded = bounded_timeout(QUEUE_TIMEOUT)
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), timeout=timeout)
+        except asyncio.TimeoutError:
+            if bounded:
+                metrics.deadline_expired.inc(stage="provider_queue")
+                raise DeadlineExceeded()
+            metrics.provider_errors.inc(provider=self.name, error="queue_timeout")
+            raise ProviderOverloadedError(
+                f"{self.name} is at capacity ({self.max_concurrency} requests in flight), try again shortly"
+            )
+        finally:
+            metrics.provider_queue_wait.observe(time.perf_counter() - started, provider=self.name)
+        self.in_flight += 1
+        metrics.provider_in_flight.inc(provider=self.name)
+
+    def _rate_limited(self, error: Exception) -> Optional[ProviderOverloadedError]:
+        """
+        Turn an upstream 429 into a ProviderOverloadedError and pause
+        dispatch to this provider until it says to retry
+        """
+        if getattr(error, "status_code", None) != 429:
+            return None
+        headers = getattr(getattr(error, "response", None), "headers", None) or {}
+        self.rate_limit.update(headers)
+        retry_ms = _header_float(headers, "retry-after-ms")
+        retry_after = retry_ms / 1000 if retry_ms else parse_duration(headers.get("retry-after"))
+        self.rate_limit.pause(retry_after or 1.0)
+        return ProviderOverloadedError(f"{self.name} is rate limiting requests", retry_after=self.rate_limit.retry_after())
+
+    def _check_expired(self, error: Exception) -> None:
+        """
+        Report a call cut off by the request's deadline (the client timeout
+        is set to the time left) as DeadlineExceeded, not a provider failure
+        """
+        left = remaining()
+        if left is not None and left <= 0:
+            metrics.deadline_expired.inc(stage="upstream")
+            raise DeadlineExceeded() from error
+
+    def _release_slot(self) -> None:
+        self.in_flight -= 1
+        metrics.provider_in_flight.dec(provider=self.name)
+        self.semaphore.release()
+
+    async def complete(self, messages: List[Dict[str, str]], **kwargs) -> Dict[str, Any]:
+        """
+        Run a chat completion
+
+        Args:
+            messages: Chat messages
+            **kwargs: Completion parameters (max_tokens, temperature, model, json_mode, ...)
+
+        Returns:
+            A dict with the completion text and token usage
+        """
+        check_deadline("upstream")
+        kwargs = self._prepare(kwargs)
+        await self.rate_limit.wait()
+        await self._acquire_slot()
+        started = time.perf_counter()
+        try:
+            # Bounds the SDK's retries too, which the per-request timeout does not
+            async with asyncio.timeout(remaining()):
+                result = await self._complete(messages, **kwargs)
+        except asyncio.CancelledError:
+            # The client went away or a hedge won: the upstream request is dropped
+            metrics.provider_cancelled.inc(provider=self.name, mode="complete")
+            raise
+        except ProviderError as e:
+            metrics.provider_errors.inc(provider=self.name, error=metrics.error_class(e))
+            raise
+        except Exception as e:
+            self._check_expired(e)
+            metrics.provider_errors.inc(provider=self.name, error=metrics.error_class(e))
+            raise self._rate_limited(e) or ProviderError(self.name, str(e)) from e
+        finally:
+            self._release_slot()
+        metrics.provider_request_duration.observe(time.perf_counter() - started, provider=self.name, mode="complete")
+        metrics.record_usage(self.name, result.get("usage"))
+        self.rate_limit.record_usage(result.get("usage"))
+        return result
+
+    async def stream(self, messages: List[Dict[str, str]], **kwargs) -> AsyncIterator[str]:
+        """
+        Stream a chat completion
+
+        Yields:
+            Text deltas as they arrive
+        """
+        check_deadline("upstream")
+        kwargs = self._prepare(kwargs)
+        await self.rate_limit.wait()
+        await self._acquire_slot()
+        started = time.perf_counter()
+        first_token = True
+        try:
+            async for delta in self._stream(messages, **kwargs):
+                if first_token:
+                    metrics.provider_ttft.observe(time.perf_counter() - started, provider=self.name)
+                    first_token = False
+                yield delta
+        except (asyncio.CancelledError, GeneratorExit):
+            metrics.provider_cancelled.inc(provider=self.name, mode="stream")
+            raise
+        except ProviderError as e:
+            metrics.provider_errors.inc(provider=self.name, error=metrics.error_class(e))
+            raise
+        except Exception as e:
+            self._check_expired(e)
+            metrics.provider_errors.inc(provider=self.name, error=metrics.error_class(e))
+            raise self._rate_limited(e) or ProviderError(self.name, str(e)) from e
+        else:
+            metrics.provider_request_duration.observe(time.perf_counter() - started, provider=self.name, mode="stream")
+        finally:
+            self._release_slot()
+
+    async def _complete(self, messages: List[Dict[str, str]], **kwargs) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    async def _stream(self, messages: List[Dict[str, str]], **kwargs) -> AsyncIterator[str]:
+        raise NotImplementedError
+        yield
+
+
+class OpenAICompatibleProvider(Provider):
+    """
+    Provider for any OpenAI-compatible chat completions API
+    (OpenAI, NVIDIA NIM, Together, Cloudflare Workers AI, local fakes)
+    """
+
+    def __init__(
+        self,
+        name: str,
+        api_key: str,
+        model: str,
+        http_client: "httpx.AsyncClient",
+        base_url: Optional[str] = None,
+        max_concurrency: int = MAX_CONCURRENCY,
+        json_mode: bool = False,
+        fast_model: Optional[str] = None
+    ):
+        super().__init__(name, model, max_concurrency, json_mode, fast_model)
+        # Imported here: the SDK is the slowest import of the app and only
+        # needed once a provider is actually configured
+        from openai import AsyncOpenAI
+
+        self.client = AsyncOpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            http_client=http_client,
+            max_retries=MAX_RETRIES
+        )
+
+    async def _complete(self, messages: List[Dict[str, str]], **kwargs) -> Dict[str, Any]:
+        # Raw response so the rate-limit headers can pace later dispatches
+        raw = await self.client.chat.completions.with_raw_response.create(messages=messages, **kwargs)
+        self.rate_limit.update(raw.headers)
+        response = raw.parse()
+        return {
+            "content": response.choices[0].message.content or "",
+            "usage": response.usage.model_dump() if response.usage else None
+        }
+
+    async def _stream(self, messages: List[Dict[str, str]], **kwargs) -> AsyncIterator[str]:
+        raw = await self.client.chat.completions.with_raw_response.create(messages=messages, stream=True, **kwargs)
+        self.rate_limit.update(raw.headers)
+        stream = raw.parse()
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                yield delta
+
+
+def _env_key(name: str) -> Optional[str]:
+    """
+    Read an API key, treating the env.example placeholders as unset
+    """
+    value = os.getenv(name)
+    if not value or value.startswith("your_"):
+        return None
+    return value
+
+
+def _env_flag(name: str, default: bool) -> bool:
+    return os.getenv(name, str(default)).lower() == "true"
+
+
+def _openai_compatible(name: str, default_base_url: Optional[str], default_model: str, json_mode: bool):
+    prefix = name.upper()
+
+    def factory(http_client: "httpx.AsyncClient") -> Optional[Provider]:
+        api_key = _env_key(f"{prefix}_API_KEY")
+        if not api_key:
+            return None
+        return OpenAICompatibleProvider(
+            name=name,
+            api_key=api_key,
+            model=os.getenv(f"{prefix}_MODEL", default_model),
+            http_client=http_client,
+            base_url=os.getenv(f"{prefix}_BASE_URL", default_base_url),
+            max_concurrency=int(os.getenv(f"{prefix}_MAX_CONCURRENCY", str(MAX_CONCURRENCY))),
+            json_mode=_env_flag(f"{prefix}_JSON_MODE", json_mode),
+            fast_model=os.getenv(f"{prefix}_FAST_MODEL")
+        )
+
+    return factory
+
+
+def _cloudflare(http_client: "httpx.AsyncClient") -> Optional[Provider]:
+    api_key = _env_key("CLOUDFLARE_API_KEY")
+    base_url = os.getenv("CLOUDFLARE_BASE_URL")
+    account_id = _env_key("CLOUDFLARE_ACCOUNT_ID")
+    if not base_url and account_id:
+        base_url = f"https://api.cloudflare.com/client/v4/accounts/{account_id}/ai/v1"
+    if not api_key or not base_url:
+        return None
+    return OpenAICompatibleProvider(
+        name="cloudflare",
+        api_key=api_key,
+        model=os.getenv("CLOUDFLARE_MODEL", "@cf/meta/llama-3-8b-instruct"),
+        http_client=http_client,
+        base_url=base_url,
+        max_concurrency=int(os.getenv("CLOUDFLARE_MAX_CONCURRENCY", str(MAX_CONCURRENCY))),
+        json_mode=_env_flag("CLOUDFLARE_JSON_MODE", False),
+        fast_model=os.getenv("CLOUDFLARE_FAST_MODEL")
+    )
+
+
+# Registry of provider factories, in default preference order.
+# A factory returns None when the provider is not configured.
+PROVIDER_FACTORIES: Dict[str, Callable[["httpx.AsyncClient"], Optional[Provider]]] = {
+    "openai": _openai_compatible("openai", None, "gpt-4-turbo", json_mode=True),
+    "nvidia": _openai_compatible("nvidia", "https://integrate.api.nvidia.com/v1", "meta/llama3-70b-instruct", json_mode=False),
+    "together": _openai_compatible("together", "https://api.together.xyz/v1", "meta-llama/Llama-3-70b-chat-hf", json_mode=True),
+    "cloudflare": _cloudflare,
+}
+
+
+def register_provider(name: str, factory: Callable[["httpx.AsyncClient"], Optional[Provider]]) -> None:
+    """
+    Register an additional provider factory
+
+    Args:
+        name: Provider name, as used by preferred_provider
+        factory: Callable building the provider from the shared HTTP client
+    """
+    PROVIDER_FACTORIES[name] = factory
+
+
+def load_providers(http_client: "httpx.AsyncClient") -> Dict[str, Provider]:
+    """
+    Instantiate every configured provider
+
+    Returns:
+        Providers keyed by name, in registry order
+    """
+    providers = {}
+    for name, factory in PROVIDER_FACTORIES.items():
+        provider = factory(http_client)
+        if provider is not None:
+            providers[name] = provider
+    return providers
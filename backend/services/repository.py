@@ -0,0 +1,571 @@
+from typing import Optional, Dict, Any, AsyncIterator, Awaitable, Callable, List, Set, Tuple
+import asyncio
+import difflib
+import io
+import json
+import os
+import posixpath
+import re
+import shutil
+import tarfile
+import threading
+import time
+import uuid
+import zipfile
+from services.sessions import make_patch
+
+REPOSITORY_DIR = os.getenv("REPOSITORY_DIR", "data/repositories")
+REPOSITORY_MAX_BYTES = int(os.getenv("REPOSITORY_MAX_BYTES", str(256 * 1024 * 1024)))
+REPOSITORY_MAX_FILES = int(os.getenv("REPOSITORY_MAX_FILES", "5000"))
+# Larger source files are copied unchanged
+REPOSITORY_MAX_FILE_BYTES = int(os.getenv("REPOSITORY_MAX_FILE_BYTES", str(512 * 1024)))
+REPOSITORY_CONCURRENCY = int(os.getenv("REPOSITORY_CONCURRENCY", "8"))
+# Finished workspaces (sources, results and patch archive) are removed after this
+REPOSITORY_TTL_SECONDS = float(os.getenv("REPOSITORY_TTL_SECONDS", str(7 * 24 * 3600)))
+
+SOURCE_EXTENSIONS = {".py": "python", ".java": "java"}
+
+_PY_IMPORT = re.compile(r"^[ \t]*import[ \t]+([\w. \t,]+)", re.M)
+_PY_FROM = re.compile(r"^[ \t]*from[ \t]+(\.*[\w.]*)[ \t]+import[ \t]+\(?([\w. \t,*]+)", re.M)
+_JAVA_PACKAGE = re.compile(r"^\s*package\s+([\w.]+)\s*;", re.M)
+_JAVA_IMPORT = re.compile(r"^\s*import\s+(static\s+)?([\w.]+)(\.\*)?\s*;", re.M)
+_IDENTIFIER = re.compile(r"\b[A-Z]\w*\b")
+
+_PY_DEFINITION = re.compile(r"^([ \t]*)(def|class)[ \t]+(\w+)", re.M)
+_JAVA_DEFINITION = re.compile(
+    r"^([ \t]*)(?:(?:public|protected|static|final|abstract|synchronized|default)\s+)*"
+    r"(?:(class|interface|enum|record)\s+(\w+)|([\w<>\[\], ?]+?)\s+(\w+)\s*\()",
+    re.M
+)
+# Statements that look like "<type> <name>(" to the definition pattern
+_JAVA_NOT_TYPES = {"return", "new", "else", "throw", "case", "yield", "await"}
+
+
+class ArchiveError(Exception):
+    """
+    Raised for uploads that are not a readable zip/tar archive or exceed
+    the size limits
+    """
+
+
+class _StreamReader(io.RawIOBase):
+    """
+    Blocking file object over an async byte stream, read from a worker
+    thread so tarfile can extract while the upload is still arriving
+    """
+
+    def __init__(self, chunks: AsyncIterator[bytes], head: bytes, loop: asyncio.AbstractEventLoop):
+        self._chunks = chunks
+        self._buffer = head
+        self._loop = loop
+        self._eof = False
+        self._received = len(head)
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, target) -> int:
+        while not self._buffer and not self._eof:
+            try:
+                self._buffer = asyncio.run_coroutine_threadsafe(self._chunks.__anext__(), self._loop).result()
+            except StopAsyncIteration:
+                self._eof = True
+            self._received += len(self._buffer)
+            # The compressed upload is capped like a zip's, whatever it expands to
+            if self._received > REPOSITORY_MAX_BYTES:
+                raise ArchiveError(f"Archive is larger than {REPOSITORY_MAX_BYTES} bytes")
+        size = min(len(target), len(self._buffer))
+        target[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+
+class _Limits:
+    """
+    File count and expanded size of an archive so far. Every member is
+    counted, including the ones that are skipped rather than extracted.
+    """
+
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def add(self, size: int) -> None:
+        with self.lock:
+            self.files += 1
+            self.bytes += size
+            if self.files > REPOSITORY_MAX_FILES:
+                raise ArchiveError(f"Archive has more than {REPOSITORY_MAX_FILES} files")
+            if self.bytes > REPOSITORY_MAX_BYTES:
+                raise ArchiveError(f"Archive expands to more than {REPOSITORY_MAX_BYTES} bytes")
+
+
+def _safe_path(name: str) -> Optional[str]:
+    """
+    Normalize an archive member name, rejecting anything that would land
+    outside the extraction directory
+    """
+    path = posixpath.normpath(name.replace("\\", "/")).lstrip("/")
+    if path in ("", ".") or path.startswith("../") or path == ".." or ":" in path.split("/")[0]:
+        return None
+    if any(part in ("__MACOSX", ".git") for part in path.split("/")):
+        return None
+    return path
+
+
+def _write_member(source, dest: str, path: str) -> None:
+    target = os.path.join(dest, path)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with open(target, "wb") as out:
+        shutil.copyfileobj(source, out, 64 * 1024)
+
+
+def _extract_tar(stream: io.RawIOBase, dest: str) -> List[str]:
+    paths = []
+    limits = _Limits()
+    try:
+        # "r|*" reads members strictly in order, so nothing is buffered beyond the current block
+        with tarfile.open(fileobj=io.BufferedReader(stream, 64 * 1024), mode="r|*") as archive:
+            for member in archive:
+                # Skipped members still have to be read (and decompressed) past
+                limits.add(member.size)
+                path = _safe_path(member.name)
+                if not member.isfile() or path is None:
+                    continue
+                _write_member(archive.extractfile(member), dest, path)
+                paths.append(path)
+    except tarfile.TarError as e:
+        raise ArchiveError(f"Not a readable tar archive: {str(e)}")
+    return paths
+
+
+def _extract_zip(archive_path: str, dest: str) -> List[str]:
+    paths = []
+    limits = _Limits()
+    try:
+        with zipfile.ZipFile(archive_path) as archive:
+            for info in archive.infolist():
+                limits.add(info.file_size)
+                path = _safe_path(info.filename)
+                # Unix symlinks carry S_IFLNK in the high bits of external_attr
+                if info.is_dir() or path is None or (info.external_attr >> 16) & 0o170000 == 0o120000:
+                    continue
+                with archive.open(info) as source:
+                    _write_member(source, dest, path)
+                paths.append(path)
+    except zipfile.BadZipFile as e:
+        raise ArchiveError(f"Not a readable zip archive: {str(e)}")
+    return paths
+
+
+def _strip_common_root(dest: str, paths: List[str]) -> List[str]:
+    """
+    Drop the single top-level folder most archives wrap the project in
+    (repo-main/), so paths match the repository and git apply
+    """
+    roots = {path.split("/", 1)[0] for path in paths}
+    if len(roots) != 1 or not all("/" in path for path in paths):
+        return paths
+    root = roots.pop()
+    moved = dest.rstrip("/") + ".root"
+    os.rename(os.path.join(dest, root), moved)
+    os.rmdir(dest)
+    os.rename(moved, dest)
+    return [path.split("/", 1)[1] for path in paths]
+
+
+async def extract_archive(chunks: AsyncIterator[bytes], dest: str) -> List[str]:
+    """
+    Extract an uploaded zip or tar (plain, gz, bz2 or xz) while it streams
+    in. Tar members are written as they arrive; a zip keeps its index at
+    the end, so it is spooled to disk first and extracted member by member.
+
+    Args:
+        chunks: The request body
+        dest: Directory to extract into
+
+    Returns:
+        The extracted file paths, relative to dest (without a common top-level folder)
+
+    Raises:
+        ArchiveError: If the upload is not an archive or exceeds the limits
+    """
+    os.makedirs(dest, exist_ok=True)
+    chunks = chunks.__aiter__()
+    head = b""
+    async for chunk in chunks:
+        head += chunk
+        if len(head) >= 4:
+            break
+    if not head:
+        raise ArchiveError("Empty upload")
+
+    if head.startswith((b"PK\x03\x04", b"PK\x05\x06")):
+        spool = dest.rstrip("/") + ".zip"
+        size = len(head)
+        try:
+            with open(spool, "wb") as out:
+                out.write(head)
+                async for chunk in chunks:
+                    size += len(chunk)
+                    if size > REPOSITORY_MAX_BYTES:
+                        raise ArchiveError(f"Archive is larger than {REPOSITORY_MAX_BYTES} bytes")
+                    out.write(chunk)
+            paths = await asyncio.to_thread(_extract_zip, spool, dest)
+        finally:
+            os.remove(spool)
+    else:
+        reader = _StreamReader(chunks, head, asyncio.get_running_loop())
+        paths = await asyncio.to_thread(_extract_tar, reader, dest)
+    return await asyncio.to_thread(_strip_common_root, dest, paths)
+
+
+def file_language(path: str) -> Optional[str]:
+    return SOURCE_EXTENSIONS.get(os.path.splitext(path)[1].lower())
+
+
+def _python_modules(path: str) -> List[str]:
+    """
+    Every dotted name the file could be imported as, since the source root
+    (repo root, src/, a top-level project folder) is not known
+    """
+    parts = path[:-3].split("/")
+    if parts[-1] == "__init__":
+        parts = parts[:-1]
+    return [".".join(parts[i:]) for i in range(len(parts)) if parts[i:]]
+
+
+def _python_imports(path: str, code: str) -> List[str]:
+    names = []
+    for match in _PY_IMPORT.finditer(code):
+        names += [part.split()[0] for part in match.group(1).split(",") if part.strip()]
+    package = path.split("/")[:-1]
+    for match in _PY_FROM.finditer(code):
+        module, imported = match.group(1), match.group(2)
+        dots = len(module) - len(module.lstrip("."))
+        if dots:
+            base = package[:len(package) - dots + 1] if dots <= len(package) + 1 else []
+            module = ".".join(base + ([module.lstrip(".")] if module.lstrip(".") else []))
+        # "from pkg import mod" may name a submodule rather than an attribute
+        names += [module] + [f"{module}.{part.split()[0]}" for part in imported.split(",") if part.strip() and part.strip() != "*"]
+    return names
+
+
+def _java_class(path: str, code: str) -> str:
+    package = _JAVA_PACKAGE.search(code)
+    name = posixpath.basename(path)[:-5]
+    return f"{package.group(1)}.{name}" if package else name
+
+
+def build_graph(root: str, paths: List[str]) -> Dict[str, Set[str]]:
+    """
+    Build the import graph between the source files of an extracted
+    repository: Python imports (absolute and relative) and Java imports
+    plus same-package class references
+
+    Args:
+        root: The extraction directory
+        paths: Source file paths relative to root
+
+    Returns:
+        Each path mapped to the set of paths it depends on
+    """
+    codes = {}
+    for path in paths:
+        with open(os.path.join(root, path), encoding="utf-8", errors="replace") as f:
+            codes[path] = f.read()
+
+    python_modules: Dict[str, str] = {}
+    java_classes: Dict[str, str] = {}
+    java_packages: Dict[str, Dict[str, str]] = {}
+    for path, code in codes.items():
+        if file_language(path) == "python":
+            # Longer (more specific) names are registered first and win
+            for module in _python_modules(path):
+                python_modules.setdefault(module, path)
+        else:
+            qualified = _java_class(path, code)
+            java_classes[qualified] = path
+            package, _, simple = qualified.rpartition(".")
+            java_packages.setdefault(package, {})[simple] = path
+
+    graph: Dict[str, Set[str]] = {}
+    for path, code in codes.items():
+        deps: Set[str] = set()
+        if file_language(path) == "python":
+            package = path.split("/")[:-1]
+            for name in _python_imports(path, code):
+                # Python 2 resolves a plain import against the importing package first
+                for candidate in (".".join(package + [name]), name):
+                    if candidate in python_modules:
+                        deps.add(python_modules[candidate])
+                        break
+        else:
+            package = _java_class(path, code).rpartition(".")[0]
+            for match in _JAVA_IMPORT.finditer(code):
+                name, wildcard = match.group(2), match.group(3)
+                if wildcard:
+                    deps.update(java_packages.get(name, {}).values())
+                    continue
+                # Static imports name a member of the class
+                while name and name not in java_classes and match.group(1):
+                    name = name.rpartition(".")[0]
+                if name in java_classes:
+                    deps.add(java_classes[name])
+            siblings = java_packages.get(package, {})
+            deps.update(siblings[name] for name in set(_IDENTIFIER.findall(code)) if name in siblings)
+        deps.discard(path)
+        graph[path] = deps
+    return graph
+
+
+def break_cycles(graph: Dict[str, Set[str]]) -> Tuple[Dict[str, Set[str]], List[List[str]]]:
+    """
+    Order the graph into topological levels, dropping the unresolved
+    imports of the file with the fewest of them whenever a cycle blocks
+    progress
+
+    Returns:
+        (acyclic dependency map, levels of paths; level 0 imports nothing)
+    """
+    deps = {path: set(d) for path, d in graph.items()}
+    remaining = {path: set(d) for path, d in graph.items()}
+    dependents: Dict[str, Set[str]] = {path: set() for path in graph}
+    for path, d in graph.items():
+        for dep in d:
+            dependents[dep].add(path)
+
+    levels: List[List[str]] = []
+    while remaining:
+        level = sorted(path for path, d in remaining.items() if not d)
+        if not level:
+            path = min(remaining, key=lambda p: (len(remaining[p]), p))
+            deps[path] -= remaining[path]
+            remaining[path] = set()
+            level = [path]
+        levels.append(level)
+        for path in level:
+            del remaining[path]
+            for dependent in dependents[path]:
+                if dependent in remaining:
+                    remaining[dependent].discard(path)
+    return deps, levels
+
+
+async def run_in_order(
+    deps: Dict[str, Set[str]],
+    handle: Callable[[str], Awaitable[Any]],
+    done: Set[str],
+    max_concurrency: int = REPOSITORY_CONCURRENCY
+) -> None:
+    """
+    Run handle for every path once all of its dependencies have finished,
+    at most max_concurrency at a time. Independent files (leaves first)
+    run concurrently instead of waiting for a whole level.
+
+    Args:
+        deps: Acyclic dependency map from break_cycles
+        handle: Coroutine run for each path
+        done: Paths finished earlier (e.g. before a worker restart); skipped
+        max_concurrency: Maximum number of files in flight
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+    finished = set(done)
+    pending = {path for path in deps if path not in finished}
+    running: Dict[asyncio.Task, str] = {}
+
+    async def run(path: str) -> None:
+        async with semaphore:
+            await handle(path)
+
+    try:
+        while pending or running:
+            ready = sorted(path for path in pending if deps[path] <= finished)
+            for path in ready:
+                pending.discard(path)
+                running[asyncio.create_task(run(path))] = path
+            completed, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in completed:
+                finished.add(running.pop(task))
+                task.result()
+    finally:
+        for task in running:
+            task.cancel()
+
+
+def definitions(code: str, language: str) -> List[Tuple[int, str, str]]:
+    """
+    Public classes, functions and methods in source order as
+    (indentation, kind, name)
+    """
+    found = []
+    if language == "python":
+        for match in _PY_DEFINITION.finditer(code):
+            if not match.group(3).startswith("_"):
+                found.append((len(match.group(1).expandtabs()), match.group(2), match.group(3)))
+        return found
+    for match in _JAVA_DEFINITION.finditer(code):
+        if match.group(3):
+            found.append((len(match.group(1).expandtabs()), match.group(2), match.group(3)))
+        elif match.group(4).split() and match.group(4).split()[-1] not in _JAVA_NOT_TYPES:
+            found.append((len(match.group(1).expandtabs()), "method", match.group(5)))
+    return found
+
+
+def renamed_definitions(before: str, after: str, language: str) -> Dict[str, str]:
+    """
+    Public APIs the refactor renamed: definitions at the same place and of
+    the same kind whose name changed
+
+    Returns:
+        Old name mapped to new name
+    """
+    old, new = definitions(before, language), definitions(after, language)
+    renames = {}
+    matcher = difflib.SequenceMatcher(None, [d[2] for d in old], [d[2] for d in new], autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag != "replace" or i2 - i1 != j2 - j1:
+            continue
+        for (_, kind, name), (_, new_kind, new_name) in zip(old[i1:i2], new[j1:j2]):
+            if kind == new_kind:
+                renames[name] = new_name
+    return renames
+
+
+def module_name(path: str, code: str) -> str:
+    """
+    Name other files use to refer to this one, for rename notes
+    """
+    if file_language(path) == "python":
+        return _python_modules(path)[0]
+    return _java_class(path, code)
+
+
+class Workspace:
+    """
+    On-disk state of one repository run, shared between the API process
+    that extracted the upload and the worker that processes it: the
+    sources, an append-only log of per-file results (so a restarted worker
+    resumes where the last one stopped) and the final patch archive
+    """
+
+    def __init__(self, workspace_id: str):
+        if not re.fullmatch(r"[0-9a-f]{32}", workspace_id):
+            raise ValueError("Invalid workspace id")
+        self.id = workspace_id
+        self.path = os.path.join(REPOSITORY_DIR, workspace_id)
+        self.src = os.path.join(self.path, "src")
+        self.log = os.path.join(self.path, "results.ndjson")
+        self.patch_archive = os.path.join(self.path, "patch.tar.gz")
+        self._lock = threading.Lock()
+
+    @classmethod
+    def create(cls) -> "Workspace":
+        workspace = cls(uuid.uuid4().hex)
+        os.makedirs(workspace.src)
+        return workspace
+
+    def remove(self) -> None:
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def read(self, path: str) -> str:
+        with open(os.path.join(self.src, path), encoding="utf-8", errors="replace") as f:
+            return f.read()
+
+    def source_files(self, paths: List[str]) -> Tuple[List[str], List[str]]:
+        """
+        Split extracted files into (source files to refactor, files copied as is)
+        """
+        sources, skipped = [], []
+        for path in paths:
+            size = os.path.getsize(os.path.join(self.src, path))
+            (sources if file_language(path) and size <= REPOSITORY_MAX_FILE_BYTES else skipped).append(path)
+        return sources, skipped
+
+    def list_files(self) -> List[str]:
+        paths = []
+        for directory, _, files in os.walk(self.src):
+            for name in files:
+                paths.append(os.path.relpath(os.path.join(directory, name), self.src).replace(os.sep, "/"))
+        return sorted(paths)
+
+    def _load(self) -> List[Dict[str, Any]]:
+        if not os.path.exists(self.log):
+            return []
+        with open(self.log, "rb+") as f:
+            data = f.read()
+            # A crash mid-write leaves a partial last line; drop it before appending
+            end = data.rfind(b"\n") + 1
+            if end < len(data):
+                f.truncate(end)
+        return [json.loads(line) for line in data[:end].decode("utf-8").splitlines() if line]
+
+    def _append(self, entry: Dict[str, Any]) -> None:
+        with self._lock, open(self.log, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    async def results(self) -> List[Dict[str, Any]]:
+        """
+        Per-file results recorded so far, in completion order
+        """
+        return await asyncio.to_thread(self._load)
+
+    async def record(self, entry: Dict[str, Any]) -> None:
+        await asyncio.to_thread(self._append, entry)
+
+    def tail(self, offset: int) -> Tuple[List[Dict[str, Any]], int]:
+        """
+        Complete result lines after byte offset, and the offset to continue from
+        """
+        if not os.path.exists(self.log):
+            return [], offset
+        with open(self.log, "rb") as f:
+            f.seek(offset)
+            data = f.read()
+        end = data.rfind(b"\n") + 1
+        return [json.loads(line) for line in data[:end].decode("utf-8").splitlines() if line], offset + end
+
+    def _write_patch(self, entries: List[Dict[str, Any]]) -> None:
+        changed = [e for e in entries if e.get("status") == "ok" and e["refactored_code"] != self.read(e["path"])]
+        combined = "".join(make_patch(self.read(e["path"]), e["refactored_code"], e["path"]) for e in changed)
+        partial = self.patch_archive + ".tmp"
+        with tarfile.open(partial, "w:gz") as archive:
+            def add(name: str, text: str) -> None:
+                data = text.encode("utf-8")
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+
+            add("repository.patch", combined)
+            add("results.json", json.dumps(
+                [{k: v for k, v in e.items() if k != "refactored_code"} for e in entries], indent=2
+            ))
+            for entry in changed:
+                add(f"files/{entry['path']}", entry["refactored_code"])
+        os.replace(partial, self.patch_archive)
+
+    async def write_patch(self, entries: List[Dict[str, Any]]) -> None:
+        """
+        Build the patch archive: repository.patch (git apply -p1 compatible),
+        the refactored files under files/ and results.json
+        """
+        await asyncio.to_thread(self._write_patch, entries)
+
+
+def purge_workspaces() -> int:
+    """
+    Remove workspaces untouched for REPOSITORY_TTL_SECONDS
+    """
+    if not os.path.isdir(REPOSITORY_DIR):
+        return 0
+    removed = 0
+    cutoff = time.time() - REPOSITORY_TTL_SECONDS
+    for name in os.listdir(REPOSITORY_DIR):
+        path = os.path.join(REPOSITORY_DIR, name)
+        if os.path.getmtime(path) < cutoff:
+            shutil.rmtree(path, ignore_errors=True)
+            removed += 1
+    return removed
@@ -0,0 +1,1046 @@
+from typing import Optional, Dict, List, Set, Tuple, Callable
+from dataclasses import dataclass, field
+from string import Formatter
+import ast
+import io
+import os
+import re
+import tokenize
+from services import metrics
+
+REWRITE_ENABLED = os.getenv("REWRITE_ENABLED", "true").lower() == "true"
+
+LEVELS = {"conservative": 0, "moderate": 1, "aggressive": 2}
+
+# A rewrite: ((start row, start col), (end row, end col), replacement), in tokenize coordinates
+Edit = Tuple[Tuple[int, int], Tuple[int, int], str]
+
+
+@dataclass
+class Rule:
+    """
+    One mechanical rewrite. It runs when the target version has the feature
+    (since) and, for removals of old syntax, when the source version still
+    had it (before).
+    """
+    name: str
+    language: str
+    description: str
+    apply: Callable[[str], Tuple[str, int]]
+    since: Optional[Tuple[int, ...]] = None
+    before: Optional[Tuple[int, ...]] = None
+    level: str = "conservative"
+
+    def applies(self, source: Optional[Tuple[int, ...]], target: Optional[Tuple[int, ...]], level: str) -> bool:
+        if LEVELS[self.level] > LEVELS.get(level, LEVELS["moderate"]):
+            return False
+        if self.since and target is not None and target < self.since:
+            return False
+        if self.before and (source is None or source >= self.before):
+            return False
+        return True
+
+
+@dataclass
+class RewriteResult:
+    code: str
+    changes: List[str] = field(default_factory=list)
+    # 1-based inclusive line ranges that still need the model
+    residual: List[Tuple[int, int]] = field(default_factory=list)
+
+    @property
+    def whole_file(self) -> bool:
+        return self.residual == [(1, self.code.count("\n") + 1)]
+
+
+RULES: Dict[str, List[Rule]] = {}
+
+
+def register_rule(
+    language: str,
+    description: str,
+    since: Optional[Tuple[int, ...]] = None,
+    before: Optional[Tuple[int, ...]] = None,
+    level: str = "conservative"
+):
+    """
+    Register a rewrite function code -> (new code, number of rewrites).
+    The description is formatted with {count}.
+    """
+    def register(apply: Callable[[str], Tuple[str, int]]):
+        RULES.setdefault(language, []).append(
+            Rule(apply.__name__.lstrip("_"), language, description, apply, since, before, level)
+        )
+        return apply
+
+    return register
+
+
+def parse_version(text: Optional[str]) -> Optional[Tuple[int, ...]]:
+    """
+    Parse "Python 3.11", "py2.7", "Java 8", "1.8" or "17" into a tuple;
+    Java's 1.x numbering maps to x
+    """
+    match = re.search(r"(\d+)(?:\.(\d+))?", text or "")
+    if not match:
+        return None
+    version = tuple(int(g) for g in match.groups() if g is not None)
+    if version[0] == 1 and len(version) > 1:
+        return version[1:]
+    return version
+
+
+def normalize_language(language: str) -> str:
+    language = language.strip().lower()
+    return {"py": "python", "python3": "python", "python2": "python"}.get(language, language)
+
+
+# ---------------------------------------------------------------------------
+# Python: token-level rewrites, so formatting and comments survive untouched
+# ---------------------------------------------------------------------------
+
+_SKIP = {tokenize.NL, tokenize.COMMENT, tokenize.INDENT, tokenize.DEDENT}
+
+
+def _tokens(code: str) -> Optional[List[tokenize.TokenInfo]]:
+    try:
+        return list(tokenize.generate_tokens(io.StringIO(code).readline))
+    except (tokenize.TokenError, IndentationError, SyntaxError):
+        return None
+
+
+def _apply_edits(code: str, edits: List[Edit]) -> str:
+    lines = code.splitlines(keepends=True)
+    starts = [0]
+    for line in lines:
+        starts.append(starts[-1] + len(line))
+
+    def offset(position: Tuple[int, int]) -> int:
+        row, col = position
+        return starts[row - 1] + col if row - 1 < len(starts) else len(code)
+
+    end = len(code) + 1
+    for start_pos, end_pos, text in sorted(edits, key=lambda e: e[0], reverse=True):
+        start, stop = offset(start_pos), offset(end_pos)
+        # Overlapping edits are dropped; the next pass picks them up
+        if stop > end:
+            continue
+        code = code[:start] + text + code[stop:]
+        end = start
+    return code
+
+
+def _significant(tokens: List[tokenize.TokenInfo]) -> List[tokenize.TokenInfo]:
+    return [t for t in tokens if t.type not in _SKIP]
+
+
+def _matching(tokens: List[tokenize.TokenInfo], index: int) -> Optional[int]:
+    """
+    Index of the bracket closing the one at index
+    """
+    depth = 0
+    for i in range(index, len(tokens)):
+        if tokens[i].type == tokenize.OP and tokens[i].string in "([{":
+            depth += 1
+        elif tokens[i].type == tokenize.OP and tokens[i].string in ")]}":
+            depth -= 1
+            if depth == 0:
+                return i
+    return None
+
+
+def _split_args(tokens: List[tokenize.TokenInfo]) -> List[List[tokenize.TokenInfo]]:
+    """
+    Split the tokens between two brackets at top-level commas
+    """
+    args: List[List[tokenize.TokenInfo]] = [[]]
+    depth = 0
+    for token in tokens:
+        if token.type == tokenize.OP and token.string in "([{":
+            depth += 1
+        elif token.type == tokenize.OP and token.string in ")]}":
+            depth -= 1
+        if depth == 0 and token.type == tokenize.OP and token.string == ",":
+            args.append([])
+        else:
+            args[-1].append(token)
+    if not args[-1]:
+        args.pop()
+    return args
+
+
+def _source(code_lines: List[str], tokens: List[tokenize.TokenInfo]) -> str:
+    """
+    Original text spanned by a run of tokens
+    """
+    (start_row, start_col), (end_row, end_col) = tokens[0].start, tokens[-1].end
+    if start_row == end_row:
+        return code_lines[start_row - 1][start_col:end_col]
+    text = [code_lines[start_row - 1][start_col:]]
+    text += code_lines[start_row:end_row - 1]
+    text.append(code_lines[end_row - 1][:end_col])
+    return "".join(text)
+
+
+def _parses(code: str) -> bool:
+    try:
+        ast.parse(code)
+        return True
+    except (SyntaxError, ValueError):
+        return False
+
+
+@register_rule("python", "Removed {count} redundant `object` base class(es)", since=(3,))
+def _object_base(code: str) -> Tuple[str, int]:
+    tokens = _tokens(code)
+    if tokens is None:
+        return code, 0
+    sig = _significant(tokens)
+    edits = []
+    for i in range(len(sig) - 5):
+        if (sig[i].string == "class" and sig[i + 1].type == tokenize.NAME and sig[i + 2].string == "("
+                and sig[i + 3].string == "object" and sig[i + 4].string == ")" and sig[i + 5].string == ":"):
+            edits.append((sig[i + 2].start, sig[i + 4].end, ""))
+    return _apply_edits(code, edits), len(edits)
+
+
+@register_rule("python", "Rewrote {count} `except X, e` clause(s) as `except X as e`", since=(3,), before=(3,))
+def _except_as(code: str) -> Tuple[str, int]:
+    tokens = _tokens(code)
+    if tokens is None:
+        return code, 0
+    sig = _significant(tokens)
+    edits = []
+    for i, token in enumerate(sig):
+        if token.string != "except":
+            continue
+        if i + 1 < len(sig) and sig[i + 1].string == "(":
+            close = _matching(sig, i + 1)
+            j = close + 1 if close is not None else len(sig)
+        else:
+            j = i + 1
+            while j < len(sig) and (sig[j].type == tokenize.NAME or sig[j].string == "."):
+                j += 1
+        if j + 2 < len(sig) and sig[j].string == "," and sig[j + 1].type == tokenize.NAME and sig[j + 2].string == ":":
+            edits.append((sig[j].start, sig[j + 1].start, " as "))
+    return _apply_edits(code, edits), len(edits)
+
+
+_PY2_RENAMES = {"xrange": "range", "raw_input": "input", "iteritems": "items", "iterkeys": "keys", "itervalues": "values"}
+
+
+@register_rule("python", "Renamed {count} Python 2 builtin(s) (xrange, raw_input, iteritems, ...)", since=(3,), before=(3,))
+def _py2_builtins(code: str) -> Tuple[str, int]:
+    tokens = _tokens(code)
+    if tokens is None:
+        return code, 0
+    sig = _significant(tokens)
+    edits = []
+    for i, token in enumerate(sig):
+        if token.type != tokenize.NAME or token.string not in _PY2_RENAMES:
+            continue
+        is_method = token.string.startswith("iter")
+        if is_method != (i > 0 and sig[i - 1].string == "."):
+            continue
+        if i + 1 < len(sig) and sig[i + 1].string == "(":
+            edits.append((token.start, token.end, _PY2_RENAMES[token.string]))
+    return _apply_edits(code, edits), len(edits)
+
+
+@register_rule("python", "Converted {count} `print` statement(s) to print() calls", since=(3,), before=(3,))
+def _print_function(code: str) -> Tuple[str, int]:
+    tokens = _tokens(code)
+    if tokens is None:
+        return code, 0
+    edits = []
+    line_start = True
+    for i, token in enumerate(tokens):
+        if token.type in (tokenize.NEWLINE, tokenize.INDENT, tokenize.DEDENT):
+            line_start = True
+            continue
+        if token.type in (tokenize.NL, tokenize.COMMENT):
+            continue
+        if line_start and token.string == "print":
+            rest = []
+            for t in tokens[i + 1:]:
+                if t.type in (tokenize.NEWLINE, tokenize.COMMENT, tokenize.ENDMARKER):
+                    break
+                rest.append(t)
+            significant = [t for t in rest if t.type != tokenize.NL]
+            if not significant:
+                edits.append((token.end, token.end, "()"))
+            elif (significant[0].string not in ("(", "=", ".", ",", ">>", "[")
+                    and significant[-1].string != "," and not significant[0].string.endswith("=")):
+                edits.append((token.end, significant[-1].end, "(" + _source(code.splitlines(keepends=True), significant) + ")"))
+        line_start = False
+    return _apply_edits(code, edits), len(edits)
+
+
+def _super_calls(code: str) -> Optional[Set[Tuple[int, int]]]:
+    """
+    (row, col) of the `super(Class, self)` calls that mean the same as
+    `super()`: Class is the enclosing class and the call sits directly in
+    one of its methods, with that method's first parameter. In nested
+    functions, lambdas and comprehensions `super()` would fail.
+    """
+    try:
+        tree = ast.parse(code)
+    except (SyntaxError, ValueError):
+        return None
+    code_lines = code.splitlines()
+    found = set()
+
+    def visit(node: ast.AST, class_name: str, first: str) -> None:
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda, ast.ClassDef,
+                                  ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp)):
+                continue
+            if (isinstance(child, ast.Call) and isinstance(child.func, ast.Name) and child.func.id == "super"
+                    and len(child.args) == 2 and not child.keywords
+                    and isinstance(child.args[0], ast.Name) and child.args[0].id == class_name
+                    and isinstance(child.args[1], ast.Name) and child.args[1].id == first):
+                # ast columns are UTF-8 byte offsets, tokenize's are characters
+                line = code_lines[child.lineno - 1].encode("utf-8")
+                found.add((child.lineno, len(line[:child.col_offset].decode("utf-8", "replace"))))
+            visit(child, class_name, first)
+
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.ClassDef):
+            continue
+        for method in node.body:
+            if isinstance(method, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                params = method.args.posonlyargs + method.args.args
+                if params:
+                    visit(method, node.name, params[0].arg)
+    return found
+
+
+# Runs after the print/except rewrites, which make Python 2 code parse
+@register_rule("python", "Replaced {count} `super(Class, self)` call(s) with `super()`", since=(3,))
+def _zero_arg_super(code: str) -> Tuple[str, int]:
+    tokens = _tokens(code)
+    calls = _super_calls(code) if tokens is not None else None
+    if not calls:
+        return code, 0
+    sig = _significant(tokens)
+    edits = []
+    for i in range(len(sig) - 5):
+        if (sig[i].string == "super" and sig[i].start in calls and sig[i + 1].string == "("
+                and sig[i + 2].type == tokenize.NAME and sig[i + 3].string == ","
+                and sig[i + 4].type == tokenize.NAME and sig[i + 5].string == ")"):
+            edits.append((sig[i + 1].end, sig[i + 5].start, ""))
+    return _apply_edits(code, edits), len(edits)
+
+
+def _local_bindings(code: str) -> Optional[Set[str]]:
+    """
+    Names the code binds itself (assignments, parameters, definitions,
+    imports), leaving out plain `from typing import X`. None if it does
+    not parse.
+    """
+    try:
+        tree = ast.parse(code)
+    except (SyntaxError, ValueError):
+        return None
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, (ast.Store, ast.Del)):
+            names.add(node.id)
+        elif isinstance(node, ast.arg):
+            names.add(node.arg)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(node.name)
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            names.add(node.name)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            from_typing = isinstance(node, ast.ImportFrom) and node.module == "typing"
+            for alias in node.names:
+                if not (from_typing and alias.asname is None):
+                    names.add(alias.asname or alias.name.split(".")[0])
+    return names
+
+
+@register_rule("python", "Replaced {count} empty `dict()` / `list()` call(s) with literals")
+def _empty_literals(code: str) -> Tuple[str, int]:
+    tokens = _tokens(code)
+    bound = _local_bindings(code) if tokens is not None else None
+    if bound is None:
+        return code, 0
+    sig = _significant(tokens)
+    edits = []
+    for i in range(len(sig) - 2):
+        if (sig[i].string in ("dict", "list") and sig[i].string not in bound
+                and sig[i + 1].string == "(" and sig[i + 2].string == ")"
+                and not (i > 0 and sig[i - 1].string in (".", "def", "class"))):
+            edits.append((sig[i].start, sig[i + 2].end, "{}" if sig[i].string == "dict" else "[]"))
+    return _apply_edits(code, edits), len(edits)
+
+
+_PERCENT_SPEC = re.compile(r"%(?:(%)|([-+ 0#]*)(\d*)(?:\.(\d+))?([srafFeEgGxXo]))")
+_SIMPLE_ARG = re.compile(r"^[A-Za-z_][\w.]*$")
+
+
+def _string_parts(token: str) -> Optional[Tuple[str, str, str]]:
+    """
+    Split a plain (non-raw, non-bytes, non-f) string literal into
+    (prefix, quote, body)
+    """
+    match = re.match(r"^([uU]?)('''|\"\"\"|'|\")(.*)\2$", token, re.S)
+    if not match:
+        return None
+    return match.group(1), match.group(2), match.group(3)
+
+
+def _arg_text(code_lines: List[str], tokens: List[tokenize.TokenInfo], quote: str) -> Optional[str]:
+    """
+    Source of an argument if it can be inlined into an f-string replacement field
+    """
+    if not tokens or any(t.type == tokenize.STRING for t in tokens):
+        return None
+    if tokens[0].string in ("*", "**") or any(t.string in ("lambda", ":=", "yield", "await") for t in tokens):
+        return None
+    text = _source(code_lines, tokens).strip()
+    if "\n" in text or "\\" in text or "#" in text or "{" in text or "}" in text or quote[0] in text:
+        return None
+    return text
+
+
+def _format_to_fstring(body: str, positional: List[str], named: Dict[str, str]) -> Optional[Tuple[str, bool]]:
+    """
+    Rebuild a str.format template with its arguments inlined
+
+    Returns:
+        (f-string body, whether every argument was used) or None if unsupported
+    """
+    pieces = []
+    used = set()
+    auto = 0
+    try:
+        parsed = list(Formatter().parse(body))
+    except ValueError:
+        return None
+    for literal, field_name, spec, conversion in parsed:
+        pieces.append(literal.replace("{", "{{").replace("}", "}}"))
+        if field_name is None:
+            continue
+        if spec and ("{" in spec or "}" in spec):
+            return None
+        match = re.match(r"^(\w*)(.*)$", field_name)
+        base, rest = match.group(1), match.group(2)
+        if re.search(r"\[[^\]0-9]", rest):
+            return None
+        if base == "":
+            key = auto
+            auto += 1
+        elif base.isdigit():
+            key = int(base)
+        else:
+            key = base
+        value = positional[key] if isinstance(key, int) and key < len(positional) else named.get(key)
+        if value is None:
+            return None
+        if key in used and not _SIMPLE_ARG.match(value):
+            # Repeating an expression would repeat its side effects
+            return None
+        used.add(key)
+        if rest and not _SIMPLE_ARG.match(value):
+            value = f"({value})"
+        pieces.append("{" + value + rest + (f"!{conversion}" if conversion else "") + (f":{spec}" if spec else "") + "}")
+    all_used = used == set(range(len(positional))) | set(named)
+    return "".join(pieces), all_used
+
+
+def _percent_to_fstring(body: str, args: List[str]) -> Optional[str]:
+    pieces = []
+    position = 0
+    index = 0
+    for match in _PERCENT_SPEC.finditer(body):
+        if "%" in body[position:match.start()]:
+            return None  # %d, %(name)s and friends are left alone
+        pieces.append(body[position:match.start()].replace("{", "{{").replace("}", "}}"))
+        position = match.end()
+        if match.group(1):
+            pieces.append("%")
+            continue
+        flags, width, precision, kind = match.group(2), match.group(3), match.group(4), match.group(5)
+        if index >= len(args):
+            return None
+        value = args[index]
+        index += 1
+        if kind in "sra":
+            # Width on %s means str() padding, which format() does not match for non-strings
+            if flags or width or precision:
+                return None
+            pieces.append("{" + value + ("" if kind == "s" else "!" + kind) + "}")
+        else:
+            if "-" in flags or "#" in flags:
+                return None
+            spec = flags + width + (f".{precision}" if precision else "") + kind
+            pieces.append("{" + value + ":" + spec + "}")
+    if "%" in body[position:] or index != len(args):
+        return None
+    pieces.append(body[position:].replace("{", "{{").replace("}", "}}"))
+    return "".join(pieces)
+
+
+@register_rule("python", "Converted {count} str.format() / % formatting call(s) to f-strings", since=(3, 6), level="moderate")
+def _fstrings(code: str) -> Tuple[str, int]:
+    tokens = _tokens(code)
+    if tokens is None:
+        return code, 0
+    code_lines = code.splitlines(keepends=True)
+    sig = _significant(tokens)
+    edits = []
+    for i, token in enumerate(sig):
+        if token.type != tokenize.STRING or (i > 0 and sig[i - 1].type == tokenize.STRING):
+            continue
+        if i + 1 < len(sig) and sig[i + 1].type == tokenize.STRING:
+            continue  # implicit concatenation
+        parts = _string_parts(token.string)
+        if parts is None or i + 2 >= len(sig):
+            continue
+        prefix, quote, body = parts
+        if "\n" in body and len(quote) == 1:
+            continue
+        replacement = None
+        if sig[i + 1].string == "." and sig[i + 2].string == "format" and i + 3 < len(sig) and sig[i + 3].string == "(":
+            close = _matching(sig, i + 3)
+            if close is None:
+                continue
+            positional, named = [], {}
+            ok = True
+            for arg in _split_args(sig[i + 4:close]):
+                if len(arg) > 2 and arg[0].type == tokenize.NAME and arg[1].string == "=":
+                    text = _arg_text(code_lines, arg[2:], quote)
+                    named[arg[0].string] = text
+                else:
+                    text = _arg_text(code_lines, arg, quote)
+                    positional.append(text)
+                ok = ok and text is not None
+            if not ok:
+                continue
+            rebuilt = _format_to_fstring(body, positional, named)
+            if rebuilt is not None and rebuilt[1]:
+                replacement = (sig[close].end, rebuilt[0])
+        elif sig[i + 1].string == "%" and sig[i + 2].string == "(":
+            close = _matching(sig, i + 2)
+            if close is None:
+                continue
+            inner = sig[i + 3:close]
+            args = _split_args(inner)
+            # Only tuple literals: "%s" % value changes meaning if value is a tuple
+            if len(args) == 1 and not (inner and inner[-1].string == ","):
+                continue
+            texts = [_arg_text(code_lines, arg, quote) for arg in args]
+            if None in texts:
+                continue
+            rebuilt = _percent_to_fstring(body, texts)
+            if rebuilt is not None:
+                replacement = (sig[close].end, rebuilt)
+        if replacement is not None:
+            edits.append((token.start, replacement[0], "f" + quote + replacement[1] + quote))
+    return _apply_edits(code, edits), len(edits)
+
+
+_TYPING_BUILTINS = {"List": "list", "Dict": "dict", "Set": "set", "FrozenSet": "frozenset", "Tuple": "tuple", "Type": "type"}
+
+
+def _prune_typing_imports(code: str) -> str:
+    """
+    Drop names from `from typing import ...` that are no longer referenced
+    """
+    tokens = _tokens(code)
+    if tokens is None:
+        return code
+    sig = _significant(tokens)
+    statements = []
+    for i in range(len(sig) - 2):
+        if sig[i].string == "from" and sig[i + 1].string == "typing" and sig[i + 2].string == "import":
+            j = i + 3
+            while j < len(sig) and sig[j].type != tokenize.NEWLINE:
+                j += 1
+            statements.append((i, j))
+    if not statements:
+        return code
+    inside = {k for start, end in statements for k in range(start, end)}
+    used = {t.string for k, t in enumerate(sig) if t.type == tokenize.NAME and k not in inside}
+    edits = []
+    for start, end in statements:
+        names = [t for t in sig[start + 3:end] if t.string not in ("(", ")", ",")]
+        if any(t.type != tokenize.NAME or t.string == "as" for t in names):
+            continue
+        span = [t for t in tokens if sig[start].start <= t.start and t.end <= sig[end - 1].end]
+        if any(t.type == tokenize.COMMENT for t in span):
+            continue
+        kept = [t.string for t in names if t.string in used]
+        if len(kept) == len(names):
+            continue
+        if kept:
+            edits.append((sig[start].start, sig[end - 1].end, "from typing import " + ", ".join(kept)))
+        else:
+            # Remove the whole line including its newline
+            edits.append(((sig[start].start[0], 0), (sig[end].end[0] + 1, 0), ""))
+    return _apply_edits(code, edits)
+
+
+@register_rule("python", "Replaced {count} typing generic(s) (List, Dict, ...) with builtin generics", since=(3, 9), level="moderate")
+def _builtin_generics(code: str) -> Tuple[str, int]:
+    tokens = _tokens(code)
+    bound = _local_bindings(code) if tokens is not None else None
+    if bound is None:
+        return code, 0
+    sig = _significant(tokens)
+    edits = []
+    for i in range(len(sig) - 1):
+        token = sig[i]
+        if token.type != tokenize.NAME or token.string not in _TYPING_BUILTINS or sig[i + 1].string != "[":
+            continue
+        if i >= 2 and sig[i - 1].string == "." and sig[i - 2].string == "typing":
+            edits.append((sig[i - 2].start, token.end, _TYPING_BUILTINS[token.string]))
+        elif (i == 0 or sig[i - 1].string != ".") and token.string not in bound:
+            edits.append((token.start, token.end, _TYPING_BUILTINS[token.string]))
+    if not edits:
+        return code, 0
+    return _prune_typing_imports(_apply_edits(code, edits)), len(edits)
+
+
+@register_rule("python", "Rewrote {count} Optional[...] / Union[...] annotation(s) with `|`", since=(3, 10), level="moderate")
+def _union_operator(code: str) -> Tuple[str, int]:
+    count = 0
+    # Nested unions are rewritten from the inside out, one level per pass
+    for _ in range(5):
+        tokens = _tokens(code)
+        if tokens is None:
+            break
+        code_lines = code.splitlines(keepends=True)
+        sig = _significant(tokens)
+        edits = []
+        for i in range(len(sig) - 1):
+            token = sig[i]
+            if token.string not in ("Optional", "Union") or sig[i + 1].string != "[":
+                continue
+            if i > 0 and sig[i - 1].string == "." and not (i >= 2 and sig[i - 2].string == "typing"):
+                continue
+            close = _matching(sig, i + 1)
+            inner = sig[i + 2:close] if close else []
+            # Forward references in strings cannot be combined with |
+            if not inner or any(t.type == tokenize.STRING or t.string in ("Optional", "Union") for t in inner):
+                continue
+            members = [_source(code_lines, arg).strip() for arg in _split_args(inner)]
+            if token.string == "Optional":
+                if len(members) != 1:
+                    continue
+                members.append("None")
+            start = sig[i - 2].start if i >= 2 and sig[i - 1].string == "." else token.start
+            edits.append((start, sig[close].end, " | ".join(members)))
+        if not edits:
+            break
+        code = _apply_edits(code, edits)
+        count += len(edits)
+    return (_prune_typing_imports(code) if count else code), count
+
+
+def _strip_comments(code: str) -> Tuple[str, int]:
+    tokens = _tokens(code)
+    if tokens is None:
+        return code, 0
+    code_lines = code.splitlines(keepends=True)
+    edits = []
+    for token in tokens:
+        if token.type != tokenize.COMMENT or token.string.startswith(("#!", "# -*-", "# type:")):
+            continue
+        line = code_lines[token.start[0] - 1]
+        if not line[:token.start[1]].strip():
+            # Comment on its own line: drop the line
+            edits.append(((token.start[0], 0), (token.start[0] + 1, 0), ""))
+        else:
+            start = len(line[:token.start[1]].rstrip())
+            edits.append(((token.start[0], start), token.end, ""))
+    return _apply_edits(code, edits), len(edits)
+
+
+# Names whose Python 2 behavior has no mechanical Python 3 equivalent
+_PY2_SEMANTIC = {
+    "unicode", "basestring", "long", "cmp", "reduce", "has_key", "execfile", "file", "unichr", "apply",
+    "buffer", "coerce", "intern", "reload", "__nonzero__", "__unicode__", "__div__", "__idiv__", "__rdiv__",
+    "__cmp__", "__metaclass__", "__getslice__", "__setslice__", "__delslice__", "__coerce__", "__hex__", "__oct__"
+}
+# Attributes removed or renamed in Python 3 (sys.maxint, string.letters, method.im_func, ...)
+_PY2_ATTRIBUTES = {
+    "maxint", "letters", "lowercase", "uppercase", "getcwdu", "im_func", "im_self", "im_class",
+    "func_name", "func_code", "func_defaults", "func_globals", "func_closure", "func_dict", "next"
+}
+# Standard library modules renamed or removed in Python 3
+_PY2_MODULES = {
+    "urllib2", "urlparse", "cPickle", "cStringIO", "StringIO", "ConfigParser", "Queue", "Tkinter", "tkMessageBox",
+    "httplib", "HTMLParser", "htmlentitydefs", "cookielib", "Cookie", "SocketServer", "SimpleHTTPServer",
+    "BaseHTTPServer", "CGIHTTPServer", "xmlrpclib", "SimpleXMLRPCServer", "robotparser", "commands", "__builtin__",
+    "thread", "dummy_thread", "copy_reg", "repr", "anydbm", "dbhash", "whichdb", "dumbdbm", "gdbm", "md5", "sha",
+    "sets", "exceptions", "UserDict", "UserList", "UserString", "new", "popen2", "mimetools", "rfc822"
+}
+# urllib functions that moved to urllib.request / urllib.parse
+_PY2_URLLIB = {"urlopen", "urlencode", "quote", "quote_plus", "unquote", "unquote_plus", "urlretrieve", "pathname2url"}
+# Calls that returned lists in Python 2 and return iterators or views in Python 3
+_PY2_LIST_FUNCTIONS = {"map", "filter", "zip"}
+_PY2_LIST_METHODS = {"keys", "values", "items"}
+# Consumers for which an iterator or view works the same as the old list
+_ITERATES = {"list", "tuple", "set", "frozenset", "sorted", "dict", "any", "all", "sum", "min", "max", "enumerate", "join"}
+_TYPING_LEGACY = set(_TYPING_BUILTINS) | {"Optional", "Union"}
+
+
+def _py2_lines(tree: ast.AST) -> Set[int]:
+    """
+    Lines of valid Python 3 syntax whose Python 2 meaning differs: renamed
+    modules, removed attributes and list-returning calls whose result is
+    used as a list
+    """
+    parents = {child: node for node in ast.walk(tree) for child in ast.iter_child_nodes(node)}
+    flagged = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            if any(alias.name.split(".")[0] in _PY2_MODULES for alias in node.names):
+                flagged.add(node.lineno)
+        elif isinstance(node, ast.ImportFrom) and node.module and node.level == 0:
+            root = node.module.split(".")[0]
+            if root in _PY2_MODULES or (root == "urllib" and any(a.name in _PY2_URLLIB for a in node.names)):
+                flagged.add(node.lineno)
+        elif isinstance(node, ast.Attribute):
+            if node.attr in _PY2_ATTRIBUTES and not (node.attr == "next" and not isinstance(parents.get(node), ast.Call)):
+                flagged.add(node.lineno)
+            elif isinstance(node.value, ast.Name) and node.value.id == "urllib" and node.attr in _PY2_URLLIB:
+                flagged.add(node.lineno)
+        elif isinstance(node, ast.Call):
+            func = node.func
+            returns_list = (
+                (isinstance(func, ast.Name) and func.id in _PY2_LIST_FUNCTIONS)
+                or (isinstance(func, ast.Attribute) and func.attr in _PY2_LIST_METHODS and not node.args)
+            )
+            if not returns_list:
+                continue
+            parent = parents.get(node)
+            if isinstance(parent, (ast.For, ast.AsyncFor, ast.comprehension)) and parent.iter is node:
+                continue
+            if isinstance(parent, ast.Call) and node in parent.args:
+                callee = parent.func
+                name = callee.id if isinstance(callee, ast.Name) else getattr(callee, "attr", None)
+                if name in _ITERATES or name in _PY2_LIST_FUNCTIONS:
+                    continue
+                # Views have a length; iterators do not
+                if name == "len" and isinstance(func, ast.Attribute):
+                    continue
+            if isinstance(parent, ast.Compare) and node in parent.comparators and all(
+                isinstance(op, (ast.In, ast.NotIn)) for op in parent.ops
+            ):
+                continue
+            # Indexed, sorted in place, concatenated, stored for later, ...
+            flagged.add(node.lineno)
+    return flagged
+
+
+def _python_residual(code: str, source: Optional[Tuple[int, ...]], target: Optional[Tuple[int, ...]], level: str) -> Optional[List[int]]:
+    """
+    Lines still holding legacy constructs the rules did not (or may not
+    safely) rewrite
+
+    Returns:
+        Flagged line numbers, or None when the code needs the model as a whole
+    """
+    tokens = _tokens(code)
+    if tokens is None or not _parses(code):
+        return None
+    rank = LEVELS.get(level, LEVELS["moderate"])
+    target = target or (99,)
+    bound = _local_bindings(code)
+    flagged = set()
+    sig = _significant(tokens)
+    for i, token in enumerate(sig):
+        following = sig[i + 1].string if i + 1 < len(sig) else ""
+        if rank >= 1 and target >= (3, 6) and token.type == tokenize.STRING and following in (".", "%"):
+            if following == "%" or (i + 2 < len(sig) and sig[i + 2].string == "format"):
+                flagged.add(token.start[0])
+        if rank >= 1 and target >= (3, 9) and token.string in _TYPING_LEGACY and following == "[":
+            if (target >= (3, 10) or token.string in _TYPING_BUILTINS) and token.string not in bound:
+                flagged.add(token.start[0])
+        if source is not None and source < (3,) and target >= (3,):
+            if token.type == tokenize.NAME and token.string in _PY2_SEMANTIC:
+                flagged.add(token.start[0])
+            # Integer division changed meaning
+            if token.type == tokenize.OP and token.string in ("/", "/="):
+                flagged.add(token.start[0])
+    if source is not None and source < (3,) and target >= (3,):
+        flagged |= _py2_lines(ast.parse(code))
+
+    if rank >= 2:
+        tree = ast.parse(code)
+        for node in ast.walk(tree):
+            # os.path -> pathlib
+            if isinstance(node, ast.Attribute) and node.attr == "path" and isinstance(node.value, ast.Name) and node.value.id == "os":
+                flagged.add(node.lineno)
+            # Classes whose __init__ only stores its arguments -> dataclasses
+            if isinstance(node, ast.FunctionDef) and node.name == "__init__" and node.body and all(
+                isinstance(stmt, ast.Assign) and isinstance(stmt.value, ast.Name) for stmt in node.body
+            ):
+                flagged.add(node.lineno)
+            # Long if/elif chains on one value -> match (3.10+)
+            if target >= (3, 10) and isinstance(node, ast.If):
+                branches, current = 0, node
+                while isinstance(current, ast.If) and isinstance(current.test, ast.Compare):
+                    branches += 1
+                    current = current.orelse[0] if len(current.orelse) == 1 else None
+                if branches >= 3:
+                    flagged.add(node.lineno)
+    return sorted(flagged)
+
+
+def _python_segments(code: str, lines: List[int]) -> List[Tuple[int, int]]:
+    """
+    Widen flagged lines to the top-level statements containing them
+    """
+    tree = ast.parse(code)
+    segments: List[Tuple[int, int]] = []
+    for node in tree.body:
+        start = min([node.lineno] + [d.lineno for d in getattr(node, "decorator_list", [])])
+        if any(start <= line <= node.end_lineno for line in lines):
+            if segments and segments[-1][1] >= start - 1:
+                segments[-1] = (segments[-1][0], node.end_lineno)
+            else:
+                segments.append((start, node.end_lineno))
+    return segments
+
+
+# ---------------------------------------------------------------------------
+# Java: rewrites on a copy with strings and comments blanked out
+# ---------------------------------------------------------------------------
+
+_JAVA_LITERAL = re.compile(r'//[^\n]*|/\*.*?\*/|"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\'', re.S)
+
+FUNCTIONAL_INTERFACES = {
+    "Runnable", "Callable", "Comparator", "ActionListener", "ChangeListener", "ItemListener",
+    "Supplier", "Consumer", "BiConsumer", "Function", "BiFunction", "Predicate", "BiPredicate",
+    "UnaryOperator", "BinaryOperator", "FileFilter", "FilenameFilter", "ThreadFactory",
+}
+
+
+def _mask_java(code: str) -> str:
+    """
+    Same-length copy with string, char and comment contents replaced by spaces
+    """
+    def blank(match: re.Match) -> str:
+        text = match.group(0)
+        return text[0] + re.sub(r"[^\n]", " ", text[1:-1]) + text[-1] if len(text) > 1 else text
+
+    return _JAVA_LITERAL.sub(blank, code)
+
+
+def _java_close(masked: str, open_index: int) -> Optional[int]:
+    depth = 0
+    for i in range(open_index, len(masked)):
+        if masked[i] == "{":
+            depth += 1
+        elif masked[i] == "}":
+            depth -= 1
+            if depth == 0:
+                return i
+    return None
+
+
+def _dedent_body(code: str, start: int, body_open: int, body_close: int) -> str:
+    """
+    Method body re-indented from the method's level to the enclosing statement's
+    """
+    def indent(index: int) -> int:
+        line = code[code.rfind("\n", 0, index) + 1:]
+        return len(line) - len(line.lstrip(" "))
+
+    delta = indent(body_open) - indent(start)
+    lines = code[body_open:body_close + 1].split("\n")
+    if delta <= 0:
+        return "\n".join(lines)
+    return "\n".join([lines[0]] + [line[min(delta, len(line) - len(line.lstrip(" "))):] for line in lines[1:]])
+
+
+_ANONYMOUS = re.compile(r"new\s+(?:[\w.]+\.)?(\w+)\s*(?:<[^{};()]*>)?\s*\(\s*\)\s*\{")
+_SINGLE_METHOD = re.compile(
+    r"\s*(?:@Override\s+)?(?:public\s+)?(?:final\s+)?[\w<>\[\],.?\s]+?\s+\w+\s*\(([^()]*)\)\s*(?:throws\s+[\w.,\s]+?)?\s*\{"
+)
+
+
+_JAVA_DECLARATION = re.compile(
+    r"\b([A-Za-z_$][\w$.]*)(?:\s*<[^;{}()]*>)?(?:\s*\[\s*\])*\s+([A-Za-z_$][\w$]*)\s*(?=[=;,:)])"
+)
+_JAVA_LAMBDA_PARAMS = re.compile(r"(?:\(([\w$\s,]*)\)|\b([A-Za-z_$][\w$]*))\s*->")
+# Words that can precede a name without declaring it
+_JAVA_NOT_TYPES = {"return", "new", "else", "throw", "case", "yield", "assert", "instanceof", "goto"}
+
+
+def _java_declared(masked: str) -> Set[str]:
+    """
+    Names declared in a stretch of masked Java: locals, parameters, catch
+    and for-each variables and lambda parameters. Errs towards too many.
+    """
+    names = {m.group(2) for m in _JAVA_DECLARATION.finditer(masked) if m.group(1) not in _JAVA_NOT_TYPES}
+    for match in _JAVA_LAMBDA_PARAMS.finditer(masked):
+        names |= set(re.findall(r"[A-Za-z_$][\w$]*", match.group(1) or match.group(2)))
+    return names
+
+
+def _java_method_span(masked: str, index: int) -> Optional[Tuple[int, int]]:
+    """
+    (start, end) of the outermost method or constructor whose body contains
+    index, from its parameter list to its closing brace
+    """
+    stack = []
+    for i in range(index):
+        if masked[i] == "{":
+            stack.append(i)
+        elif masked[i] == "}" and stack:
+            stack.pop()
+    for brace in stack:
+        header_start = max(masked.rfind(c, 0, brace) for c in ";{}") + 1
+        header = masked[header_start:brace]
+        if (re.search(r"\)\s*(?:throws\s+[\w.,\s]+)?$", header) and not re.search(r"\bnew\b", header)
+                and not re.search(r"\b(?:if|for|while|switch|catch|synchronized|try)\s*\(", header)):
+            close = _java_close(masked, brace)
+            return header_start, close if close is not None else len(masked)
+    return None
+
+
+@register_rule("java", "Replaced {count} anonymous functional-interface class(es) with lambdas", since=(8,), level="moderate")
+def _java_lambdas(code: str) -> Tuple[str, int]:
+    count = 0
+    starts = [m.start() for m in _ANONYMOUS.finditer(_mask_java(code))]
+    # Innermost (last) first; earlier starts are unaffected by later edits
+    for start in reversed(starts):
+        masked = _mask_java(code)
+        match = _ANONYMOUS.match(masked, start)
+        if not match or match.group(1) not in FUNCTIONAL_INTERFACES:
+            continue
+        class_open = match.end() - 1
+        class_close = _java_close(masked, class_open)
+        if class_close is None:
+            continue
+        method = _SINGLE_METHOD.match(masked, class_open + 1, class_close)
+        if not method:
+            continue
+        body_open = method.end() - 1
+        body_close = _java_close(masked, body_open)
+        if body_close is None or masked[body_close + 1:class_close].strip():
+            continue
+        body = _dedent_body(code, start, body_open, body_close)
+        # `this` refers to the anonymous instance; lambdas would change it
+        if re.search(r"\b(this|super)\b", masked[body_open:body_close]):
+            continue
+        params = [p.strip() for p in re.split(r",(?![^<]*>)", method.group(1)) if p.strip()]
+        names = [re.sub(r"\[\]$", "", p.split()[-1]) for p in params]
+        # A lambda, unlike a class, shares the enclosing scope: its parameters
+        # and locals must not redeclare the enclosing method's
+        span = _java_method_span(masked, start)
+        if span is not None:
+            outside = masked[span[0]:start] + masked[class_close + 1:span[1]]
+            if _java_declared(outside) & (set(names) | _java_declared(masked[body_open:body_close])):
+                continue
+        head = names[0] if len(names) == 1 else "(" + ", ".join(names) + ")"
+        single = re.fullmatch(r"\{\s*return\s+([^;{}]+);\s*\}", masked[body_open:body_close + 1])
+        if single and "//" not in body and "/*" not in body:
+            lambda_text = f"{head} -> {code[body_open + 1:body_close].strip()[len('return'):].strip().rstrip(';').strip()}"
+        else:
+            lambda_text = f"{head} -> {body}"
+        code = code[:start] + lambda_text + code[class_close + 1:]
+        count += 1
+    return code, count
+
+
+_EXPLICIT_GENERIC = re.compile(r"(=\s*new\s+[\w.]+)<([\w\s,.<>?\[\]]+)>(\s*\()")
+
+
+@register_rule("java", "Replaced {count} explicit constructor type argument(s) with the diamond operator", since=(7,))
+def _java_diamond(code: str) -> Tuple[str, int]:
+    masked = _mask_java(code)
+    edits = []
+    for match in _EXPLICIT_GENERIC.finditer(masked):
+        close = masked.find(")", match.end())
+        after = masked[close + 1:close + 40].lstrip() if close != -1 else ""
+        declaration = masked[masked.rfind("\n", 0, match.start()) + 1:match.start()]
+        # Anonymous classes only accept <> from Java 9 on, and `var` would infer Object
+        if not after.startswith("{") and not re.search(r"\bvar\s+\w+\s*$", declaration):
+            edits.append((match.start(2) - 1, match.end(2) + 1))
+    for start, end in reversed(edits):
+        code = code[:start] + "<>" + code[end:]
+    return code, len(edits)
+
+
+_JAVA_RESIDUAL = [
+    ((1,), 1, re.compile(r"\bStringBuffer\b|\bVector\s*<|\bHashtable\s*<|\bEnumeration\s*<")),
+    ((5,), 1, re.compile(r"for\s*\(\s*int\s+\w+\s*=\s*0\s*;\s*\w+\s*<\s*[\w.]+\.(?:size\(\)|length)")),
+    ((5,), 1, re.compile(r"\bIterator\s*<")),
+    ((8,), 1, _ANONYMOUS),
+    ((16,), 1, re.compile(r"instanceof\s+\w+\s*\)\s*\{?\s*\w+\s+\w+\s*=\s*\(\w+\)")),
+    ((14,), 2, re.compile(r"\bswitch\s*\(")),
+    ((16,), 2, re.compile(r"\bfinal\s+class\s+\w+\s*\{[^}]*private\s+final")),
+]
+
+
+def _java_residual(code: str, target: Optional[Tuple[int, ...]], level: str) -> bool:
+    masked = _mask_java(code)
+    rank = LEVELS.get(level, LEVELS["moderate"])
+    target = target or (99,)
+    return any(target >= since and rank >= min_rank and pattern.search(masked) for since, min_rank, pattern in _JAVA_RESIDUAL)
+
+
+def rewrite_code(
+    code: str,
+    language: str,
+    source_version: str,
+    target_version: str,
+    preserve_comments: bool = True,
+    modernization_level: str = "moderate"
+) -> RewriteResult:
+    """
+    Apply the mechanical modernizations for a language and version range
+    locally and work out what is left for the model
+
+    Args:
+        code: Code to modernize
+        language: Source language
+        source_version: Version the code is written for
+        target_version: Version to modernize to
+        preserve_comments: Keep comments; when false they are stripped locally
+        modernization_level: conservative, moderate or aggressive
+
+    Returns:
+        The rewritten code, a description of each change and the line
+        ranges that still need the model (the whole file for unsupported
+        languages or code that does not parse)
+    """
+    language = normalize_language(language)
+    level = (modernization_level or "moderate").lower()
+    source = parse_version(source_version)
+    target = parse_version(target_version)
+    rules = RULES.get(language) if REWRITE_ENABLED else None
+    if not rules:
+        return RewriteResult(code, residual=[(1, code.count("\n") + 1)])
+
+    changes = []
+    parses = language == "python" and _parses(code)
+    steps = [(rule.name, rule.description, rule.apply) for rule in rules if rule.applies(source, target, level)]
+    if language == "python" and not preserve_comments:
+        steps.append(("strip_comments", "Removed {count} comment(s)", _strip_comments))
+    for name, description, apply in steps:
+        rewritten, count = apply(code)
+        if not count:
+            continue
+        # A rule must never turn valid code into invalid code
+        if parses and not _parses(rewritten):
+            continue
+        code = rewritten
+        parses = language == "python" and _parses(code)
+        changes.append(description.format(count=count))
+        metrics.rewrite_rules.inc(count, rule=name)
+
+    whole = [(1, code.count("\n") + 1)]
+    if language == "python":
+        lines = _python_residual(code, source, target, level)
+        residual = whole if lines is None else _python_segments(code, lines)
+    else:
+        residual = whole if _java_residual(code, target, level) else []
+    return RewriteResult(code, changes, residual)
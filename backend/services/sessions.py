@@ -0,0 +1,440 @@
+from typing import Optional, Dict, Any, Awaitable, Callable, List, Tuple
+import asyncio
+import difflib
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from pydantic import BaseModel
+from prompt_builder import build_followup_prompt, output_token_budget
+from services import metrics
+from services.ai_service import ai_service
+
+SESSIONS_DB_PATH = os.getenv("SESSIONS_DB_PATH", "data/sessions.sqlite3")
+SESSIONS_TTL_SECONDS = float(os.getenv("SESSIONS_TTL_SECONDS", str(24 * 3600)))
+# Start a fresh prompt prefix once the diff against it grows past this
+# fraction of the code it was built from
+SESSIONS_REBASE_RATIO = float(os.getenv("SESSIONS_REBASE_RATIO", "0.5"))
+# Follow-up answers are diffs that must apply, so they are sampled greedily by default
+SESSIONS_TEMPERATURE = float(os.getenv("SESSIONS_TEMPERATURE", "0"))
+CONTEXT_LINES = 3
+
+_HUNK_HEADER = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+
+
+class PatchError(Exception):
+    """
+    Raised when a unified diff does not apply to the text it is meant for
+    """
+
+
+class SessionConflictError(Exception):
+    """
+    Raised when a client's diff is based on a different version than the
+    one the session holds
+    """
+
+    def __init__(self, message: str, version: str):
+        super().__init__(message)
+        self.version = version
+
+
+def version_of(text: str) -> str:
+    """
+    Short content hash identifying one version of a session's code or result
+    """
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+def _lines(text: str) -> List[str]:
+    # Only "\n" ends a line; str.splitlines would also split on form feeds etc.
+    return re.findall(r"[^\n]*\n|[^\n]+$", text)
+
+
+def _diff_line(tag: str, line: str) -> List[str]:
+    if line.endswith("\n"):
+        return [tag + line[:-1]]
+    return [tag + line, "\\ No newline at end of file"]
+
+
+def make_patch(old: str, new: str, name: str = "code") -> str:
+    """
+    Unified diff turning old into new, as produced by diff -u / git diff
+
+    Args:
+        old: The text the receiver already has
+        new: The text the receiver should end up with
+        name: File name used in the ---/+++ header
+
+    Returns:
+        The diff, or "" when the texts are equal
+    """
+    a, b = _lines(old), _lines(new)
+    out: List[str] = []
+    for group in difflib.SequenceMatcher(None, a, b, autojunk=False).get_grouped_opcodes(CONTEXT_LINES):
+        if not out:
+            out += [f"--- a/{name}", f"+++ b/{name}"]
+        i1, i2, j1, j2 = group[0][1], group[-1][2], group[0][3], group[-1][4]
+        # An empty range is numbered by the line before it
+        out.append(f"@@ -{i1 + 1 if i2 > i1 else i1},{i2 - i1} +{j1 + 1 if j2 > j1 else j1},{j2 - j1} @@")
+        for tag, x1, x2, y1, y2 in group:
+            if tag == "equal":
+                for line in a[x1:x2]:
+                    out += _diff_line(" ", line)
+                continue
+            for line in a[x1:x2]:
+                out += _diff_line("-", line)
+            for line in b[y1:y2]:
+                out += _diff_line("+", line)
+    return "\n".join(out) + "\n" if out else ""
+
+
+def is_patch(text: str) -> bool:
+    return any(line.startswith("@@") for line in text.split("\n"))
+
+
+def _parse_hunks(patch: str) -> List[Tuple[Optional[int], List[str], List[str]]]:
+    """
+    Split a unified diff into (old start, old lines, new lines) hunks. Hunk
+    counts are not trusted, since hand-edited and model-written diffs often
+    get them wrong: a hunk runs until the next header.
+    """
+    hunks: List[Tuple[Optional[int], List[str], List[str]]] = []
+    old: List[str] = []
+    new: List[str] = []
+    last: List[List[str]] = []
+    patch = patch.replace("\r\n", "\n")
+    if patch.endswith("\n"):
+        patch = patch[:-1]
+    for raw in patch.split("\n"):
+        if raw.startswith("@@"):
+            header = _HUNK_HEADER.match(raw)
+            start = int(header.group(1)) if header else None
+            if header and header.group(2) == "0":
+                # Pure insertion: the start names the line before it
+                start += 1
+            old, new = [], []
+            hunks.append((start, old, new))
+            continue
+        if not hunks or raw.startswith(("--- ", "+++ ", "diff ", "index ")):
+            continue
+        if raw.startswith("\\"):
+            # "\ No newline at end of file" applies to the previous line
+            for target in last:
+                target[-1] = target[-1][:-1]
+            continue
+        tag, line = (raw[0], raw[1:]) if raw else (" ", "")
+        if tag not in " +-":
+            # Editors strip the leading space of blank context lines
+            tag, line = " ", raw
+        line += "\n"
+        last = []
+        if tag in " -":
+            old.append(line)
+            last.append(old)
+        if tag in " +":
+            new.append(line)
+            last.append(new)
+    return hunks
+
+
+def _find(lines: List[str], block: List[str], expected: int, floor: int) -> Optional[int]:
+    """
+    Position of block in lines at or after floor, nearest to expected,
+    matching exactly first and ignoring trailing whitespace (including a
+    missing final newline) second
+    """
+    last = len(lines) - len(block)
+    if last < floor:
+        return None
+    order = sorted(range(floor, last + 1), key=lambda i: abs(i - expected))
+    for same in (lambda x, y: x == y, lambda x, y: x.rstrip() == y.rstrip()):
+        for i in order:
+            if all(same(lines[i + k], block[k]) for k in range(len(block))):
+                return i
+    return None
+
+
+def apply_patch(text: str, patch: str) -> str:
+    """
+    Apply a unified diff, locating each hunk by its context so that shifted
+    line numbers (or missing ones) do not matter
+
+    Args:
+        text: The text the diff was made against
+        patch: The unified diff
+
+    Returns:
+        The patched text
+
+    Raises:
+        PatchError: If the diff has no hunks or a hunk's context is not found
+    """
+    hunks = _parse_hunks(patch)
+    if not hunks:
+        raise PatchError("The diff contains no hunks")
+    lines = _lines(text)
+    floor = 0
+    offset = 0
+    for number, (start, old, new) in enumerate(hunks, 1):
+        expected = start - 1 + offset if start is not None else floor
+        at = _find(lines, old, expected, floor)
+        if at is None:
+            raise PatchError(f"Hunk {number} does not apply" + (f" near line {start}" if start else ""))
+        lines[at:at + len(old)] = new
+        floor = at + len(new)
+        offset += len(new) - len(old)
+    return "".join(lines)
+
+
+_COLUMNS = (
+    "id", "tool", "params", "code", "version", "result", "base_code", "base_answer",
+    "rounds", "created_at", "updated_at", "base_prompt", "base_output"
+)
+
+# The model call a session's prompt prefix replays: the exact prompt, the
+# model's raw answer and the code in that answer, which follow-up diffs patch
+Exchange = Dict[str, str]
+
+
+class SessionStore:
+    """
+    SQLite-backed store of incremental submission sessions: the code a
+    client last submitted, the result it last received and the base round
+    the cached prompt prefix replays (its code, and the prompt and answer
+    of its model call, if it was answered by a single one). Shared between
+    API processes.
+    """
+
+    def __init__(self, path: str = SESSIONS_DB_PATH):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "id TEXT PRIMARY KEY, tool TEXT NOT NULL, params TEXT NOT NULL, code TEXT NOT NULL, "
+            "version TEXT NOT NULL, result TEXT NOT NULL, base_code TEXT NOT NULL, base_answer TEXT NOT NULL, "
+            "rounds INTEGER NOT NULL DEFAULT 0, created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(sessions)")]
+        if "base_prompt" not in columns:
+            # Sessions written before the prefix was stored; they rebase on their next round
+            self._conn.execute("ALTER TABLE sessions ADD COLUMN base_prompt TEXT")
+            self._conn.execute("ALTER TABLE sessions ADD COLUMN base_output TEXT")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated_at)")
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _row(row: Optional[tuple]) -> Optional[Dict[str, Any]]:
+        if row is None:
+            return None
+        session = dict(zip(_COLUMNS, row))
+        session["params"] = json.loads(session["params"])
+        session["result"] = json.loads(session["result"])
+        return session
+
+    def _create(
+        self,
+        tool: str,
+        params: Dict[str, Any],
+        code: str,
+        result: Dict[str, Any],
+        exchange: Optional[Exchange]
+    ) -> Dict[str, Any]:
+        now = time.time()
+        session_id = uuid.uuid4().hex
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM sessions WHERE updated_at < ?", (now - SESSIONS_TTL_SECONDS,)
+            )
+            self._conn.execute(
+                f"INSERT INTO sessions ({', '.join(_COLUMNS)}) VALUES ({', '.join('?' * len(_COLUMNS))})",
+                (session_id, tool, json.dumps(params), code, version_of(code), json.dumps(result),
+                 code, exchange["answer"] if exchange else "", 0, now, now,
+                 exchange["prompt"] if exchange else None, exchange["output"] if exchange else None)
+            )
+        return self._get(session_id, tool)
+
+    def _get(self, session_id: str, tool: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT {', '.join(_COLUMNS)} FROM sessions WHERE id = ? AND tool = ? AND updated_at >= ?",
+                (session_id, tool, time.time() - SESSIONS_TTL_SECONDS)
+            ).fetchone()
+        return self._row(row)
+
+    def _advance(
+        self,
+        session_id: str,
+        version: str,
+        code: str,
+        result: Dict[str, Any],
+        rebased: bool,
+        exchange: Optional[Exchange]
+    ) -> bool:
+        fields = {"code": code, "version": version_of(code), "result": json.dumps(result), "updated_at": time.time()}
+        if rebased:
+            fields["base_code"] = code
+            fields["base_answer"] = exchange["answer"] if exchange else ""
+            fields["base_prompt"] = exchange["prompt"] if exchange else None
+            fields["base_output"] = exchange["output"] if exchange else None
+        assignments = ", ".join(f"{key} = ?" for key in fields)
+        with self._lock:
+            cursor = self._conn.execute(
+                f"UPDATE sessions SET {assignments}, rounds = rounds + 1 WHERE id = ? AND version = ?",
+                (*fields.values(), session_id, version)
+            )
+        return cursor.rowcount > 0
+
+    def _delete(self, session_id: str, tool: str) -> bool:
+        with self._lock:
+            cursor = self._conn.execute("DELETE FROM sessions WHERE id = ? AND tool = ?", (session_id, tool))
+        return cursor.rowcount > 0
+
+    async def create(
+        self,
+        tool: str,
+        params: Dict[str, Any],
+        code: str,
+        result: Dict[str, Any],
+        exchange: Optional[Exchange] = None
+    ) -> Dict[str, Any]:
+        """
+        Start a session from a full submission and its answer
+
+        Args:
+            tool: The route family ("refactor", "optimize")
+            params: The request options other than the code
+            code: The submitted code
+            result: The answer returned to the client
+            exchange: The single model call that answered it, replayed as
+                the prompt prefix; None when there was no such call
+        """
+        return await asyncio.to_thread(self._create, tool, params, code, result, exchange)
+
+    async def get(self, session_id: str, tool: str) -> Optional[Dict[str, Any]]:
+        return await asyncio.to_thread(self._get, session_id, tool)
+
+    async def advance(
+        self,
+        session: Dict[str, Any],
+        code: str,
+        result: Dict[str, Any],
+        rebased: bool,
+        exchange: Optional[Exchange] = None
+    ) -> Dict[str, Any]:
+        """
+        Record a new round, moving the prompt prefix to this round (and
+        its model call, if any) when it was answered from scratch
+
+        Raises:
+            SessionConflictError: If another round advanced the session first
+        """
+        if not await asyncio.to_thread(
+            self._advance, session["id"], session["version"], code, result, rebased, exchange
+        ):
+            current = await self.get(session["id"], session["tool"])
+            raise SessionConflictError(
+                "The session was updated by another request", current["version"] if current else ""
+            )
+        return await self.get(session["id"], session["tool"])
+
+    async def delete(self, session_id: str, tool: str) -> bool:
+        return await asyncio.to_thread(self._delete, session_id, tool)
+
+
+def resolve_code(session: Dict[str, Any], diff: Optional[str], code: Optional[str], base_version: Optional[str]) -> str:
+    """
+    Rebuild the client's current code from the session and what it uploaded
+
+    Args:
+        session: The stored session
+        diff: Unified diff against the code last submitted to the session
+        code: The complete code instead of a diff
+        base_version: Version the client believes the session holds
+
+    Raises:
+        SessionConflictError: If base_version is not the stored version
+        PatchError: If the diff does not apply
+    """
+    if base_version is not None and base_version != session["version"]:
+        raise SessionConflictError(
+            f"The diff is based on version {base_version} but the session holds {session['version']}",
+            session["version"]
+        )
+    if code is not None:
+        return code
+    if diff is None:
+        raise PatchError("Send either a diff or the complete code")
+    return apply_patch(session["code"], diff) if diff.strip() else session["code"]
+
+
+async def answer_round(
+    session: Dict[str, Any],
+    code: str,
+    code_field: str,
+    parse: Callable[[str, str], Awaitable[BaseModel]],
+    full: Callable[[str], Awaitable[Tuple[BaseModel, Optional[Exchange]]]]
+) -> Tuple[Dict[str, Any], bool, Optional[Exchange]]:
+    """
+    Answer a follow-up round. The base round's prompt and the model's
+    answer to it are replayed exactly as stored and only the diff from
+    that code is new, so providers with prompt caching serve most of the
+    input from cache; the model answers with a diff against its earlier
+    code, which is applied here.
+
+    Args:
+        session: The stored session
+        code: The client's current code
+        code_field: The result field holding the code
+        parse: Coroutine turning (model output, provider) into the response model
+        full: Coroutine answering code from scratch, returning the response
+            model and its model call (None when it was not a single one)
+
+    Returns:
+        (result dict, whether the prompt prefix has to move to this round,
+        the model call of a round answered from scratch)
+    """
+    tool = session["tool"]
+    if code == session["code"]:
+        metrics.session_rounds.inc(tool=tool, outcome="unchanged")
+        return session["result"], False, None
+
+    diff = make_patch(session["base_code"], code)
+    if session["base_prompt"] is None or len(diff) > SESSIONS_REBASE_RATIO * max(len(session["base_code"]), 1):
+        metrics.session_rounds.inc(tool=tool, outcome="rebased")
+        result, exchange = await full(code)
+        return result.model_dump(), True, exchange
+
+    history = [
+        {"role": "user", "content": session["base_prompt"]},
+        {"role": "assistant", "content": session["base_answer"]}
+    ]
+    response = await ai_service.generate_response(
+        prompt=build_followup_prompt(diff, code_field),
+        history=history,
+        max_tokens=output_token_budget(diff),
+        temperature=SESSIONS_TEMPERATURE,
+        json_mode=True
+    )
+    result = (await parse(response["content"], response["provider"])).model_dump()
+    answer = result[code_field]
+    if is_patch(answer):
+        try:
+            result[code_field] = apply_patch(session["base_output"], answer)
+        except PatchError:
+            metrics.session_rounds.inc(tool=tool, outcome="patch_failed")
+            result, exchange = await full(code)
+            return result.model_dump(), True, exchange
+    metrics.session_rounds.inc(tool=tool, outcome="incremental")
+    return result, False, None
+
+
+# Create a singleton instance
+session_store = SessionStore()
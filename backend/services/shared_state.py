@@ -0,0 +1,157 @@
+from typing import Optional, Iterator, Tuple
+from contextlib import contextmanager
+import os
+import sqlite3
+import threading
+import time
+
+# Set (by serve.py when it starts several workers) to keep rate-limit state in
+# this SQLite file, shared by every process on the host, instead of in memory
+SHARED_STATE_PATH = os.getenv("SHARED_STATE_PATH") or None
+# Buckets idle this long (and refilled) are dropped from the table
+SHARED_STATE_IDLE_SECONDS = float(os.getenv("SHARED_STATE_IDLE_SECONDS", "3600"))
+
+
+class SharedState:
+    """
+    Token buckets and upstream pacing state kept in SQLite, so that several
+    worker processes enforce one set of limits. Each operation is a single
+    short write transaction on a WAL database; they run inline because they
+    take microseconds and must be atomic with the decision they inform.
+
+    The connection is opened lazily and reopened after a fork, since SQLite
+    connections must not cross process boundaries.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pid: Optional[int] = None
+        self._writes = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None or self._pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS buckets (
+                    key TEXT PRIMARY KEY,
+                    level REAL NOT NULL,
+                    updated REAL NOT NULL,
+                    rate REAL NOT NULL,
+                    capacity REAL NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS pacing (
+                    name TEXT PRIMARY KEY,
+                    interval REAL NOT NULL DEFAULT 0,
+                    next_at REAL NOT NULL DEFAULT 0,
+                    paused_until REAL NOT NULL DEFAULT 0
+                )
+                """
+            )
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        with self._lock:
+            conn = self._connection()
+            # IMMEDIATE takes the write lock up front, so read-modify-write is atomic across processes
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def take(self, key: str, rate: float, capacity: float, amount: float, debt: bool = False) -> float:
+        """
+        Refill a token bucket and take amount from it
+
+        Args:
+            key: Bucket name
+            rate: Refill per second
+            capacity: Maximum level (and the level of a new bucket)
+            amount: Tokens to take
+            debt: Take them even if the level goes negative (usage already spent)
+
+        Returns:
+            0 when taken, else the seconds until amount would be available
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute("SELECT level, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+            level = capacity if row is None else min(capacity, row[0] + (now - row[1]) * rate)
+            wait = 0.0
+            if debt or level >= amount:
+                level -= amount
+            elif rate <= 0:
+                wait = float("inf")
+            else:
+                wait = (amount - level) / rate
+            conn.execute(
+                "INSERT OR REPLACE INTO buckets (key, level, updated, rate, capacity) VALUES (?, ?, ?, ?, ?)",
+                (key, level, now, rate, capacity)
+            )
+            self._writes += 1
+            if self._writes % 1000 == 0:
+                # A bucket that has refilled completely is the same as no bucket
+                conn.execute(
+                    "DELETE FROM buckets WHERE updated < ? AND level + (? - updated) * rate >= capacity",
+                    (now - SHARED_STATE_IDLE_SECONDS, now)
+                )
+        return wait
+
+    def pace(self, name: str, interval: Optional[float] = None, paused_until: Optional[float] = None) -> None:
+        """
+        Update a provider's dispatch interval and extend its pause
+        """
+        with self._transaction() as conn:
+            conn.execute("INSERT OR IGNORE INTO pacing (name) VALUES (?)", (name,))
+            if interval is not None:
+                conn.execute("UPDATE pacing SET interval = ? WHERE name = ?", (interval, name))
+            if paused_until is not None:
+                conn.execute(
+                    "UPDATE pacing SET paused_until = MAX(paused_until, ?) WHERE name = ?", (paused_until, name)
+                )
+
+    def paused_until(self, name: str) -> float:
+        with self._transaction() as conn:
+            row = conn.execute("SELECT paused_until FROM pacing WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else 0.0
+
+    def reserve(self, name: str, now: float, max_wait: float) -> Tuple[float, bool]:
+        """
+        Reserve a provider's next dispatch time if it is at most max_wait away
+
+        Returns:
+            (the dispatch time, whether it was reserved)
+        """
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT interval, next_at, paused_until FROM pacing WHERE name = ?", (name,)
+            ).fetchone()
+            interval, next_at, paused_until = row or (0.0, 0.0, 0.0)
+            slot = max(now, next_at, paused_until)
+            if slot - now > max_wait:
+                return slot, False
+            conn.execute(
+                "INSERT OR REPLACE INTO pacing (name, interval, next_at, paused_until) VALUES (?, ?, ?, ?)",
+                (name, interval, slot + interval, paused_until)
+            )
+        return slot, True
+
+
+# Create a singleton instance
+shared_state = SharedState(SHARED_STATE_PATH) if SHARED_STATE_PATH else None
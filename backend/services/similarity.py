@@ -0,0 +1,611 @@
+from typing import Optional, Dict, Any, List, Set, Tuple
+from collections import OrderedDict
+from dataclasses import dataclass, field
+import ast
+import asyncio
+import hashlib
+import io
+import json
+import os
+import re
+import sqlite3
+import struct
+import threading
+import time
+import tokenize
+import zlib
+from services.stacktrace import strip_volatile
+from services.structured_output import UNKNOWN
+
+SIMILARITY_ENABLED = os.getenv("SIMILARITY_ENABLED", "true").lower() == "true"
+SIMILARITY_DB_PATH = os.getenv("SIMILARITY_DB_PATH", "data/similarity.sqlite3")
+SIMILARITY_MAX_ENTRIES = int(os.getenv("SIMILARITY_MAX_ENTRIES", "1000000"))
+SIMILARITY_MAX_MEMORY = int(os.getenv("SIMILARITY_MAX_MEMORY", "10000"))
+SIMILARITY_TTL_SECONDS = float(os.getenv("SIMILARITY_TTL_SECONDS", str(30 * 86400)))
+# Estimated Jaccard similarity above which a prior answer is passed to the model as a reference
+SIMILARITY_THRESHOLD = float(os.getenv("SIMILARITY_THRESHOLD", "0.7"))
+# Above this a prior stack trace explanation is returned as is
+SIMILARITY_REUSE_THRESHOLD = float(os.getenv("SIMILARITY_REUSE_THRESHOLD", "0.9"))
+# Characters of a prior answer included in the prompt as a reference
+SIMILARITY_REFERENCE_CHARS = int(os.getenv("SIMILARITY_REFERENCE_CHARS", "2000"))
+# Answer fields holding code, the only ones identifier renames apply to
+CODE_FIELDS = ("optimized_code", "refactored_code")
+
+# 64 MinHash values in 16 bands of 4 rows: pairs at the 0.7 threshold share a
+# band with ~94% probability, pairs at 0.3 with ~12%
+NUM_PERM = 64
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+SHINGLE_SIZE = 4
+
+_EMPTY = (1 << 56) - 1
+
+_TOKEN = re.compile(r'[A-Za-z_$][\w$]*|\d+(?:\.\d+)?|"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\'|\S')
+
+# Comment syntax by language; for languages not listed nothing is treated as
+# a comment, so their comments stay part of the code rather than risk
+# dropping code (// is floor division in Python, # a private field in JS)
+_HASH_COMMENTS = {"python", "py", "python3", "ruby", "rb", "shell", "bash", "sh", "perl", "r", "elixir"}
+_SLASH_COMMENTS = {
+    "java", "javascript", "js", "typescript", "ts", "jsx", "tsx", "c", "cpp", "c++", "csharp", "c#", "go",
+    "golang", "rust", "kotlin", "swift", "scala", "dart", "php",
+}
+_STRING = (
+    r'(?:\b[rRbBuUfF]{1,2})?(?:"""[\s\S]*?"""|\'\'\'[\s\S]*?\'\'\'|"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\')'
+    r"|`(?:\\.|[^`\\])*`"
+)
+
+
+def _scanner(language: Optional[str]) -> "re.Pattern[str]":
+    language = (language or "").lower()
+    if language in _HASH_COMMENTS:
+        comment = r"#[^\n]*"
+    elif language in _SLASH_COMMENTS:
+        comment = r"//[^\n]*|/\*[\s\S]*?\*/"
+    else:
+        comment = r"(?!)"
+    return re.compile(
+        rf"(?P<comment>{comment})|(?P<string>{_STRING})|(?P<name>[A-Za-z_$][\w$]*)|(?P<other>\d+(?:\.\d+)?|\S)"
+    )
+
+
+_SCANNERS: Dict[str, "re.Pattern[str]"] = {}
+
+# Names kept verbatim when identifiers are canonicalized: keywords and common
+# builtins across the languages we see, since they carry meaning
+KEYWORDS = set("""
+and as assert async await break case catch class const continue def default del do elif else enum except
+extends false final finally for from func function go if implements import in instanceof interface is
+lambda let new nil none not null or package pass private protected public raise return self static super
+switch this throw throws true try type var void while with yield int long float double char boolean byte
+short string str bool list dict set tuple len range print println printf append map filter zip sorted sum
+min max abs enumerate isinstance object self system out console log math array arrays collections
+""".split())
+# Words after which a name is being declared, in the languages without a parser here
+_DECLARATORS = set("""
+def class function func fn let var const val struct interface enum record for as int long float double char
+boolean byte short string bool void auto final
+""".split())
+_PYTHON = ("python", "py", "python3")
+
+
+@dataclass
+class Fingerprint:
+    """
+    Normalized view of one submission: structural digest, identifiers in
+    first-use order and the MinHash signature of its shingles
+    """
+    digest: str
+    names: List[str]
+    signature: Tuple[int, ...]
+
+
+@dataclass
+class SimilarMatch:
+    answer: Dict[str, Any]
+    similarity: float
+    # Same code up to identifier names: the answer was renamed to fit
+    exact: bool = False
+    renames: Dict[str, str] = field(default_factory=dict)
+
+
+def _lex_python(text: str) -> Optional[List[Tuple[str, str, int, int]]]:
+    """
+    Lex Python with its own tokenizer, keeping the indentation structure
+    (which is syntax), or None if it does not tokenize
+    """
+    offsets = [0]
+    for line in text.splitlines(keepends=True):
+        offsets.append(offsets[-1] + len(line))
+    kinds = {
+        tokenize.NAME: "name", tokenize.STRING: "string", tokenize.COMMENT: "comment",
+        tokenize.NEWLINE: "layout", tokenize.INDENT: "layout", tokenize.DEDENT: "layout",
+    }
+    lexemes = []
+    try:
+        for token in tokenize.generate_tokens(io.StringIO(text).readline):
+            if token.type in (tokenize.NL, tokenize.ENCODING, tokenize.ENDMARKER):
+                continue
+            # Rows are 1-based; a DEDENT at the end sits on the row after the last line
+            start = offsets[token.start[0] - 1] + token.start[1]
+            end = offsets[token.end[0] - 1] + token.end[1]
+            kind = kinds.get(token.type, "other")
+            value = tokenize.tok_name[token.type] if kind == "layout" else token.string
+            lexemes.append((kind, value, start, end))
+    except (tokenize.TokenError, SyntaxError):
+        return None
+    return lexemes
+
+
+def lex(text: str, language: Optional[str] = None) -> List[Tuple[str, str, int, int]]:
+    """
+    Split code into (kind, text, start, end) lexemes, kind being "name",
+    "string", "comment", "layout" or "other". String literals and comments
+    are whole lexemes, so nothing inside them is mistaken for code.
+    """
+    key = (language or "").lower()
+    if key in ("python", "py", "python3"):
+        lexemes = _lex_python(text)
+        if lexemes is not None:
+            return lexemes
+    if key not in _SCANNERS:
+        _SCANNERS[key] = _scanner(key)
+    return [(m.lastgroup, m.group(), m.start(), m.end()) for m in _SCANNERS[key].finditer(text)]
+
+
+def _python_bound(text: str) -> Optional[Set[str]]:
+    """
+    Names Python code binds itself (assignments, parameters, definitions,
+    loop and exception targets), without the imported ones
+    """
+    try:
+        tree = ast.parse(text)
+    except (SyntaxError, ValueError):
+        return None
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, (ast.Store, ast.Del)):
+            names.add(node.id)
+        elif isinstance(node, ast.arg):
+            names.add(node.arg)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(node.name)
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            names.add(node.name)
+    return names
+
+
+def _bound_names(text: str, lexemes: List[Tuple[str, str, int, int]], language: Optional[str]) -> Set[str]:
+    """
+    Names the code declares itself, as opposed to builtins, imports and
+    library APIs, which keep their meaning and so their spelling. Outside
+    Python this is a lexical guess (`Type name`, `let name`, `name = ...`)
+    that errs towards leaving a name as written.
+    """
+    if (language or "").lower() in _PYTHON:
+        names = _python_bound(text)
+        if names is not None:
+            return names
+    names = set()
+    code = [lexeme for lexeme in lexemes if lexeme[0] != "layout"]
+    for i, (kind, name, _, _) in enumerate(code):
+        if kind != "name":
+            continue
+        before = code[i - 1] if i else None
+        after = [lexeme[1] for lexeme in code[i + 1:i + 3]]
+        if before is not None and before[1].lower() in _DECLARATORS:
+            names.add(name)
+        elif after[:1] == ["="] and after[1:] != ["="]:
+            names.add(name)
+        elif before is not None and after[:1] and after[0] in (",", ")", "=", ";", ":", "(") and (
+            before[1] in (">", "]") or (before[0] == "name" and before[1].lower() not in KEYWORDS)
+        ):
+            names.add(name)
+    return names
+
+
+def _is_local_name(lexemes: List[Tuple[str, str, int, int]], index: int) -> bool:
+    kind, text = lexemes[index][:2]
+    # Attribute and method names are API, not local naming
+    return kind == "name" and text.lower() not in KEYWORDS and (index == 0 or lexemes[index - 1][1] != ".")
+
+
+def _tokens(text: str, kind: str, language: Optional[str] = None) -> Tuple[List[str], List[str]]:
+    """
+    Tokenize a submission. Identifiers the code declares become v0, v1, ...
+    in order of first use so renamed variables produce the same stream,
+    while builtins, imported names and literals are kept as written and
+    comments dropped; traces drop line numbers, addresses and timestamps
+    instead.
+
+    Returns:
+        (normalized tokens, original identifiers in first-use order)
+    """
+    if kind == "trace":
+        text = re.sub(r"\d+", "0", strip_volatile(text))
+        return _TOKEN.findall(text), []
+    names: Dict[str, str] = {}
+    tokens = []
+    lexemes = [lexeme for lexeme in lex(text, language) if lexeme[0] != "comment"]
+    bound = _bound_names(text, lexemes, language)
+    for i, (lexeme_kind, token, _, _) in enumerate(lexemes):
+        if token in bound and _is_local_name(lexemes, i):
+            token = names.setdefault(token, f"v{len(names)}")
+        tokens.append(token)
+    return tokens, list(names)
+
+
+def _shingle_hash(shingle: str) -> int:
+    data = shingle.encode()
+    return zlib.crc32(data) << 32 | zlib.adler32(data)
+
+
+def minhash(hashes: List[int]) -> Tuple[int, ...]:
+    """
+    One-permutation MinHash: each 64-bit shingle hash lands in one of
+    NUM_PERM bins by its low bits and each bin keeps its minimum, so the
+    signature costs one pass instead of NUM_PERM. Empty bins borrow from
+    the next filled bin (rotation densification) so sparse inputs still
+    compare position by position.
+    """
+    # Largest first, so each bin ends up holding its smallest value
+    smallest = {h % NUM_PERM: h >> 8 for h in sorted(hashes, reverse=True)}
+    bins = [smallest.get(i, _EMPTY) for i in range(NUM_PERM)]
+    if _EMPTY in bins and any(v != _EMPTY for v in bins):
+        filled = bins[:]
+        for i in range(NUM_PERM):
+            distance = 1
+            while filled[i] == _EMPTY:
+                filled[i] = bins[(i + distance) % NUM_PERM]
+                if filled[i] != _EMPTY:
+                    # Offset by the distance so borrowed values only match the same borrow
+                    filled[i] += distance * (_EMPTY + 1)
+                distance += 1
+        bins = filled
+    return tuple(bins)
+
+
+def fingerprint(text: str, kind: str, language: Optional[str] = None) -> Fingerprint:
+    """
+    Build the fingerprint of a code ("code") or stack trace ("trace") submission
+    """
+    tokens, names = _tokens(text, kind, language)
+    digest = hashlib.sha256(" ".join(tokens).encode()).hexdigest()
+    # Shingles see every identifier as "v": numbering by first use would let
+    # one new name early in the file change every shingle after it
+    tokens = ["v" if t[0] == "v" and t[1:].isdigit() else t for t in tokens]
+    size = min(SHINGLE_SIZE, max(1, len(tokens)))
+    shingles = {_shingle_hash(" ".join(tokens[i:i + size])) for i in range(max(1, len(tokens) - size + 1))}
+    return Fingerprint(digest, names, minhash(list(shingles)))
+
+
+def similarity(a: Tuple[int, ...], b: Tuple[int, ...]) -> float:
+    """
+    Estimated Jaccard similarity of two signatures
+    """
+    return sum(x == y for x, y in zip(a, b)) / NUM_PERM
+
+
+def namespace(route: str, params: Dict[str, Any]) -> str:
+    """
+    Submissions are only compared with others made to the same route with
+    the same options (language, versions, ...)
+    """
+    return hashlib.sha256(f"{route}:{json.dumps(params, sort_keys=True, default=str)}".encode()).hexdigest()[:16]
+
+
+def band_keys(space: str, signature: Tuple[int, ...]) -> List[int]:
+    keys = []
+    for band in range(BANDS):
+        rows = signature[band * ROWS:(band + 1) * ROWS]
+        digest = hashlib.blake2b(f"{space}:{band}:{rows}".encode(), digest_size=8).digest()
+        keys.append(int.from_bytes(digest, "big", signed=True))
+    return keys
+
+
+def rename_code(code: str, renames: Dict[str, str], language: Optional[str] = None) -> str:
+    """
+    Apply identifier renames to code, leaving strings, comments and
+    attribute names alone
+    """
+    lexemes = [lexeme for lexeme in lex(code, language) if lexeme[0] != "comment"]
+    parts = []
+    position = 0
+    for i, (_, text, start, end) in enumerate(lexemes):
+        if text in renames and _is_local_name(lexemes, i):
+            parts += [code[position:start], renames[text]]
+            position = end
+    return "".join(parts) + code[position:]
+
+
+def rename_answer(answer: Dict[str, Any], renames: Dict[str, str], language: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Apply identifier renames to the code fields of an answer; prose is
+    left as is, since a name there cannot be told from an ordinary word
+    """
+    if not renames:
+        return answer
+    return {
+        key: rename_code(value, renames, language) if key in CODE_FIELDS and isinstance(value, str) else value
+        for key, value in answer.items()
+    }
+
+
+def _renames_collide(answer: Dict[str, Any], renames: Dict[str, str], language: Optional[str] = None) -> bool:
+    """
+    Whether a new name is already used in the answer's code for something
+    the renames leave alone, e.g. a local variable the model introduced;
+    renaming would then merge two different variables
+    """
+    targets = {new for new in renames.values() if new not in renames}
+    for key in CODE_FIELDS:
+        if isinstance(answer.get(key), str):
+            lexemes = [lexeme for lexeme in lex(answer[key], language) if lexeme[0] != "comment"]
+            if any(lexemes[i][1] in targets and _is_local_name(lexemes, i) for i in range(len(lexemes))):
+                return True
+    return False
+
+
+def reference_note(match: SimilarMatch) -> str:
+    """
+    Compact rendering of a prior answer for use as a prompt reference
+    """
+    text = json.dumps(match.answer, separators=(",", ":"))
+    if len(text) > SIMILARITY_REFERENCE_CHARS:
+        text = text[:SIMILARITY_REFERENCE_CHARS] + "..."
+    return text
+
+
+@dataclass
+class _Entry:
+    space: str
+    digest: str
+    names: List[str]
+    signature: Tuple[int, ...]
+    answer: Dict[str, Any]
+    created_at: float
+
+
+class SimilarityIndex:
+    """
+    MinHash / LSH index of past submissions and their answers. Recent
+    entries are held in memory; all of them, up to max_entries, in SQLite
+    with the LSH band keys indexed so lookups stay a handful of B-tree probes.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = SIMILARITY_DB_PATH,
+        max_entries: int = SIMILARITY_MAX_ENTRIES,
+        max_memory: int = SIMILARITY_MAX_MEMORY,
+        ttl: float = SIMILARITY_TTL_SECONDS
+    ):
+        self.max_entries = max_entries
+        self.max_memory = max_memory
+        self.ttl = ttl
+        self._entries: "OrderedDict[int, _Entry]" = OrderedDict()
+        self._bands: Dict[int, set] = {}
+        self._digests: Dict[Tuple[str, str], int] = {}
+        self._next_id = 0
+        self._conn = None
+        self._lock = threading.Lock()
+        self._count = 0
+        self._stats = {"exact_hits": 0, "similar_hits": 0, "misses": 0, "evictions": 0}
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "id INTEGER PRIMARY KEY, space TEXT NOT NULL, digest TEXT NOT NULL, names TEXT NOT NULL, "
+                "signature BLOB NOT NULL, answer TEXT NOT NULL, created_at REAL NOT NULL, used_at REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS entries_digest ON entries (space, digest)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS entries_used ON entries (used_at)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS bands (band INTEGER NOT NULL, entry_id INTEGER NOT NULL, "
+                "PRIMARY KEY (band, entry_id)) WITHOUT ROWID"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS bands_entry ON bands (entry_id)")
+            self._count = self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    # Memory tier
+
+    def _remember(self, entry_id: int, entry: _Entry) -> None:
+        if entry_id in self._entries:
+            self._entries.move_to_end(entry_id)
+            return
+        self._entries[entry_id] = entry
+        self._digests[(entry.space, entry.digest)] = entry_id
+        for key in band_keys(entry.space, entry.signature):
+            self._bands.setdefault(key, set()).add(entry_id)
+        while len(self._entries) > self.max_memory:
+            self._forget(next(iter(self._entries)))
+
+    def _forget(self, entry_id: int) -> None:
+        entry = self._entries.pop(entry_id, None)
+        if entry is None:
+            return
+        if self._digests.get((entry.space, entry.digest)) == entry_id:
+            del self._digests[(entry.space, entry.digest)]
+        for key in band_keys(entry.space, entry.signature):
+            ids = self._bands.get(key)
+            if ids is not None:
+                ids.discard(entry_id)
+                if not ids:
+                    del self._bands[key]
+
+    def _memory_candidates(self, space: str, digest: str, keys: List[int]) -> List[Tuple[int, _Entry]]:
+        exact = self._digests.get((space, digest))
+        if exact is not None:
+            return [(exact, self._entries[exact])]
+        ids = set()
+        for key in keys:
+            ids |= self._bands.get(key, set())
+        return [(i, self._entries[i]) for i in ids]
+
+    # SQLite tier
+
+    def _db_candidates(self, space: str, digest: str, keys: List[int]) -> List[Tuple[int, _Entry]]:
+        columns = "id, space, digest, names, signature, answer, created_at"
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {columns} FROM entries WHERE space = ? AND digest = ? LIMIT 1", (space, digest)
+            ).fetchall()
+            if not rows:
+                marks = ",".join("?" * len(keys))
+                rows = self._conn.execute(
+                    f"SELECT {columns} FROM entries WHERE id IN "
+                    f"(SELECT entry_id FROM bands WHERE band IN ({marks}) LIMIT 64)",
+                    keys
+                ).fetchall()
+        return [
+            (row[0], _Entry(row[1], row[2], json.loads(row[3]), struct.unpack(f"<{NUM_PERM}Q", row[4]), json.loads(row[5]), row[6]))
+            for row in rows
+        ]
+
+    def _touch(self, entry_id: int) -> None:
+        with self._lock:
+            self._conn.execute("UPDATE entries SET used_at = ? WHERE id = ?", (time.time(), entry_id))
+
+    def _insert(self, entry: _Entry, keys: List[int]) -> int:
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                replaced = self._conn.execute(
+                    "SELECT id FROM entries WHERE space = ? AND digest = ?", (entry.space, entry.digest)
+                ).fetchall()
+                for (old_id,) in replaced:
+                    self._delete(old_id)
+                entry_id = self._conn.execute(
+                    "INSERT INTO entries (space, digest, names, signature, answer, created_at, used_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (entry.space, entry.digest, json.dumps(entry.names),
+                     struct.pack(f"<{NUM_PERM}Q", *entry.signature), json.dumps(entry.answer), now, now)
+                ).lastrowid
+                self._conn.executemany("INSERT OR IGNORE INTO bands (band, entry_id) VALUES (?, ?)", [(k, entry_id) for k in keys])
+                self._count += 1 - len(replaced)
+                evicted = self._evict()
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        self._stats["evictions"] += evicted
+        return entry_id
+
+    def _delete(self, entry_id: int) -> None:
+        self._conn.execute("DELETE FROM bands WHERE entry_id = ?", (entry_id,))
+        self._conn.execute("DELETE FROM entries WHERE id = ?", (entry_id,))
+
+    def _evict(self) -> int:
+        """
+        Past max_entries, drop the least recently used entries 1% at a time
+        so eviction is amortized across inserts. Expired entries are never
+        served and so age out the same way.
+        """
+        if self._count <= self.max_entries:
+            return 0
+        batch = max(1, self.max_entries // 100)
+        ids = [row[0] for row in self._conn.execute("SELECT id FROM entries ORDER BY used_at LIMIT ?", (batch,))]
+        for entry_id in ids:
+            self._delete(entry_id)
+        self._count -= len(ids)
+        return len(ids)
+
+    # Public API
+
+    async def lookup(
+        self,
+        space: str,
+        text: str,
+        kind: str = "code",
+        language: Optional[str] = None
+    ) -> Optional[SimilarMatch]:
+        """
+        Find the most similar earlier submission in a namespace
+
+        Args:
+            space: Namespace from namespace()
+            text: Submitted code or stack trace
+            kind: "code" or "trace"
+            language: Language of submitted code, for its comment syntax
+
+        Returns:
+            The prior answer with its estimated similarity (renamed to the new
+            identifiers when the code only differs in naming and the new
+            names are free in the answer), or None when nothing reaches
+            SIMILARITY_THRESHOLD
+        """
+        if not SIMILARITY_ENABLED:
+            return None
+        fp = fingerprint(text, kind, language)
+        keys = band_keys(space, fp.signature)
+        candidates = self._memory_candidates(space, fp.digest, keys)
+        best = self._best(candidates, space, fp)
+        if best is None and self._conn is not None:
+            candidates = await asyncio.to_thread(self._db_candidates, space, fp.digest, keys)
+            best = self._best(candidates, space, fp)
+            if best is not None:
+                self._remember(*best[:2])
+        if best is None:
+            self._stats["misses"] += 1
+            return None
+
+        entry_id, entry, score = best
+        exact = entry.digest == fp.digest
+        renames = {old: new for old, new in zip(entry.names, fp.names) if old != new} if exact else {}
+        if renames and _renames_collide(entry.answer, renames, language):
+            # Only usable as a reference: the model has to redo the renaming
+            exact, renames = False, {}
+        self._stats["exact_hits" if exact else "similar_hits"] += 1
+        self._entries.move_to_end(entry_id)
+        if self._conn is not None:
+            await asyncio.to_thread(self._touch, entry_id)
+        return SimilarMatch(rename_answer(entry.answer, renames, language), score, exact, renames)
+
+    def _best(self, candidates: List[Tuple[int, _Entry]], space: str, fp: Fingerprint) -> Optional[Tuple[int, _Entry, float]]:
+        best = None
+        now = time.time()
+        for entry_id, entry in candidates:
+            if entry.space != space or now - entry.created_at > self.ttl:
+                continue
+            score = 1.0 if entry.digest == fp.digest else similarity(entry.signature, fp.signature)
+            if score >= SIMILARITY_THRESHOLD and (best is None or score > best[2]):
+                best = (entry_id, entry, score)
+        return best
+
+    async def add(
+        self,
+        space: str,
+        text: str,
+        answer: Dict[str, Any],
+        kind: str = "code",
+        language: Optional[str] = None
+    ) -> None:
+        """
+        Index the answer produced for a submission. Answers with fields the
+        model never produced are not worth reusing and are skipped.
+        """
+        if not SIMILARITY_ENABLED or UNKNOWN in answer.values():
+            return
+        fp = fingerprint(text, kind, language)
+        entry = _Entry(space, fp.digest, fp.names, fp.signature, answer, time.time())
+        previous = self._digests.get((space, fp.digest))
+        if previous is not None:
+            self._forget(previous)
+        if self._conn is not None:
+            entry_id = await asyncio.to_thread(self._insert, entry, band_keys(space, fp.signature))
+        else:
+            entry_id = self._next_id
+            self._next_id += 1
+        self._remember(entry_id, entry)
+
+    def stats(self) -> Dict[str, int]:
+        return {**self._stats, "memory_entries": len(self._entries), "entries": self._count if self._conn else len(self._entries)}
+
+# Create a singleton instance
+similarity_index = SimilarityIndex()
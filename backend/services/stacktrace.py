@@ -0,0 +1,470 @@
+from typing import Optional, Dict, Any, List, Tuple
+from collections import OrderedDict
+from dataclasses import dataclass, field
+import asyncio
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+FINGERPRINT_DB_PATH = os.getenv("FINGERPRINT_DB_PATH", "data/trace_fingerprints.sqlite3")
+FINGERPRINT_TTL_SECONDS = float(os.getenv("FINGERPRINT_TTL_SECONDS", str(7 * 86400)))
+FINGERPRINT_MAX_MEMORY = int(os.getenv("FINGERPRINT_MAX_MEMORY", "4096"))
+# Rows kept on disk; the least recently used are dropped past this
+FINGERPRINT_MAX_ROWS = int(os.getenv("FINGERPRINT_MAX_ROWS", "100000"))
+# Number of application frames that make up the fingerprint
+FINGERPRINT_FRAMES = 3
+# Characters of the normalized exception message that make up the fingerprint
+FINGERPRINT_MESSAGE_CHARS = 500
+# Frames kept verbatim at the top and bottom of a long trace
+KEEP_TOP_FRAMES = 15
+KEEP_BOTTOM_FRAMES = 5
+
+# Path fragments that mark framework / library frames
+LIBRARY_MARKERS = (
+    "site-packages", "dist-packages", "/lib/python", "\\lib\\python", "<frozen ",
+    "node_modules", "node:internal", "(node:",
+    "/usr/local/go/", "/go/pkg/mod/", "/src/runtime/", "/src/net/",
+)
+# Package prefixes that mark JVM / Go standard library and framework frames
+LIBRARY_PREFIXES = (
+    "java.", "javax.", "jdk.", "sun.", "com.sun.", "kotlin.", "scala.",
+    "org.springframework.", "org.apache.", "org.hibernate.", "io.netty.", "reactor.",
+    "runtime.", "net/http.", "reflect.", "testing.",
+)
+
+# Volatile tokens that differ between occurrences of the same error
+VOLATILE_PATTERNS = [
+    (re.compile(r" ?\+0x[0-9a-f]+"), ""),
+    (re.compile(r"\b0x[0-9a-fA-F]+\b"), "0x?"),
+    (re.compile(r"\b\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(?:[.,]\d+)?(?:Z|[+-]\d{2}:?\d{2})?\b"), "<timestamp>"),
+    (re.compile(r"\b[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}\b"), "<uuid>"),
+    (re.compile(r"\bgoroutine \d+\b"), "goroutine N"),
+    (re.compile(r"@[0-9a-f]{6,}\b"), "@<hash>"),
+]
+
+PYTHON_FRAME = re.compile(r'^\s*File "(?P<file>[^"]+)", line (?P<line>\d+)(?:, in (?P<func>.+))?')
+JAVA_FRAME = re.compile(r"^\s*at (?P<func>[\w$.<>/]+)\((?P<file>[^:)]*)(?::(?P<line>\d+))?\)")
+JS_FRAME = re.compile(r"^\s*at (?:(?P<func>.+?) \()?(?P<file>[^()]+?):(?P<line>\d+)(?::\d+)?\)?$")
+GO_FUNC = re.compile(r"^(?P<func>[\w./*()-]+\.[\w.*()-]+)\(.*\)$")
+GO_FILE = re.compile(r"^\s+(?P<file>\S+\.go):(?P<line>\d+)")
+
+
+@dataclass
+class Frame:
+    function: str
+    file: str
+    line: Optional[int]
+    is_library: bool
+    raw: List[str] = field(default_factory=list)
+
+    @property
+    def key(self) -> str:
+        return f"{self.file}:{self.function}:{self.line}"
+
+
+@dataclass
+class ParsedTrace:
+    language: str
+    exception_type: str
+    message: str
+    frames: List[Frame]
+    preamble: List[str] = field(default_factory=list)
+
+
+def strip_volatile(text: str) -> str:
+    """
+    Replace addresses, timestamps, UUIDs and similar per-occurrence tokens
+    """
+    for pattern, replacement in VOLATILE_PATTERNS:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+def _is_library(location: str) -> bool:
+    return location.startswith(LIBRARY_PREFIXES) or any(marker in location for marker in LIBRARY_MARKERS)
+
+
+def detect_language(stack_trace: str, hint: Optional[str] = None) -> str:
+    """
+    Guess the trace's language from its frame syntax, falling back to the hint
+    """
+    if "Traceback (most recent call last)" in stack_trace or PYTHON_FRAME.search(stack_trace):
+        return "python"
+    if re.search(r"^goroutine \d+ \[", stack_trace, re.M) or re.search(r"^panic: ", stack_trace, re.M):
+        return "go"
+    if re.search(r"^\s*at [\w$.<>/]+\([\w$]+\.(java|kt|scala)(:\d+)?\)", stack_trace, re.M):
+        return "java"
+    if re.search(r"^\s*at .+\.(m?js|ts|cjs)(:\d+){1,2}\)?$", stack_trace, re.M) or "node:internal" in stack_trace:
+        return "javascript"
+    if hint:
+        hint = hint.lower()
+        if hint in ("js", "node", "nodejs", "typescript", "ts"):
+            return "javascript"
+        if hint in ("kotlin", "scala", "jvm"):
+            return "java"
+        return hint
+    return "unknown"
+
+
+def _parse_python(lines: List[str]) -> ParsedTrace:
+    frames: List[Frame] = []
+    preamble: List[str] = []
+    exception_type, message = "", ""
+    for line in lines:
+        match = PYTHON_FRAME.match(line)
+        if match:
+            path = match.group("file")
+            frames.append(Frame(
+                function=(match.group("func") or "").strip(),
+                file=path,
+                line=int(match.group("line")),
+                is_library=_is_library(path),
+                raw=[line]
+            ))
+        elif frames and line.startswith("    ") and len(frames[-1].raw) == 1:
+            frames[-1].raw.append(line)  # source line under the frame
+        elif re.match(r"^[\w.]+(Error|Exception|Exit|Interrupt|Warning)\b|^[\w.]+:", line):
+            exception_type, _, message = line.partition(":")
+            message = message.strip()
+        elif not frames:
+            preamble.append(line)
+    # Python prints the innermost frame last; normalise to innermost first
+    frames.reverse()
+    return ParsedTrace("python", exception_type.strip(), message, frames, preamble)
+
+
+def _parse_java(lines: List[str]) -> ParsedTrace:
+    frames: List[Frame] = []
+    preamble: List[str] = []
+    exception_type, message = "", ""
+    for line in lines:
+        match = JAVA_FRAME.match(line)
+        if match:
+            func = match.group("func")
+            frames.append(Frame(
+                function=func,
+                file=match.group("file"),
+                line=int(match.group("line")) if match.group("line") else None,
+                is_library=_is_library(func),
+                raw=[line]
+            ))
+        elif not frames and not exception_type and re.match(r"^(Exception in thread \"[^\"]*\" )?[\w$.]+(:|$)", line.strip()):
+            head = re.sub(r'^Exception in thread "[^"]*" ', "", line.strip())
+            exception_type, _, message = head.partition(":")
+            message = message.strip()
+        elif line.strip().startswith("Caused by:"):
+            # Keep the cause chain visible as its own pseudo-frame
+            frames.append(Frame(function=line.strip(), file="", line=None, is_library=False, raw=[line]))
+        elif not frames:
+            preamble.append(line)
+    return ParsedTrace("java", exception_type, message, frames, preamble)
+
+
+def _parse_javascript(lines: List[str]) -> ParsedTrace:
+    frames: List[Frame] = []
+    preamble: List[str] = []
+    exception_type, message = "", ""
+    for line in lines:
+        match = JS_FRAME.match(line)
+        if match:
+            path = match.group("file").strip()
+            frames.append(Frame(
+                function=(match.group("func") or "<anonymous>").strip(),
+                file=path,
+                line=int(match.group("line")),
+                is_library=_is_library(path),
+                raw=[line]
+            ))
+        elif not frames and not exception_type and re.match(r"^\s*[\w$.]*(Error|Exception)\b", line):
+            exception_type, _, message = line.strip().partition(":")
+            message = message.strip()
+        elif not frames:
+            preamble.append(line)
+    return ParsedTrace("javascript", exception_type, message, frames, preamble)
+
+
+def _parse_go(lines: List[str]) -> ParsedTrace:
+    frames: List[Frame] = []
+    preamble: List[str] = []
+    exception_type, message = "", ""
+    for line in lines:
+        func_match = GO_FUNC.match(line.strip()) if not line.startswith(("\t", " ")) else None
+        file_match = GO_FILE.match(line)
+        if line.startswith("panic: ") and not exception_type:
+            exception_type = "panic"
+            message = line[len("panic: "):].strip()
+        elif func_match:
+            func = func_match.group("func")
+            frames.append(Frame(function=func, file="", line=None, is_library=_is_library(func), raw=[line]))
+        elif file_match and frames and not frames[-1].file:
+            path = file_match.group("file")
+            frames[-1].file = path
+            frames[-1].line = int(file_match.group("line"))
+            frames[-1].is_library = frames[-1].is_library or _is_library(path)
+            frames[-1].raw.append(line)
+        elif not frames:
+            preamble.append(line)
+    return ParsedTrace("go", exception_type, message, frames, preamble)
+
+
+PARSERS = {
+    "python": _parse_python,
+    "java": _parse_java,
+    "javascript": _parse_javascript,
+    "go": _parse_go,
+}
+
+
+def parse_stacktrace(stack_trace: str, language: Optional[str] = None) -> Optional[ParsedTrace]:
+    """
+    Parse a stack trace into frames
+
+    Args:
+        stack_trace: The raw trace
+        language: Optional language hint from the request
+
+    Returns:
+        The parsed trace, or None if the language is not supported or no
+        frames were found
+    """
+    parser = PARSERS.get(detect_language(stack_trace, language))
+    if parser is None:
+        return None
+    parsed = parser(stack_trace.replace("\r\n", "\n").split("\n"))
+    return parsed if parsed.frames else None
+
+
+def _collapse(frames: List[Frame]) -> List[str]:
+    """
+    Render frames, collapsing recursion / repeated frame cycles and runs of
+    library frames into one summary line each
+    """
+    out: List[str] = []
+    i = 0
+    while i < len(frames):
+        # Repeated cycles of up to 4 frames (direct and mutual recursion)
+        collapsed = False
+        for size in range(1, 5):
+            cycle = [f.key for f in frames[i:i + size]]
+            if len(cycle) < size:
+                break
+            repeats = 1
+            while [f.key for f in frames[i + repeats * size:i + (repeats + 1) * size]] == cycle:
+                repeats += 1
+            if repeats > 2:
+                for frame in frames[i:i + size]:
+                    out.extend(frame.raw)
+                out.append(f"    ... previous {size} frame(s) repeated {repeats - 1} more times ...")
+                i += repeats * size
+                collapsed = True
+                break
+        if collapsed:
+            continue
+
+        if frames[i].is_library:
+            start = i
+            while i < len(frames) and frames[i].is_library:
+                i += 1
+            if i - start > 2:
+                out.extend(frames[start].raw)
+                out.append(f"    ... {i - start - 1} library/framework frames omitted ...")
+            else:
+                for frame in frames[start:i]:
+                    out.extend(frame.raw)
+            continue
+
+        out.extend(frames[i].raw)
+        i += 1
+    return out
+
+
+def _normalize(parsed: ParsedTrace) -> str:
+    lines = _collapse(parsed.frames)
+    if len(lines) > KEEP_TOP_FRAMES + KEEP_BOTTOM_FRAMES:
+        omitted = len(lines) - KEEP_TOP_FRAMES - KEEP_BOTTOM_FRAMES
+        lines = lines[:KEEP_TOP_FRAMES] + [f"    ... {omitted} lines omitted ..."] + lines[-KEEP_BOTTOM_FRAMES:]
+
+    header = f"{parsed.exception_type}: {parsed.message}" if parsed.message else parsed.exception_type
+    # Frames are listed innermost first, whatever the source language's order
+    return strip_volatile("\n".join([header, "(frames, innermost first)"] + lines).strip())
+
+
+def _fingerprint(parsed: ParsedTrace, framework: Optional[str] = None) -> str:
+    app_frames = [f for f in parsed.frames if not f.is_library and f.file] or parsed.frames
+    top = [f"{os.path.basename(f.file)}:{strip_volatile(f.function)}" for f in app_frames[:FINGERPRINT_FRAMES]]
+    # The message tells apart different errors raised in the same place
+    message = " ".join(strip_volatile(parsed.message).split())[:FINGERPRINT_MESSAGE_CHARS]
+    framework = (framework or "").strip().lower()
+    payload = json.dumps([parsed.language, framework, parsed.exception_type, message, top])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def normalize_stacktrace(stack_trace: str, language: Optional[str] = None) -> str:
+    """
+    Compact a stack trace for the prompt: strip volatile tokens, collapse
+    recursion and repeated frames, summarise library frames and trim the
+    middle of very long traces.
+
+    Args:
+        stack_trace: The raw trace
+        language: Optional language hint
+
+    Returns:
+        The compacted trace (volatile tokens are stripped even if the
+        language is not recognised)
+    """
+    return preprocess_stacktrace(stack_trace, language)[0]
+
+
+def fingerprint_stacktrace(
+    stack_trace: str,
+    language: Optional[str] = None,
+    framework: Optional[str] = None
+) -> Optional[str]:
+    """
+    Compute a stable fingerprint from the framework, the exception type and
+    message (without volatile tokens) and the top application frames (file
+    and function, without line numbers)
+
+    Returns:
+        A hex digest, or None if the trace could not be parsed
+    """
+    return preprocess_stacktrace(stack_trace, language, framework)[1]
+
+
+def preprocess_stacktrace(
+    stack_trace: str,
+    language: Optional[str] = None,
+    framework: Optional[str] = None
+) -> Tuple[str, Optional[str]]:
+    """
+    Parse a trace once and return both its compacted form and its fingerprint
+
+    Args:
+        stack_trace: The raw trace
+        language: Optional language hint
+        framework: Framework the caller named, part of the fingerprint
+
+    Returns:
+        (normalized trace, fingerprint or None)
+    """
+    parsed = parse_stacktrace(stack_trace, language)
+    if parsed is None:
+        return strip_volatile(stack_trace.strip()), None
+    return _normalize(parsed), _fingerprint(parsed, framework)
+
+
+class FingerprintIndex:
+    """
+    Persistent fingerprint -> answer index so repeated traces are served
+    without an upstream call
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = FINGERPRINT_DB_PATH,
+        ttl: float = FINGERPRINT_TTL_SECONDS,
+        max_memory: int = FINGERPRINT_MAX_MEMORY,
+        max_rows: int = FINGERPRINT_MAX_ROWS
+    ):
+        self.ttl = ttl
+        self.max_memory = max_memory
+        self.max_rows = max_rows
+        self._memory: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._conn = None
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0}
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS fingerprints ("
+                "fingerprint TEXT PRIMARY KEY, answer TEXT NOT NULL, "
+                "created_at REAL NOT NULL, hits INTEGER NOT NULL DEFAULT 0, "
+                "accessed_at REAL NOT NULL DEFAULT 0)"
+            )
+            columns = [row[1] for row in self._conn.execute("PRAGMA table_info(fingerprints)")]
+            if "accessed_at" not in columns:
+                # Indexes written before rows were evicted by last use
+                self._conn.execute("ALTER TABLE fingerprints ADD COLUMN accessed_at REAL NOT NULL DEFAULT 0")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS fingerprints_accessed ON fingerprints (accessed_at)")
+
+    def _get(self, fingerprint: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT answer, created_at FROM fingerprints WHERE fingerprint = ?", (fingerprint,)
+            ).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > self.ttl:
+                self._conn.execute("DELETE FROM fingerprints WHERE fingerprint = ?", (fingerprint,))
+                return None
+            self._conn.execute(
+                "UPDATE fingerprints SET hits = hits + 1, accessed_at = ? WHERE fingerprint = ?", (now, fingerprint)
+            )
+        return json.loads(row[0])
+
+    def _set(self, fingerprint: str, answer: Dict[str, Any]) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO fingerprints (fingerprint, answer, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?)",
+                (fingerprint, json.dumps(answer), now, now)
+            )
+            self._evict(now)
+
+    def _evict(self, now: float) -> None:
+        self._conn.execute("DELETE FROM fingerprints WHERE created_at < ?", (now - self.ttl,))
+        excess = self._conn.execute("SELECT COUNT(*) FROM fingerprints").fetchone()[0] - self.max_rows
+        if excess > 0:
+            # Drop a tenth at a time so eviction is not paid on every insert
+            self._conn.execute(
+                "DELETE FROM fingerprints WHERE fingerprint IN "
+                "(SELECT fingerprint FROM fingerprints ORDER BY accessed_at LIMIT ?)",
+                (max(excess, self.max_rows // 10),)
+            )
+
+    def _remember(self, fingerprint: str, answer: Dict[str, Any], created_at: float) -> None:
+        self._memory[fingerprint] = (created_at, answer)
+        self._memory.move_to_end(fingerprint)
+        while len(self._memory) > self.max_memory:
+            self._memory.popitem(last=False)
+
+    async def get(self, fingerprint: str) -> Optional[Dict[str, Any]]:
+        """
+        Return the stored answer for a fingerprint, if still fresh
+        """
+        answer = None
+        entry = self._memory.get(fingerprint)
+        if entry is not None and time.time() - entry[0] <= self.ttl:
+            self._memory.move_to_end(fingerprint)
+            answer = entry[1]
+        elif self._conn is not None:
+            answer = await asyncio.to_thread(self._get, fingerprint)
+            if answer is not None:
+                self._remember(fingerprint, answer, time.time())
+        self._stats["hits" if answer is not None else "misses"] += 1
+        return answer
+
+    async def set(self, fingerprint: str, answer: Dict[str, Any]) -> None:
+        """
+        Store the answer produced for a fingerprint
+        """
+        self._remember(fingerprint, answer, time.time())
+        if self._conn is not None:
+            await asyncio.to_thread(self._set, fingerprint, answer)
+
+    def stats(self) -> Dict[str, int]:
+        return {**self._stats, "memory_entries": len(self._memory)}
+
+# Create a singleton instance
+fingerprint_index = FingerprintIndex()
@@ -0,0 +1,210 @@
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+import json
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+
+
+class IncrementalJSONParser:
+    """
+    Incremental parser for a single JSON object arriving in chunks.
+
+    Each top-level field is emitted as soon as its value is complete, so
+    callers can forward e.g. "explanation" while the model is still writing
+    "possible_fixes". Any text before the opening brace (such as a markdown
+    code fence) is ignored.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.fields: Dict[str, Any] = {}
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._phase = "start"  # start, key, colon, value, done
+        self._key_start = 0
+        self._key: Optional[str] = None
+        self._value_start = 0
+
+    @property
+    def done(self) -> bool:
+        return self._phase == "done"
+
+    def feed(self, text: str) -> List[Tuple[str, Any]]:
+        """
+        Consume the next chunk of model output
+
+        Args:
+            text: The next text delta
+
+        Returns:
+            The (field, value) pairs completed by this chunk
+        """
+        self.buffer += text
+        completed = []
+        buf = self.buffer
+        while self._pos < len(buf) and self._phase != "done":
+            i = self._pos
+            ch = buf[i]
+            self._pos += 1
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    if self._phase == "key" and self._depth == 1:
+                        self._key = json.loads(buf[self._key_start:i + 1])
+                        self._phase = "colon"
+                continue
+
+            if self._phase == "start":
+                if ch == "{":
+                    self._depth = 1
+                    self._phase = "key"
+            elif self._phase == "key":
+                if ch == '"':
+                    self._in_string = True
+                    self._key_start = i
+                elif ch == "}":
+                    self._phase = "done"
+            elif self._phase == "colon":
+                if ch == ":":
+                    self._phase = "value"
+                    self._value_start = i + 1
+            elif self._phase == "value":
+                if ch == '"':
+                    self._in_string = True
+                elif ch in "{[":
+                    self._depth += 1
+                elif ch in "}]" and self._depth > 1:
+                    self._depth -= 1
+                elif ch in ",}" and self._depth == 1:
+                    field = self._emit(buf[self._value_start:i])
+                    if field is not None:
+                        completed.append(field)
+                    self._phase = "key" if ch == "," else "done"
+        return completed
+
+    def _emit(self, raw: str) -> Optional[Tuple[str, Any]]:
+        try:
+            value = json.loads(raw)
+        except json.JSONDecodeError:
+            return None
+        self.fields[self._key] = value
+        return self._key, value
+
+
+def format_event(event: str, data: Any, fmt: str = "sse") -> str:
+    """
+    Serialize one stream event as an SSE frame or an NDJSON line
+    """
+    if fmt == "ndjson":
+        return json.dumps({"event": event, "data": data}) + "\n"
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def prime_stream(chunks: AsyncIterator[Dict[str, Any]]) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Pull the first chunk eagerly so that errors raised before any token is
+    produced (no provider, overload, auth) surface as HTTP errors rather
+    than as an in-band error event.
+
+    Returns:
+        An iterator yielding the same chunks
+    """
+    try:
+        first = await chunks.__anext__()
+    except StopAsyncIteration:
+        first = None
+
+    async def replay():
+        if first is not None:
+            yield first
+        async for chunk in chunks:
+            yield chunk
+
+    return replay()
+
+
+async def stream_structured(
+    chunks: AsyncIterator[Dict[str, Any]],
+    build_result: Callable[[str, str], Awaitable[BaseModel]],
+    fmt: str = "sse",
+    on_result: Optional[Callable[[BaseModel], Awaitable[None]]] = None
+) -> AsyncIterator[str]:
+    """
+    Turn a provider token stream into token / field / result events
+
+    Args:
+        chunks: Iterator of {"provider", "delta"} dicts from AIService.stream_response
+        build_result: Builds the final response model from (content, provider)
+        fmt: "sse" or "ndjson"
+        on_result: Optional coroutine called with the final model
+
+    Yields:
+        Serialized events; the last one is either "result" or "error"
+    """
+    parser = IncrementalJSONParser()
+    provider = None
+    try:
+        async for chunk in chunks:
+            provider = chunk["provider"]
+            yield format_event("token", {"delta": chunk["delta"]}, fmt)
+            for name, value in parser.feed(chunk["delta"]):
+                yield format_event("field", {"name": name, "value": value}, fmt)
+        # Prefer the cleanly parsed fields over the raw text (which may be fenced)
+        content = json.dumps(parser.fields) if parser.done else parser.buffer
+        result = await build_result(content, provider or "unknown")
+        yield format_event("result", result.model_dump(), fmt)
+        if on_result is not None:
+            await on_result(result)
+    except Exception as e:
+        yield format_event("error", {"detail": str(e)}, fmt)
+
+
+async def stream_chunked(
+    results: AsyncIterator[Tuple[int, BaseModel]],
+    total: int,
+    merge: Callable[[List[BaseModel]], BaseModel],
+    fmt: str = "sse"
+) -> AsyncIterator[str]:
+    """
+    Stream a map-reduce run: one "chunk" event per finished chunk (in
+    completion order), then the merged "result"
+
+    Args:
+        results: (index, model) pairs from services.map_reduce.map_chunks
+        total: Number of chunks
+        merge: Combines the per-chunk models, in chunk order
+        fmt: "sse" or "ndjson"
+    """
+    ordered: List[Optional[BaseModel]] = [None] * total
+    try:
+        async for index, result in results:
+            ordered[index] = result
+            yield format_event("chunk", {"index": index, "total": total, "value": result.model_dump()}, fmt)
+        yield format_event("result", merge(ordered).model_dump(), fmt)
+    except Exception as e:
+        yield format_event("error", {"detail": str(e)}, fmt)
+
+
+async def single_result(result: BaseModel, fmt: str = "sse") -> AsyncIterator[str]:
+    """
+    Emit an already known result as a one-event stream
+    """
+    yield format_event("result", result.model_dump(), fmt)
+
+
+def event_stream_response(events: AsyncIterator[str], fmt: str = "sse") -> StreamingResponse:
+    """
+    Wrap serialized events in a StreamingResponse with proxy buffering disabled
+    """
+    media_type = "application/x-ndjson" if fmt == "ndjson" else "text/event-stream"
+    return StreamingResponse(
+        events,
+        media_type=media_type,
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
@@ -0,0 +1,293 @@
+from typing import Optional, Dict, Any, Awaitable, Callable, List, Type, TypeVar, get_args, get_origin
+from collections import defaultdict
+import json
+import os
+import re
+from pydantic import BaseModel, ValidationError
+from services.ai_service import ai_service
+
+# Completion budget for the follow-up call that fills in missing fields
+REASK_MAX_TOKENS = int(os.getenv("REASK_MAX_TOKENS", "600"))
+
+T = TypeVar("T", bound=BaseModel)
+
+# Placeholder for required string fields the model never produced
+UNKNOWN = "Unknown"
+
+_FENCE = re.compile(r"```[\w+-]*\n(.*?)(?:```|$)", re.S)
+
+# Per-provider parse outcomes: clean, repaired, reasked, failed
+_stats: Dict[str, Dict[str, int]] = defaultdict(lambda: {"clean": 0, "repaired": 0, "reasked": 0, "failed": 0})
+
+
+def _strip_trailing_commas(text: str) -> str:
+    out = []
+    in_string = escape = False
+    for i, ch in enumerate(text):
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch == ",":
+            rest = text[i + 1:].lstrip()
+            if rest.startswith(("}", "]")):
+                continue
+        out.append(ch)
+    return "".join(out)
+
+
+def _close_truncated(text: str) -> str:
+    """
+    Close an object cut off mid-way (e.g. by max_tokens): terminate an
+    open string, drop a dangling key or comma, then close open brackets
+    """
+    stack = []
+    in_string = escape = False
+    for ch in text:
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+        elif ch in "}]" and stack:
+            stack.pop()
+    if in_string:
+        text += '"'
+    if stack and stack[-1] == "}":
+        # A trailing `"key"` or `"key":` without a value cannot be completed
+        text = re.sub(r'([{,])\s*"(?:[^"\\]|\\.)*"\s*:?\s*$', r"\1", text)
+    text = text.rstrip().rstrip(",")
+    return text + "".join(reversed(stack))
+
+
+def tolerant_json_loads(text: str) -> Optional[Dict[str, Any]]:
+    """
+    Parse a JSON object out of model output, tolerating code fences,
+    surrounding prose, trailing commas and truncation
+
+    Args:
+        text: Raw model output
+
+    Returns:
+        The parsed object, or None if no object could be recovered
+    """
+    start = text.find("{")
+    if start == -1:
+        return None
+    candidate = text[start:]
+    end = candidate.rfind("}")
+    attempts = []
+    if end != -1:
+        attempts.append(candidate[:end + 1])
+    attempts.append(candidate)
+    for attempt in attempts:
+        for transform in (lambda t: t, _strip_trailing_commas, lambda t: _close_truncated(_strip_trailing_commas(t))):
+            try:
+                value = json.loads(transform(attempt), strict=False)
+            except json.JSONDecodeError:
+                continue
+            if isinstance(value, dict):
+                return value
+    return None
+
+
+def _is_list(annotation: Any) -> bool:
+    if get_origin(annotation) is list:
+        return True
+    return any(get_origin(arg) is list for arg in get_args(annotation))
+
+
+def _coerce(value: Any, annotation: Any) -> Any:
+    """
+    Coerce common shape mistakes: a list where a string is expected and a
+    string (bulleted or newline separated) where a list is expected
+    """
+    if _is_list(annotation):
+        if isinstance(value, str):
+            items = [re.sub(r"^\s*(?:[-*\u2022]|\d+[.)])\s*", "", line).strip() for line in value.split("\n")]
+            return [item for item in items if item]
+        if isinstance(value, list):
+            return [json.dumps(v) if isinstance(v, (dict, list)) else str(v) for v in value if v is not None]
+        return value
+    if isinstance(value, list):
+        return "\n".join(str(v) for v in value)
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    return value
+
+
+def _required_fields(model: Type[BaseModel], extra: Dict[str, Any]) -> List[str]:
+    return [name for name, field in model.model_fields.items() if field.is_required() and name not in extra]
+
+
+def _fill_defaults(model: Type[BaseModel], data: Dict[str, Any], extra: Dict[str, Any]) -> Dict[str, Any]:
+    filled = dict(data)
+    for name, field in model.model_fields.items():
+        if name not in filled and name not in extra and field.is_required():
+            filled[name] = [] if _is_list(field.annotation) else UNKNOWN
+    return filled
+
+
+def repair(
+    data: Dict[str, Any],
+    model: Type[BaseModel],
+    extra: Optional[Dict[str, Any]] = None
+) -> tuple[Dict[str, Any], List[str]]:
+    """
+    Keep the fields of data that fit the model, coercing where possible
+
+    Args:
+        data: Parsed model output
+        model: Target Pydantic model
+        extra: Fields supplied by the caller rather than the model
+
+    Returns:
+        (usable fields, required fields still missing)
+    """
+    extra = extra or {}
+    fields = {}
+    for name, field in model.model_fields.items():
+        if name in extra or name not in data or data[name] is None:
+            continue
+        value = _coerce(data[name], field.annotation)
+        if value == "" and field.is_required():
+            continue
+        fields[name] = value
+    missing = [name for name in _required_fields(model, extra) if name not in fields]
+    return fields, missing
+
+
+def _from_text(content: str, text_field: Optional[str], code_field: Optional[str]) -> Dict[str, Any]:
+    """
+    Salvage fields from a plain-text answer: the first fenced block becomes
+    the code field and the prose becomes the text field
+    """
+    fields: Dict[str, Any] = {}
+    fence = _FENCE.search(content)
+    if code_field and fence:
+        fields[code_field] = fence.group(1).strip()
+        content = _FENCE.sub("", content).strip()
+    if text_field and content.strip():
+        fields[text_field] = content.strip()
+    return fields
+
+
+def missing_fields_prompt(original_prompt: str, partial: Dict[str, Any], missing: List[str]) -> str:
+    """
+    Build the follow-up prompt that asks only for the missing fields
+    """
+    return "\n".join([
+        original_prompt,
+        "\nYou already answered part of this. Your answer so far:",
+        json.dumps(partial, indent=2),
+        f"\nIt is missing these fields: {', '.join(missing)}.",
+        "Respond with ONLY a JSON object containing exactly these keys:",
+        json.dumps({name: "..." for name in missing})
+    ])
+
+
+def make_reask(prompt: str, provider: str) -> Callable[[Dict[str, Any], List[str]], Awaitable[str]]:
+    """
+    Build a reask callback that asks the provider that produced the partial
+    answer for the missing fields only
+
+    Args:
+        prompt: The original prompt
+        provider: Provider that produced the partial answer
+    """
+    async def reask(partial: Dict[str, Any], missing: List[str]) -> str:
+        response = await ai_service.generate_response(
+            prompt=missing_fields_prompt(prompt, partial, missing),
+            preferred_provider=provider,
+            max_tokens=REASK_MAX_TOKENS,
+            temperature=0,
+            json_mode=True
+        )
+        return response["content"]
+
+    return reask
+
+
+async def parse_structured(
+    content: str,
+    model: Type[T],
+    provider: str,
+    extra: Optional[Dict[str, Any]] = None,
+    reask: Optional[Callable[[Dict[str, Any], List[str]], Awaitable[str]]] = None,
+    text_field: Optional[str] = None,
+    code_field: Optional[str] = None
+) -> T:
+    """
+    Turn model output into a validated response model without re-running
+    the whole request: tolerant JSON parsing, then repair against the
+    model, then (optionally) one follow-up call for only the missing
+    fields, then defaults
+
+    Args:
+        content: Raw model output
+        model: Target Pydantic model
+        provider: Provider that produced the output (for stats)
+        extra: Fields supplied by the caller (e.g. provider_used)
+        reask: Coroutine taking (partial fields, missing names) and returning
+            the model's answer for just those fields
+        text_field: Field that receives a plain-text answer
+        code_field: Field that receives the first fenced code block of a plain-text answer
+
+    Returns:
+        An instance of model
+    """
+    extra = extra or {}
+    data = tolerant_json_loads(content)
+    clean = data is not None
+    if data is None:
+        data = _from_text(content, text_field, code_field)
+
+    fields, missing = repair(data, model, extra)
+    outcome = "clean" if clean and not missing else "repaired"
+
+    if missing and reask is not None:
+        try:
+            follow_up = tolerant_json_loads(await reask(fields, missing)) or {}
+            more, missing = repair({**follow_up, **fields}, model, extra)
+            fields = more
+            outcome = "reasked"
+        except Exception:
+            pass
+
+    if missing:
+        outcome = "failed" if not fields else outcome
+        fields = _fill_defaults(model, fields, extra)
+
+    _stats[provider][outcome] += 1
+    try:
+        return model(**fields, **extra)
+    except ValidationError:
+        _stats[provider]["failed"] += 1
+        _stats[provider][outcome] -= 1
+        return model(**_fill_defaults(model, {}, extra), **extra)
+
+
+def parse_stats() -> Dict[str, Dict[str, Any]]:
+    """
+    Parse outcome counts and repair / failure rates per provider
+    """
+    report = {}
+    for provider, counts in _stats.items():
+        total = sum(counts.values())
+        report[provider] = {
+            **counts,
+            "repair_rate": round((counts["repaired"] + counts["reasked"]) / total, 4) if total else 0.0,
+            "failure_rate": round(counts["failed"] / total, 4) if total else 0.0
+        }
+    return report
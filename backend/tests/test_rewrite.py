@@ -0,0 +1,275 @@
+"""
+Input/output tables for the local rewrite rules in services.rewrite
+"""
+import pytest
+
+from services import rewrite
+
+
+def _case(name: str, source: str, expected: str):
+    return pytest.param(source, expected, id=name)
+
+
+OBJECT_BASE = [
+    _case("removed", "class A(object):\n    pass\n", "class A:\n    pass\n"),
+    _case("other bases kept", "class A(object, Mixin):\n    pass\n", "class A(object, Mixin):\n    pass\n"),
+    _case("no base", "class A:\n    pass\n", "class A:\n    pass\n"),
+]
+
+EXCEPT_AS = [
+    _case("single", "try:\n    f()\nexcept ValueError, e:\n    g(e)\n", "try:\n    f()\nexcept ValueError as e:\n    g(e)\n"),
+    _case("tuple", "try:\n    f()\nexcept (A, B), e:\n    g(e)\n", "try:\n    f()\nexcept (A, B) as e:\n    g(e)\n"),
+    _case("already as", "try:\n    f()\nexcept A as e:\n    g(e)\n", "try:\n    f()\nexcept A as e:\n    g(e)\n"),
+]
+
+PY2_BUILTINS = [
+    _case("xrange", "for i in xrange(3):\n    pass\n", "for i in range(3):\n    pass\n"),
+    _case("raw_input", "name = raw_input()\n", "name = input()\n"),
+    _case("iteritems", "for k, v in d.iteritems():\n    pass\n", "for k, v in d.items():\n    pass\n"),
+    _case("string untouched", "s = 'xrange'\n", "s = 'xrange'\n"),
+]
+
+PRINT_FUNCTION = [
+    _case("statement", "print 'hi'\n", "print('hi')\n"),
+    _case("several values", "print a, b\n", "print(a, b)\n"),
+    _case("already a call", "print('hi')\n", "print('hi')\n"),
+]
+
+ZERO_ARG_SUPER = [
+    _case(
+        "method",
+        "class A(B):\n    def __init__(self):\n        super(A, self).__init__()\n",
+        "class A(B):\n    def __init__(self):\n        super().__init__()\n",
+    ),
+    _case(
+        "other class",
+        "class A(B):\n    def __init__(self):\n        super(B, self).__init__()\n",
+        "class A(B):\n    def __init__(self):\n        super(B, self).__init__()\n",
+    ),
+    _case(
+        "nested function",
+        "class A(B):\n    def run(self):\n        def inner():\n            return super(A, self).run()\n        return inner\n",
+        "class A(B):\n    def run(self):\n        def inner():\n            return super(A, self).run()\n        return inner\n",
+    ),
+    _case(
+        "comprehension",
+        "class A(B):\n    def run(self):\n        return [super(A, self).run() for _ in ()]\n",
+        "class A(B):\n    def run(self):\n        return [super(A, self).run() for _ in ()]\n",
+    ),
+    _case(
+        "first parameter not self",
+        "class A(B):\n    def run(self, other):\n        return super(A, other).run()\n",
+        "class A(B):\n    def run(self, other):\n        return super(A, other).run()\n",
+    ),
+]
+
+EMPTY_LITERALS = [
+    _case("dict and list", "a = dict()\nb = list()\n", "a = {}\nb = []\n"),
+    _case("with arguments", "a = dict(x=1)\n", "a = dict(x=1)\n"),
+    _case("shadowed", "dict = MyDict\na = dict()\n", "dict = MyDict\na = dict()\n"),
+]
+
+FSTRINGS = [
+    _case("format positional", "s = '{} {}'.format(a, b)\n", "s = f'{a} {b}'\n"),
+    _case("format named", "s = '{x}!'.format(x=name)\n", "s = f'{name}!'\n"),
+    _case("percent", "s = '%s-%s' % (a, b)\n", "s = f'{a}-{b}'\n"),
+    _case("format spec kept", "s = '{:.2f}'.format(x)\n", "s = f'{x:.2f}'\n"),
+    _case("starred left alone", "s = '{} {}'.format(*args)\n", "s = '{} {}'.format(*args)\n"),
+]
+
+BUILTIN_GENERICS = [
+    _case(
+        "typing import pruned",
+        "from typing import List, Dict\n\ndef f(a: List[int]) -> Dict[str, int]:\n    pass\n",
+        "\ndef f(a: list[int]) -> dict[str, int]:\n    pass\n",
+    ),
+    _case(
+        "user-defined List",
+        "class List:\n    pass\n\ndef f(a: List[int]):\n    pass\n",
+        "class List:\n    pass\n\ndef f(a: List[int]):\n    pass\n",
+    ),
+]
+
+UNION_OPERATOR = [
+    _case(
+        "optional",
+        "from typing import Optional\n\ndef f(a: Optional[int]):\n    pass\n",
+        "\ndef f(a: int | None):\n    pass\n",
+    ),
+    _case(
+        "union",
+        "from typing import Union\n\ndef f(a: Union[int, str]):\n    pass\n",
+        "\ndef f(a: int | str):\n    pass\n",
+    ),
+]
+
+STRIP_COMMENTS = [
+    _case("own line and trailing", "# note\nx = 1  # one\n", "x = 1\n"),
+    _case("shebang kept", "#!/usr/bin/env python\nx = 1\n", "#!/usr/bin/env python\nx = 1\n"),
+    _case("hash in string", "s = '# not a comment'\n", "s = '# not a comment'\n"),
+]
+
+JAVA_LAMBDAS = [
+    _case(
+        "comparator",
+        "class A {\n"
+        "    void run(List<String> items) {\n"
+        "        Collections.sort(items, new Comparator<String>() {\n"
+        "            public int compare(String a, String b) {\n"
+        "                return a.compareTo(b);\n"
+        "            }\n"
+        "        });\n"
+        "    }\n"
+        "}",
+        "class A {\n"
+        "    void run(List<String> items) {\n"
+        "        Collections.sort(items, (a, b) -> a.compareTo(b));\n"
+        "    }\n"
+        "}",
+    ),
+    _case(
+        "parameter shadows a local",
+        "class A {\n"
+        "    void run(List<String> items) {\n"
+        "        String s = \"x\";\n"
+        "        Collections.sort(items, new Comparator<String>() {\n"
+        "            public int compare(String s, String t) {\n"
+        "                return s.compareTo(t);\n"
+        "            }\n"
+        "        });\n"
+        "    }\n"
+        "}",
+        None,
+    ),
+    _case(
+        "body local shadows a parameter",
+        "class A {\n"
+        "    void run(int n) {\n"
+        "        executor.submit(new Runnable() {\n"
+        "            public void run() {\n"
+        "                int n = 3;\n"
+        "                System.out.println(n);\n"
+        "            }\n"
+        "        });\n"
+        "    }\n"
+        "}",
+        None,
+    ),
+    _case(
+        "uses this",
+        "class A {\n"
+        "    void run() {\n"
+        "        executor.submit(new Runnable() {\n"
+        "            public void run() {\n"
+        "                System.out.println(this);\n"
+        "            }\n"
+        "        });\n"
+        "    }\n"
+        "}",
+        None,
+    ),
+]
+
+JAVA_DIAMOND = [
+    _case("constructor", "List<String> xs = new ArrayList<String>();", "List<String> xs = new ArrayList<>();"),
+    _case("already diamond", "List<String> xs = new ArrayList<>();", "List<String> xs = new ArrayList<>();"),
+]
+
+
+def _check(apply, source: str, expected):
+    code, count = apply(source)
+    if expected is None:
+        assert (code, count) == (source, 0)
+    else:
+        assert code == expected
+        assert bool(count) == (expected != source)
+
+
+@pytest.mark.parametrize("source, expected", OBJECT_BASE)
+def test_object_base(source, expected):
+    _check(rewrite._object_base, source, expected)
+
+
+@pytest.mark.parametrize("source, expected", EXCEPT_AS)
+def test_except_as(source, expected):
+    _check(rewrite._except_as, source, expected)
+
+
+@pytest.mark.parametrize("source, expected", PY2_BUILTINS)
+def test_py2_builtins(source, expected):
+    _check(rewrite._py2_builtins, source, expected)
+
+
+@pytest.mark.parametrize("source, expected", PRINT_FUNCTION)
+def test_print_function(source, expected):
+    _check(rewrite._print_function, source, expected)
+
+
+@pytest.mark.parametrize("source, expected", ZERO_ARG_SUPER)
+def test_zero_arg_super(source, expected):
+    _check(rewrite._zero_arg_super, source, expected)
+
+
+@pytest.mark.parametrize("source, expected", EMPTY_LITERALS)
+def test_empty_literals(source, expected):
+    _check(rewrite._empty_literals, source, expected)
+
+
+@pytest.mark.parametrize("source, expected", FSTRINGS)
+def test_fstrings(source, expected):
+    _check(rewrite._fstrings, source, expected)
+
+
+@pytest.mark.parametrize("source, expected", BUILTIN_GENERICS)
+def test_builtin_generics(source, expected):
+    _check(rewrite._builtin_generics, source, expected)
+
+
+@pytest.mark.parametrize("source, expected", UNION_OPERATOR)
+def test_union_operator(source, expected):
+    _check(rewrite._union_operator, source, expected)
+
+
+@pytest.mark.parametrize("source, expected", STRIP_COMMENTS)
+def test_strip_comments(source, expected):
+    _check(rewrite._strip_comments, source, expected)
+
+
+@pytest.mark.parametrize("source, expected", JAVA_LAMBDAS)
+def test_java_lambdas(source, expected):
+    _check(rewrite._java_lambdas, source, expected)
+
+
+@pytest.mark.parametrize("source, expected", JAVA_DIAMOND)
+def test_java_diamond(source, expected):
+    _check(rewrite._java_diamond, source, expected)
+
+
+@pytest.mark.parametrize("source", [
+    "import urllib2\n",
+    "import cPickle as pickle\n",
+    "first = d.keys()[0]\n",
+    "first = map(f, xs)[0]\n",
+    "import sys\nbig = sys.maxint\n",
+    "class A:\n    __metaclass__ = Meta\n",
+    "n = long(x)\n",
+])
+def test_python2_semantics_go_to_the_model(source):
+    result = rewrite.rewrite_code(source, "python", "2.7", "3.12")
+    assert result.residual
+
+
+@pytest.mark.parametrize("source", [
+    "xs = sorted(d.keys())\n",
+    "n = len(d.items())\n",
+    "for x in map(f, xs):\n    pass\n",
+])
+def test_python2_views_that_still_work_stay_local(source):
+    assert rewrite.rewrite_code(source, "python", "2.7", "3.12").residual == []
+
+
+def test_skipped_lambda_goes_to_the_model():
+    source = JAVA_LAMBDAS[1].values[0]
+    result = rewrite.rewrite_code(source, "java", "7", "17")
+    assert result.code == source
+    assert result.residual
@@ -0,0 +1,32 @@
+"""
+Standalone job worker, so workers can be scaled separately from the API.
+
+Run from the backend directory with JOBS_RUN_IN_API=false on the API:
+
+    python worker.py
+"""
+import asyncio
+import logging
+import signal
+from routers import jobs, repository  # noqa: F401  (registers the job handlers)
+from services.ai_service import ai_service
+from services.jobs import JobWorker, job_store, JOBS_WORKERS
+
+async def main():
+    worker = JobWorker(job_store, JOBS_WORKERS)
+    await worker.start()
+    logging.info("Job worker %s started with %d workers", worker.name, JOBS_WORKERS)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+    # Running jobs are handed back to the queue for another worker
+    await worker.stop()
+    await ai_service.aclose()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
@@ -9,6 +9,14 @@ const apiClient = axios.create({
   }
 })
 
+// Forward axios timeouts so the API stops working on requests we gave up on
+apiClient.interceptors.request.use(config => {
+  if (config.timeout) {
+    config.headers['X-Request-Timeout'] = `${config.timeout}ms`
+  }
+  return config
+})
+
 // Add response interceptor for error handling
 apiClient.interceptors.response.use(
   response => response,